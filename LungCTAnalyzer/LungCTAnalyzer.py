@@ -9,6 +9,7 @@ import sys, subprocess
 from slicer.ScriptedLoadableModule import *
 from slicer.util import VTKObservationMixin
 from SegmentStatisticsPlugins import *
+import LungCTAnalyzerLib
 
 #
 # LungCTAnalyzer
@@ -104,13 +105,23 @@ class LungCTAnalyzerWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         self.batchProcessingOutputDir = ""
         self.batchProcessingTestMode = False
         self.batchProcessingIsCancelled = False
+        self.batchProcessingWorkers = 1
         self.csvOnly = False
+        self.writeResultsDatabase = False
+        self.multiLabelOutput = True
+        self.segmentFilesOutput = False
+        self.outputCompression = "fast"
+        self.minimalOutput = False
+        self.timingColumns = False
         self.useCalibratedCT = False
         self.scanInput = False
         self.lobeAnalysis = False
         self.areaAnalysis = False
         self.batchProcessing = False
         self.isNiiGzFormat = False
+        self.livePreview = False
+        # set while an interactive analysis runs in the background (see onApplyButton)
+        self.applyRunning = False
         self.checkForUpdates = True
         self.resetmode = False
         
@@ -147,6 +158,11 @@ class LungCTAnalyzerWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         self.volumeRenderingPropertyUpdateTimer.setSingleShot(True)
         self.volumeRenderingPropertyUpdateTimer.timeout.connect(self.updateVolumeRenderingProperty)
 
+        self.livePreviewUpdateTimer = qt.QTimer()
+        self.livePreviewUpdateTimer.setInterval(300)
+        self.livePreviewUpdateTimer.setSingleShot(True)
+        self.livePreviewUpdateTimer.timeout.connect(self.updateLivePreview)
+
         # Connections
 
         # These connections ensure that we update parameter node when scene is closed
@@ -168,6 +184,8 @@ class LungCTAnalyzerWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         # Output options
         self.ui.generateStatisticsCheckBox.connect('toggled(bool)', self.updateParameterNodeFromGUI)
         self.ui.lobeAnalysisCheckBox.connect('toggled(bool)', self.updateParameterNodeFromGUI)
+        self.ui.lobeSegmentsCheckBox.connect('toggled(bool)', self.updateParameterNodeFromGUI)
+        self.ui.countBullaeCheckBox.connect('toggled(bool)', self.updateParameterNodeFromGUI)
         self.ui.areaAnalysisCheckBox.connect('toggled(bool)', self.updateParameterNodeFromGUI)
         self.ui.niigzFormatCheckBox.connect('toggled(bool)', self.updateParameterNodeFromGUI)
 
@@ -177,11 +195,18 @@ class LungCTAnalyzerWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         self.ui.volumeRenderingPropertyNodeSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.updateParameterNodeFromGUI)
         self.ui.testModeCheckBox.connect('toggled(bool)', self.updateParameterNodeFromGUI)
         self.ui.csvOnlyCheckBox.connect('toggled(bool)', self.updateParameterNodeFromGUI)
+        self.ui.resultsDatabaseCheckBox.connect('toggled(bool)', self.updateParameterNodeFromGUI)
+        self.ui.multiLabelOutputCheckBox.connect('toggled(bool)', self.updateParameterNodeFromGUI)
+        self.ui.segmentFilesOutputCheckBox.connect('toggled(bool)', self.updateParameterNodeFromGUI)
+        self.ui.outputCompressionComboBox.connect('currentIndexChanged(int)', self.updateParameterNodeFromGUI)
+        self.ui.minimalOutputCheckBox.connect('toggled(bool)', self.updateParameterNodeFromGUI)
+        self.ui.timingColumnsCheckBox.connect('toggled(bool)', self.updateParameterNodeFromGUI)
         self.ui.useCalibratedCTCheckBox.connect('toggled(bool)', self.updateParameterNodeFromGUI)
         self.ui.scanInputCheckBox.connect('toggled(bool)', self.updateParameterNodeFromGUI)
 
         # Advanced options
         self.ui.checkForUpdatesCheckBox.connect('toggled(bool)', self.updateParameterNodeFromGUI)
+        self.ui.useResultCacheCheckBox.connect('toggled(bool)', self.updateParameterNodeFromGUI)
 
         # Thresholds
         self.ui.BullaRangeWidget.connect('valuesChanged(double,double)', self.onBullaRangeWidgetChanged)
@@ -189,6 +214,7 @@ class LungCTAnalyzerWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         self.ui.InfiltratedRangeWidget.connect('valuesChanged(double,double)', self.onInfiltratedRangeWidgetChanged)
         self.ui.CollapsedRangeWidget.connect('valuesChanged(double,double)', self.onCollapsedRangeWidgetChanged)
         self.ui.VesselsRangeWidget.connect('valuesChanged(double,double)', self.onVesselsRangeWidgetChanged)
+        self.ui.livePreviewCheckBox.connect('toggled(bool)', self.onLivePreviewToggled)
         self.ui.restoreDefaultsButton.connect('clicked(bool)', self.onRestoreDefaultsButton)
         self.ui.saveThresholdsButton.connect('clicked(bool)', self.onSaveThresholdsButton)
         self.ui.loadThresholdsButton.connect('clicked(bool)', self.onLoadThresholdsButton)
@@ -198,6 +224,7 @@ class LungCTAnalyzerWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         self.ui.inputDirectoryPathLineEdit.connect('currentPathChanged(const QString&)', self.onInputDirectoryPathLineEditChanged)
         self.ui.outputDirectoryPathLineEdit.connect('currentPathChanged(const QString&)', self.onOutputDirectoryPathLineEditChanged)
         
+        self.ui.batchProcessingWorkersSpinBox.connect('valueChanged(int)', self.onBatchProcessingWorkersChanged)
         self.ui.batchProcessingButton.connect('clicked(bool)', self.onBatchProcessingButton)
         self.ui.cancelBatchProcessingButton.connect('clicked(bool)', self.onCancelBatchProcessingButton)
           
@@ -212,6 +239,8 @@ class LungCTAnalyzerWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
 
         self.ui.inputDirectoryPathLineEdit.currentPath = settings.value("LungCtAnalyzer/batchProcessingInputFolder", "")      
         self.ui.outputDirectoryPathLineEdit.currentPath = settings.value("LungCtAnalyzer/batchProcessingOutputFolder", "")
+        if settings.value("LungCtAnalyzer/batchProcessingWorkers", "") != "":
+            self.ui.batchProcessingWorkersSpinBox.value = int(settings.value("LungCtAnalyzer/batchProcessingWorkers", ""))
 
         if settings.value("LungCtAnalyzer/BullaRangeWidgetMinimumValue", "") != "":               
             self.ui.BullaRangeWidget.minimumValue =  float(settings.value("LungCtAnalyzer/BullaRangeWidgetMinimumValue", ""))
@@ -245,6 +274,30 @@ class LungCTAnalyzerWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         if settings.value("LungCtAnalyzer/csvOnlyCheckBoxChecked", "") != "":               
             self.csvOnly = eval(settings.value("LungCtAnalyzer/csvOnlyCheckBoxChecked", ""))
             self.ui.csvOnlyCheckBox.checked = eval(settings.value("LungCtAnalyzer/csvOnlyCheckBoxChecked", ""))
+
+        if settings.value("LungCtAnalyzer/resultsDatabaseCheckBoxChecked", "") != "":
+            self.writeResultsDatabase = eval(settings.value("LungCtAnalyzer/resultsDatabaseCheckBoxChecked", ""))
+            self.ui.resultsDatabaseCheckBox.checked = self.writeResultsDatabase
+
+        if settings.value("LungCtAnalyzer/multiLabelOutputCheckBoxChecked", "") != "":
+            self.multiLabelOutput = eval(settings.value("LungCtAnalyzer/multiLabelOutputCheckBoxChecked", ""))
+            self.ui.multiLabelOutputCheckBox.checked = self.multiLabelOutput
+
+        if settings.value("LungCtAnalyzer/segmentFilesOutputCheckBoxChecked", "") != "":
+            self.segmentFilesOutput = eval(settings.value("LungCtAnalyzer/segmentFilesOutputCheckBoxChecked", ""))
+            self.ui.segmentFilesOutputCheckBox.checked = self.segmentFilesOutput
+
+        if settings.value("LungCtAnalyzer/outputCompression", "") != "":
+            self.outputCompression = settings.value("LungCtAnalyzer/outputCompression", "")
+            self.ui.outputCompressionComboBox.currentText = self.outputCompression
+
+        if settings.value("LungCtAnalyzer/minimalOutputCheckBoxChecked", "") != "":
+            self.minimalOutput = eval(settings.value("LungCtAnalyzer/minimalOutputCheckBoxChecked", ""))
+            self.ui.minimalOutputCheckBox.checked = self.minimalOutput
+
+        if settings.value("LungCtAnalyzer/timingColumnsCheckBoxChecked", "") != "":
+            self.timingColumns = eval(settings.value("LungCtAnalyzer/timingColumnsCheckBoxChecked", ""))
+            self.ui.timingColumnsCheckBox.checked = self.timingColumns
        
         if settings.value("LungCtAnalyzer/useCalibratedCTCheckBoxChecked", "") != "":               
             self.useCalibratedCT = eval(settings.value("LungCtAnalyzer/useCalibratedCTCheckBoxChecked", ""))
@@ -266,6 +319,10 @@ class LungCTAnalyzerWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
             self.isNiiGzFormat = eval(settings.value("LungCtAnalyzer/niigzFormatCheckBoxChecked", ""))
             self.ui.niigzFormatCheckBox.checked = eval(settings.value("LungCtAnalyzer/niigzFormatCheckBoxChecked", ""))
 
+        if settings.value("LungCtAnalyzer/livePreviewCheckBoxChecked", "") != "":
+            self.livePreview = eval(settings.value("LungCtAnalyzer/livePreviewCheckBoxChecked", ""))
+            self.ui.livePreviewCheckBox.checked = eval(settings.value("LungCtAnalyzer/livePreviewCheckBoxChecked", ""))
+
         
         # Opacities
         self.opacitySliders = {
@@ -471,6 +528,9 @@ class LungCTAnalyzerWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         """
         Called just before the scene is closed.
         """
+        # an analysis running in the background must not continue on the closed scene
+        if self.applyRunning:
+            self.logic.requestCancel()
         # Parameter node will be reset, do not use it anymore
         self.setParameterNode(None)
 
@@ -642,14 +702,24 @@ class LungCTAnalyzerWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
 
         self.ui.testModeCheckBox.checked = self.batchProcessingTestMode
         self.ui.csvOnlyCheckBox.checked = self.csvOnly
+        self.ui.resultsDatabaseCheckBox.checked = self.writeResultsDatabase
+        self.ui.multiLabelOutputCheckBox.checked = self.multiLabelOutput
+        self.ui.segmentFilesOutputCheckBox.checked = self.segmentFilesOutput
+        self.ui.outputCompressionComboBox.currentText = self.outputCompression
+        self.ui.minimalOutputCheckBox.checked = self.minimalOutput
+        self.ui.timingColumnsCheckBox.checked = self.timingColumns
         self.ui.useCalibratedCTCheckBox.checked = self.useCalibratedCT
         self.ui.scanInputCheckBox.checked = self.scanInput
 
         self.ui.checkForUpdatesCheckBox.checked = self.checkForUpdates
         self.ui.generateStatisticsCheckBox.checked = self.logic.generateStatistics
         self.ui.lobeAnalysisCheckBox.checked = self.lobeAnalysis
+        self.ui.lobeSegmentsCheckBox.checked = self.logic.createLobeSegments
+        self.ui.countBullaeCheckBox.checked = self.logic.countBullae
+        self.ui.useResultCacheCheckBox.checked = self.logic.useResultCache
         self.ui.areaAnalysisCheckBox.checked = self.areaAnalysis
         self.ui.niigzFormatCheckBox.checked = self.isNiiGzFormat
+        self.ui.livePreviewCheckBox.checked = self.livePreview
 
         # Update buttons states and tooltips
 
@@ -659,8 +729,8 @@ class LungCTAnalyzerWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         self.ui.createPDFReportButton.enabled = (self.logic.resultsTable is not None)
         self.ui.saveResultsCSVButton.enabled = (self.logic.resultsTable is not None)
         self.ui.showResultsTablePushButton.enabled = (self.logic.resultsTable is not None)
-        self.ui.showCovidResultsTableButton.enabled = (self.logic.covidResultsTable is not None)
-        self.ui.showEmphysemaResultsTableButton.enabled = (self.logic.emphysemaResultsTable is not None)
+        self.ui.showCovidResultsTableButton.enabled = (self.logic.covidResultsTable is not None or self.logic.covidResultsPreviewTable is not None)
+        self.ui.showEmphysemaResultsTableButton.enabled = (self.logic.emphysemaResultsTable is not None or self.logic.emphysemaResultsPreviewTable is not None)
 
         self.ui.toggleInputSegmentationVisibility2DPushButton.enabled = (self.logic.inputSegmentation is not None)
         self.ui.toggleInputSegmentationVisibility3DPushButton.enabled = (self.logic.inputSegmentation is not None)
@@ -722,6 +792,18 @@ class LungCTAnalyzerWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         settings.setValue("LungCtAnalyzer/testModeCheckBoxChecked", str(self.batchProcessingTestMode))          
         self.csvOnly = self.ui.csvOnlyCheckBox.checked
         settings.setValue("LungCtAnalyzer/csvOnlyCheckBoxChecked", str(self.csvOnly))
+        self.writeResultsDatabase = self.ui.resultsDatabaseCheckBox.checked
+        settings.setValue("LungCtAnalyzer/resultsDatabaseCheckBoxChecked", str(self.writeResultsDatabase))
+        self.multiLabelOutput = self.ui.multiLabelOutputCheckBox.checked
+        settings.setValue("LungCtAnalyzer/multiLabelOutputCheckBoxChecked", str(self.multiLabelOutput))
+        self.segmentFilesOutput = self.ui.segmentFilesOutputCheckBox.checked
+        settings.setValue("LungCtAnalyzer/segmentFilesOutputCheckBoxChecked", str(self.segmentFilesOutput))
+        self.outputCompression = self.ui.outputCompressionComboBox.currentText
+        settings.setValue("LungCtAnalyzer/outputCompression", self.outputCompression)
+        self.minimalOutput = self.ui.minimalOutputCheckBox.checked
+        settings.setValue("LungCtAnalyzer/minimalOutputCheckBoxChecked", str(self.minimalOutput))
+        self.timingColumns = self.ui.timingColumnsCheckBox.checked
+        settings.setValue("LungCtAnalyzer/timingColumnsCheckBoxChecked", str(self.timingColumns))
         
         self.useCalibratedCT = self.ui.useCalibratedCTCheckBox.checked
         settings.setValue("LungCtAnalyzer/useCalibratedCTCheckBoxChecked", str(self.useCalibratedCT))
@@ -739,12 +821,14 @@ class LungCTAnalyzerWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         self.logic.generateStatistics = self.ui.generateStatisticsCheckBox.checked
         self.lobeAnalysis = self.ui.lobeAnalysisCheckBox.checked
         settings.setValue("LungCtAnalyzer/lobeAnalysisCheckBoxChecked", str(self.lobeAnalysis))
+        self.logic.createLobeSegments = self.ui.lobeSegmentsCheckBox.checked
         self.areaAnalysis = self.ui.areaAnalysisCheckBox.checked
         settings.setValue("LungCtAnalyzer/areaAnalysisCheckBoxChecked", str(self.areaAnalysis))
         self.isNiiGzFormat = self.ui.niigzFormatCheckBox.checked
         settings.setValue("LungCtAnalyzer/niigzFormatCheckBoxChecked", str(self.isNiiGzFormat))
         
-        self.logic.countBullae = False
+        self.logic.countBullae = self.ui.countBullaeCheckBox.checked
+        self.logic.useResultCache = self.ui.useResultCacheCheckBox.checked
 
         self._parameterNode.EndModify(wasModified)
 
@@ -787,6 +871,11 @@ class LungCTAnalyzerWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         settings=qt.QSettings(slicer.app.launcherSettingsFilePath, qt.QSettings.IniFormat)
         settings.setValue("LungCtAnalyzer/batchProcessingOutputFolder", self.ui.outputDirectoryPathLineEdit.currentPath);
 
+    def onBatchProcessingWorkersChanged(self, value):
+        self.batchProcessingWorkers = value
+        settings=qt.QSettings(slicer.app.launcherSettingsFilePath, qt.QSettings.IniFormat)
+        settings.setValue("LungCtAnalyzer/batchProcessingWorkers", str(value))
+
     def showStatusMessage(self, msg, timeoutMsec=500):
         slicer.util.showStatusMessage(msg, timeoutMsec)
         slicer.app.processEvents()
@@ -828,21 +917,18 @@ class LungCTAnalyzerWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         if not os.path.exists(self.batchProcessingInputDir):
             self.showCriticalError("Input folder does not exist.")
 
-        counter = 0
-        pattern = ''
-
-        pattern = '/' '**/*.mrb'
-        
         if self.isNiiGzFormat: 
             pattern = '/' '**/*.nii.gz'
+            inputFilename = "ct_calibrated.nii.gz" if self.useCalibratedCT else "ct.nii.gz"
         else:
             pattern = '/' '**/*.mrb'
+            inputFilename = "ct_seg.mrb"
 
-              
-        filesToProcess = 0
-        for filepath in glob.iglob(self.batchProcessingInputDir + pattern, recursive=True):
+        # find all cases in a single pass over the input folder
+        filepaths = []
+        for filepath in sorted(glob.iglob(self.batchProcessingInputDir + pattern, recursive=True)):
             pathhead, pathtail = os.path.split(filepath)
-            if (pathtail.lower() == "ct_seg.mrb" and not self.isNiiGzFormat) or (pathtail.lower() == "ct.nii.gz" and self.isNiiGzFormat):
+            if pathtail.lower() == inputFilename:
                 # input data must be in subdirectories of self.batchProcessingInputDir
                 if pathhead == self.batchProcessingInputDir:
                     self.showCriticalError("Unsupported data structure: Data files in input folder detected, they must be placed in subfolders.")
@@ -850,26 +936,60 @@ class LungCTAnalyzerWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
                 parentDir = os.path.dirname(pathhead)
                 if parentDir != self.batchProcessingInputDir:
                     self.showCriticalError("Unsupported data structure: There seem to be input data in sub-subfolders of the input folder. Only one subfolder dimension is allowed.")
-                filesToProcess += 1
+                filepaths.append(filepath)
                 if self.batchProcessingTestMode: 
                   print("Input file '" + filepath + "' detected ...")
           
-        if filesToProcess == 0: 
+        if len(filepaths) == 0: 
             self.showCriticalError("No files to process. Each input file must be placed in a separate subdirectory of the input folder.")
 
+        if self.batchProcessingTestMode and len(filepaths) < 3:
+            self.showCriticalError("Not enough input files for test mode (3 needed) during recursive reading below input directory path.")
+
+        # Skip cases that are already processed with the same input files and parameters
+        # (or continue an interrupted run), unless input files are only loaded for inspection.
+        from LungCTAnalyzerLib import BatchManifest
+        manifest = BatchManifest.BatchManifest(self.batchProcessingOutputDir)
+        batchParameters = self.getBatchParameters()
+        parametersHash = BatchManifest.parametersHash(batchParameters)
+        if not self.scanInput:
+            casesFound = len(filepaths)
+            filepaths = [filepath for filepath in filepaths if manifest.needsProcessing(filepath, parametersHash)]
+            if casesFound > len(filepaths):
+                logging.info(f"Skipping {casesFound - len(filepaths)} cases that are already processed.")
+            if len(filepaths) == 0:
+                slicer.util.messageBox(f"All {casesFound} cases are already processed with the current settings.")
+                return
+        if self.batchProcessingTestMode:
+            filepaths = filepaths[:3]
+        filesToProcess = len(filepaths)
+
         minutesRequired = (filesToProcess * 180) / 60
           
         if not self.batchProcessingTestMode and not slicer.util.confirmYesNoDisplay("If each analysis takes about 3 minutes, batch segmentation of " + str(filesToProcess) + " input files will last around " + str(minutesRequired) + "  minutes. Are you sure you want to continue?"):
             logging.info('Batch processing cancelled by user.')
             return
 
-        if self.batchProcessingTestMode and filesToProcess < 3:
-            self.showCriticalError("Not enough input files for test mode (3 needed) during recursive reading below input directory path.")
-
         startWatchTime = time.time()
         
+        if self.batchProcessingWorkers > 1 and not self.scanInput:
+            self.runParallelBatchProcessing(filepaths, manifest, batchParameters)
+            stopWatchTime = time.time()
+            if self.batchProcessingIsCancelled: 
+                print('Batch processing cancelled after {0:.2f} seconds'.format(stopWatchTime-startWatchTime))
+                self.showStatusMessage("Batch processing cancelled.")
+            else: 
+                print('Batch processing completed in {0:.2f} seconds'.format(stopWatchTime-startWatchTime))
+                self.showStatusMessage("Batch processing done.")
+            return
+
         self.batchProcessing = True
+        # cached results have no output segments, so the cache is only used if only results are written
+        self.logic.outputSegmentsRequired = not self.csvOnly
         counter = 0
+        # progress of the analysis of a case is only logged, the status bar shows the batch progress
+        from LungCTAnalyzerLib import ProgressReporter
+        self.logic.progressReporter = ProgressReporter.ProgressReporter()
         
         if self.scanInput:
             _doanalyze = False
@@ -878,129 +998,126 @@ class LungCTAnalyzerWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
             _doanalyze = True
             _dowrite = True
         
+        # Input files of the next case are staged (copied and decompressed to a local folder) while the
+        # current case is analyzed. NIFTI outputs are snapshots of the output arrays that are written in
+        # the background, scenes are written to a local folder and moved to the output folder in the background.
+        # The writer queue is bounded, so a slow output folder throttles the loop.
+        import tempfile
+        from LungCTAnalyzerLib import BatchIO
+        stagingRootDir = tempfile.mkdtemp(prefix="LungCTAnalyzerBatch", dir=slicer.app.temporaryPath)
+        # Only the input nodes are read from .mrb input if the input scene is not saved with the results,
+        # otherwise the complete scene is loaded (and saved in ct_seg_analyzed.mrb)
+        inputNodesOnly = not self.isNiiGzFormat and not self.scanInput and (self.csvOnly or self.minimalOutput)
+        prefetcher = BatchIO.CasePrefetcher(filepaths, stagingRootDir + "/input",
+            mrbNodes=self.logic.getBatchCaseInputNodes(self.useCalibratedCT) if inputNodesOnly else None)
+        writer = BatchIO.BackgroundWriter(maxPendingTasks=64, maxPendingBytes=self.logic.outputWriterMaxPendingMB * 1024 * 1024)
+        from LungCTAnalyzerLib import ResultsSink
+        resultsSink = ResultsSink.ResultsSink(self.batchProcessingOutputDir)
+        resultsDatabase = None
+        if _dowrite and self.writeResultsDatabase:
+            from LungCTAnalyzerLib import ResultsDatabase
+            resultsDatabase = ResultsDatabase.ResultsDatabase(self.batchProcessingOutputDir + "/" + ResultsDatabase.databaseFilename)
+
+        def flushCaseResults(filepaths):
+            # Runs in the writer thread after the output files of the cases: results of cases whose outputs
+            # could not be written are dropped, a case is marked done only if its outputs and results are written,
+            # a failed case stays unfinished in the manifest and is processed again by the next run.
+            for filepath in filepaths:
+                if filepath in writer.failedGroups:
+                    resultsSink.discardRows(filepath)
+            resultsSink.flush()
+            for filepath in filepaths:
+                if filepath not in writer.failedGroups:
+                    manifest.setCaseFinished(filepath)
+
+        unflushedCases = []
+        failedCases = []
         durationProcess = 0
-        if self.batchProcessingTestMode:
-            filesToProcess = 3
-        for filepath in glob.iglob(self.batchProcessingInputDir + pattern, recursive=True):
-            pathhead, pathtail = os.path.split(filepath)
-
-            filename = pathtail.lower()
-            _doread = False
-            if filename == "ct_seg.mrb" and not self.isNiiGzFormat: 
-                _doread = True
-            if filename == "ct.nii.gz" and self.isNiiGzFormat and not self.useCalibratedCT: 
-                _doread = True
-            if filename == "ct_calibrated.nii.gz" and self.isNiiGzFormat and self.useCalibratedCT: 
-                _doread = True
-            if pathhead != self.batchProcessingInputDir: 
-                _doread = True
-            if _doread:
+        try:
+            for filepath, stagedFilepath, stagingDir, stagingError in prefetcher:
+                pathhead, pathtail = os.path.split(filepath)
                 startProcessWatchTime = time.time()
                 counter += 1
-                slicer.mrmlScene.Clear(0)
-                if not self.isNiiGzFormat: 
-                    # input is not NRRD format 
-                    slicer.util.loadScene(filepath)
-                    if self.useCalibratedCT: 
-                        firstVolumeNode = slicer.util.getFirstNodeByClassByName("vtkMRMLScalarVolumeNode","CT_calibrated")
-                        # to prevent crash TODO find out why
-                        ctVolumeNode = slicer.util.getFirstNodeByClassByName("vtkMRMLScalarVolumeNode","CT")
-                        if ctVolumeNode: 
-                            slicer.mrmlScene.RemoveNode(ctVolumeNode)
-                    else: 
-                        firstVolumeNode = slicer.util.getFirstNodeByClassByName("vtkMRMLScalarVolumeNode","CT")
-                    if firstVolumeNode:
-                        self.logic.inputVolume = firstVolumeNode
-                    else: 
-                        raise ValueError("No input volume.")
-                    if not self.logic.inputSegmentation:
-                        segNode = slicer.util.getFirstNodeByClassByName("vtkMRMLSegmentationNode", "Lung segmentation")
-                        if segNode:
-                            self.logic.inputSegmentation = segNode
-                else:                
-                    # input is NIFTI format 
-                    # Get color node with random colors
-                    randomColorsNode = slicer.mrmlScene.GetNodeByID('vtkMRMLColorTableNodeRandom')
-                    rgba = [0, 0, 0, 0]
-
-                    self.inputVolume = slicer.util.loadVolume(filepath)
-                    self.logic.inputSegmentation = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLSegmentationNode', 'Lung segmentation')
-                    pattern = '/' '**/*.nii.gz'
-                    print(self.batchProcessingInputDir)
-                    # inpathtail is the first level source folder 
-                    inpathhead, inpathtail = os.path.split(pathhead)
-                    for filepath2 in glob.iglob(self.batchProcessingInputDir + '/' + inpathtail + '/lung_segmentations/' +  pattern, recursive=True):
-                        pathhead2, pathtail2 = os.path.split(filepath2)
-                        print(f"Importing {filepath2}")
-                        underscore_str = pathtail2.replace(".nii.gz","")
-                        segmentName = underscore_str.replace("_" , " ")
+                caseNumber = manifest.caseNumber(filepath)
+                if _dowrite:
+                    manifest.setCaseStarted(filepath, parametersHash)
+                try:
+                    if stagingError:
+                        raise stagingError
+                    slicer.mrmlScene.Clear(0)
+                    self.logic.loadBatchCase(stagedFilepath, self.isNiiGzFormat, self.useCalibratedCT)
+                    BatchIO.removeStagingDir(stagingDir)
+
+                    print("Analyzing '" + filepath + "' ...", end='\r')
+                    if _doanalyze: 
+                        self.onApplyButton()
+
+                    if _dowrite: 
+                        outpathhead, outpathtail = os.path.split(pathhead)
+
+                        targetdir = self.batchProcessingOutputDir + "/" + outpathtail + "/"
+                        if not os.path.exists(targetdir):
+                            os.makedirs(targetdir)
                         
-                        labelmapVolumeNode = slicer.util.loadLabelVolume(filepath2, {"name": segmentName})
-                        segmentId = self.logic.inputSegmentation.GetSegmentation().AddEmptySegment(segmentName, segmentName)
-                        updatedSegmentIds = vtk.vtkStringArray()
-                        updatedSegmentIds.InsertNextValue(segmentId)
-                        slicer.modules.segmentations.logic().ImportLabelmapToSegmentationNode(labelmapVolumeNode, self.logic.inputSegmentation, updatedSegmentIds)
-                        slicer.mrmlScene.RemoveNode(labelmapVolumeNode)
-                        segmentation = self.logic.inputSegmentation.GetSegmentation()
-                        self.logic.rightLungMaskSegmentID = segmentation.GetSegmentIdBySegmentName("right lung")
-                        self.logic.leftLungMaskSegmentID = segmentation.GetSegmentIdBySegmentName("left lung")
-
-
-                print("Analyzing '" + filepath + "' ...", end='\r')
-                if _doanalyze: 
-                    self.onApplyButton()
-
-                if _dowrite: 
-                    outpathhead, outpathtail = os.path.split(pathhead)
-
-                    targetdir = self.batchProcessingOutputDir + "/" + outpathtail + "/"
-                    if not os.path.exists(targetdir):
-                        os.makedirs(targetdir)
-                        
-                    self.logic.saveExtendedDataToFile(self.batchProcessingOutputDir + "/results.csv", filepath, counter, outpathtail)
-                    self.logic.saveExtendedRegionDataToFile(self.batchProcessingOutputDir + "/regionResults.csv", filepath, counter, outpathtail)
-                    self.logic.saveExtendedLobeDataToFile(self.batchProcessingOutputDir + "/lobeResults.csv", filepath, counter, outpathtail)
-
-                    if not self.csvOnly:
-                      if self.isNiiGzFormat:
-                          # write NIFTI format 
-                          self.showStatusMessage("Writing NIFTI output files for input " + str(counter) +  "/" + str(filesToProcess) + " to '" + targetdir + "' ...")
-                          for volumeNode in slicer.util.getNodesByClass("vtkMRMLScalarVolumeNode"):
-                            volumeNode.AddDefaultStorageNode()
-                            slicer.util.saveNode(volumeNode, targetdir + volumeNode.GetName().lower().replace(" ", "_") + ".nii.gz")
-                          numberOfSegments = self.logic.outputSegmentation.GetSegmentation().GetNumberOfSegments()
-                          for i in range(numberOfSegments):
-                              segment = self.logic.outputSegmentation.GetSegmentation().GetNthSegment(i)
-                              labelmapVolumeNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLLabelMapVolumeNode")
-                              segID = self.logic.outputSegmentation.GetSegmentation().GetSegmentIdBySegment(segment)
-                              strArr = [str(segID)]                      
-                              slicer.modules.segmentations.logic().ExportSegmentsToLabelmapNode (self.logic.outputSegmentation, strArr, labelmapVolumeNode, self.logic.inputVolume)
-                              labelmapVolumeNode.AddDefaultStorageNode()
-                              if not os.path.exists(targetdir + "lung_analysis_segmentations/"):
-                                  os.makedirs(targetdir + "lung_analysis_segmentations/")
-                              slicer.util.saveNode(labelmapVolumeNode, targetdir + "lung_analysis_segmentations/" + segment.GetName().lower().replace(" ", "_") + ".seg.nii.gz")
-                              slicer.mrmlScene.RemoveNode(labelmapVolumeNode)  
-                      else:
-                          # write default format 
-                          sceneSaveFilename = targetdir + "ct_seg_analyzed.mrb"
-                          self.showStatusMessage("Writing mrb output file for input " + str(counter) +  "/" + str(filesToProcess) + " (last process: {0:.2f} s ".format(durationProcess) + " processing and write time) to '" + sceneSaveFilename + "' ...")
-                          if slicer.util.saveScene(sceneSaveFilename):
-                              logging.info("Scene saved to: {0}".format(sceneSaveFilename))
-                          else:
-                              logging.error("Scene saving failed") 
+                        # rows of an earlier (changed or interrupted) run of this case are replaced when flushed
+                        self.logic.addBatchCaseResults(resultsSink, filepath, caseNumber, outpathtail, resultsDatabase, batchParameters,
+                            self.timingColumns)
+                        if _doanalyze:
+                            self.logic.saveStageTimings(targetdir + "timings.json", filepath=filepath)
+
+                        if not self.csvOnly:
+                            self.showStatusMessage("Writing output files for input " + str(counter) +  "/" + str(filesToProcess) + " (last process: {0:.2f} s ".format(durationProcess) + " processing and write time) to '" + targetdir + "' ...")
+                            if self.isNiiGzFormat:
+                                for function, args, sizeBytes in self.logic.getNiftiOutputWriteTasks(targetdir,
+                                    self.multiLabelOutput, self.segmentFilesOutput, self.outputCompression, self.minimalOutput):
+                                    writer.submit(function, *args, sizeBytes=sizeBytes, group=filepath)
+                            else:
+                                stagingOutputDir = f"{stagingRootDir}/output{counter}/"
+                                self.logic.saveBatchCaseOutputs(stagingOutputDir, False, compression=self.outputCompression,
+                                    minimalOutput=self.minimalOutput)
+                                writer.submit(BatchIO.moveTree, stagingOutputDir, targetdir, group=filepath)
+                        unflushedCases.append(filepath)
+                        if len(unflushedCases) >= self.logic.resultsFlushIntervalCases:
+                            writer.submit(flushCaseResults, unflushedCases)
+                            unflushedCases = []
+                except Exception as e:
+                    # a failed case does not stop the batch, it stays failed in the manifest and is processed again by the next run
+                    import traceback
+                    traceback.print_exc()
+                    logging.error(f"Batch processing of '{filepath}' failed: {e}")
+                    failedCases.append(filepath)
+                    BatchIO.removeStagingDir(stagingDir)
+                    if _dowrite:
+                        resultsSink.discardRows(filepath)
+                        manifest.setCaseFinished(filepath, False, str(e))
     
                 stopProcessWatchTime = time.time()
                 durationProcess = stopProcessWatchTime - startProcessWatchTime
 
                 # let slicer process events and update its display
                 slicer.app.processEvents()
-                time.sleep(3)
           
-            if self.batchProcessingIsCancelled: 
-                break
-            if self.batchProcessingTestMode and counter > 2:
-                break
-        self.batchProcessing = False             
+                if self.batchProcessingIsCancelled: 
+                    break
+        finally:
+            self.batchProcessing = False
+            self.logic.progressReporter = None
+            self.logic.outputSegmentsRequired = False
+            prefetcher.close()
+            self.showStatusMessage("Waiting for output files to be written ...")
+            try:
+                if unflushedCases:
+                    writer.submit(flushCaseResults, unflushedCases)
+                writer.close()
+            finally:
+                BatchIO.removeStagingDir(stagingRootDir)
+                if resultsDatabase:
+                    resultsDatabase.close()
+                if writer.failedGroups:
+                    logging.error(f"Writing the outputs of {len(writer.failedGroups)} cases failed, they are processed again by the next run: "
+                        + ", ".join(writer.failedGroups.keys()))
+        if _dowrite:
+            self.exportBatchResults()
         stopWatchTime = time.time()
         if self.batchProcessingIsCancelled: 
             print('Batch processing cancelled after {0:.2f} seconds'.format(stopWatchTime-startWatchTime))
@@ -1008,6 +1125,114 @@ class LungCTAnalyzerWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         else: 
             print('Batch processing completed in {0:.2f} seconds'.format(stopWatchTime-startWatchTime))
             self.showStatusMessage("Batch processing done.")
+        if failedCases:
+            slicer.util.errorDisplay(f"Batch processing failed for {len(failedCases)} cases, they are processed again by the next run. See the log for details.")
+
+    def exportBatchResults(self):
+        """
+        Export the batch CSV files to a columnar format for fast loading in cohort statistics.
+        """
+        from LungCTAnalyzerLib import ResultsSink
+        for csvFilename in ["results.csv", "regionResults.csv", "lobeResults.csv"]:
+            filename = self.batchProcessingOutputDir + "/" + csvFilename
+            if os.path.isfile(filename):
+                logging.info(f"Results exported to '{ResultsSink.exportColumnar(filename)}'.")
+
+    def getBatchParameters(self):
+        """
+        Get thresholds and options used for batch processing.
+        Batch cases use the same thresholds and options as an analysis started with the Apply button.
+        """
+        from LungCTAnalyzerLib import BatchWorker
+        self.setThresholdsFromGUI()
+        self.logic.lobeAnalysis = self.lobeAnalysis
+        self.logic.areaAnalysis = self.areaAnalysis
+        options = {}
+        for optionName in BatchWorker.batchOptionNames:
+            options[optionName] = getattr(self.logic, optionName)
+        return {
+            "thresholds": self.logic.thresholds,
+            "options": options,
+            "isNiiGzFormat": self.isNiiGzFormat,
+            "useCalibratedCT": self.useCalibratedCT,
+            "csvOnly": self.csvOnly,
+            "multiLabelOutput": self.multiLabelOutput,
+            "segmentFilesOutput": self.segmentFilesOutput,
+            "outputCompression": self.outputCompression,
+            "minimalOutput": self.minimalOutput,
+            }
+
+    def runParallelBatchProcessing(self, filepaths, manifest, batchParameters):
+        """
+        Analyze the batch cases in headless Slicer worker processes (see LungCTAnalyzerLib/BatchWorker.py).
+        The GUI process only distributes the work, shows the progress and updates the manifest,
+        workers write their results to the CSV files directly.
+        """
+        import json
+        import shutil
+        from LungCTAnalyzerLib import BatchManifest, BatchWorker
+
+        jobDir = self.batchProcessingOutputDir + "/.batchjob"
+        if os.path.exists(jobDir):
+            shutil.rmtree(jobDir)
+        os.makedirs(jobDir + "/claims")
+        os.makedirs(jobDir + "/status")
+        parametersHash = BatchManifest.parametersHash(batchParameters)
+        for filepath in filepaths:
+            manifest.setCaseStarted(filepath, parametersHash)
+        job = dict(batchParameters)
+        job["outputDir"] = self.batchProcessingOutputDir
+        job["writeResultsDatabase"] = self.writeResultsDatabase
+        job["timingColumns"] = self.timingColumns
+        job["cases"] = [[manifest.caseNumber(filepath), filepath] for filepath in filepaths]
+        jobFilename = jobDir + "/job.json"
+        with open(jobFilename, "w") as f:
+            json.dump(job, f, indent=2)
+
+        numberOfWorkers = min(self.batchProcessingWorkers, len(filepaths))
+        logging.info(f"Starting {numberOfWorkers} batch processing workers for {len(filepaths)} cases ...")
+        workerProcesses = []
+        workerLogFiles = []
+        for workerIndex in range(numberOfWorkers):
+            logFile = open(f"{jobDir}/worker{workerIndex}.log", "w")
+            workerLogFiles.append(logFile)
+            workerProcesses.append(subprocess.Popen([slicer.app.launcherExecutableFilePath,
+                "--no-splash", "--no-main-window", "--python-script", BatchWorker.__file__, jobFilename, str(workerIndex)],
+                stdout=logFile, stderr=subprocess.STDOUT))
+
+        self.batchProcessing = True
+        cancelRequested = False
+        caseStatus = {}
+        while True:
+            workersRunning = any(workerProcess.poll() is None for workerProcess in workerProcesses)
+            if self.batchProcessingIsCancelled and not cancelRequested:
+                # workers stop after their current case
+                open(jobDir + "/cancel", "w").close()
+                cancelRequested = True
+            for statusFilename in glob.glob(jobDir + "/status/*.json"):
+                if statusFilename in caseStatus:
+                    continue
+                with open(statusFilename) as f:
+                    status = json.load(f)
+                caseStatus[statusFilename] = status
+                manifest.setCaseFinished(status["filepath"], status["status"] == "done", status.get("error"))
+            if not workersRunning:
+                break
+            self.showStatusMessage(f"Batch processing with {numberOfWorkers} workers: {len(caseStatus)}/{len(filepaths)} cases done ...", 2000)
+            time.sleep(0.2)
+        self.batchProcessing = False
+        for logFile in workerLogFiles:
+            logFile.close()
+
+        self.exportBatchResults()
+
+        failedCases = [status for status in caseStatus.values() if status["status"] != "done"]
+        for status in failedCases:
+            logging.error(f"Batch processing of '{status['filepath']}' failed: {status['error']}")
+        if failedCases:
+            slicer.util.errorDisplay(f"Batch processing failed for {len(failedCases)} cases. See worker logs in '{jobDir}' for details.")
+        else:
+            shutil.rmtree(jobDir)
 
 
     def onInputSegmentationSelected(self, segmentationNode):
@@ -1035,6 +1260,31 @@ class LungCTAnalyzerWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         slider.blockSignals(wasBlocked)
         self.updateParameterNodeFromGUI()
         self.logic.updateMaskedVolumeColors()
+        if self.livePreview:
+            self.livePreviewUpdateTimer.start()
+
+    def onLivePreviewToggled(self, checked):
+        self.livePreview = checked
+        settings=qt.QSettings(slicer.app.launcherSettingsFilePath, qt.QSettings.IniFormat)
+        settings.setValue("LungCtAnalyzer/livePreviewCheckBoxChecked", str(self.livePreview))
+        if self.livePreview:
+            self.livePreviewUpdateTimer.start()
+
+    def updateLivePreview(self):
+        if self.applyRunning or not self.logic.inputVolume or not self.logic.inputSegmentation:
+            return
+        try:
+            self.logic.updateResultsPreview()
+        except Exception as e:
+            logging.error("Failed to update live volume preview: " + str(e))
+            return
+        # results tables that are shown are replaced by their preview
+        activeTableID = slicer.app.applicationLogic().GetSelectionNode().GetActiveTableID()
+        for resultsTable, previewTable in [(self.logic.covidResultsTable, self.logic.covidResultsPreviewTable),
+            (self.logic.emphysemaResultsTable, self.logic.emphysemaResultsPreviewTable)]:
+            if resultsTable and activeTableID == resultsTable.GetID():
+                self.logic.showTable(previewTable)
+        self.updateGUIFromParameterNode()
 
     def onBullaRangeWidgetChanged(self):
       self.adjustThresholdSliders(None, self.ui.BullaRangeWidget, self.ui.InflatedRangeWidget)
@@ -1301,12 +1551,27 @@ class LungCTAnalyzerWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
             logging.info('Apply')
             self.logic.lobeAnalysis = self.lobeAnalysis
             self.logic.areaAnalysis = self.areaAnalysis
-            self.logic.process()
+            # interactive analysis runs its numeric stages in the background and can be cancelled
+            self.logic.runInBackground = not self.batchProcessing
+            if self.logic.runInBackground:
+                # GUI events are processed during the analysis: inputs, thresholds and options must not change
+                # and the live preview must not run until it is done
+                self.applyRunning = True
+                self.livePreviewUpdateTimer.stop()
+                self.parent.enabled = False
+            try:
+                self.logic.process()
+            finally:
+                if self.applyRunning:
+                    self.parent.enabled = True
+                    self.applyRunning = False
+                self.logic.runInBackground = False
 
             self.onShowResultsTable()
 
-            # ensure user sees the new segments
-            self.logic.outputSegmentation.GetDisplayNode().Visibility2DOn()
+            # ensure user sees the new segments (not created if results were found in the result cache)
+            if self.logic.outputSegmentation:
+                self.logic.outputSegmentation.GetDisplayNode().Visibility2DOn()
 
             # hide input segments to make results better visible
             self.logic.inputSegmentation.GetDisplayNode().Visibility2DOff()
@@ -1318,8 +1583,18 @@ class LungCTAnalyzerWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
 
 
             qt.QApplication.restoreOverrideCursor()
+        except UserWarning as e:
+            # cancelled by the user
+            qt.QApplication.restoreOverrideCursor()
+            if self.batchProcessing:
+                raise
+            logging.info(str(e))
+            slicer.util.showStatusMessage("Analysis cancelled.", 3000)
         except Exception as e:
             qt.QApplication.restoreOverrideCursor()
+            if self.batchProcessing:
+                # the batch loop marks the case failed and continues with the next one
+                raise
             slicer.util.errorDisplay("Failed to compute results: "+str(e))
             import traceback
             traceback.print_exc()
@@ -1378,14 +1653,15 @@ class LungCTAnalyzerWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
             dontShowAgainSettingsKey="LungCTAnalyzer/DontShowCovidResultsWarning",
             icon=qt.QMessageBox.Warning)
 
-        self.logic.showTable(self.logic.covidResultsTable)
+        # the preview exists only if the thresholds were changed after the results were computed
+        self.logic.showTable(self.logic.covidResultsPreviewTable or self.logic.covidResultsTable)
         
     def onShowEmphysemaResultsTable(self):
         slicer.util.messageBox("Emphysema segmentations have not been clinically evaluated yet. Do not base treatment decisions on that values.",
             dontShowAgainSettingsKey="LungCTAnalyzer/DontShowCovidResultsWarning",
             icon=qt.QMessageBox.Warning)
 
-        self.logic.showTable(self.logic.emphysemaResultsTable)
+        self.logic.showTable(self.logic.emphysemaResultsPreviewTable or self.logic.emphysemaResultsTable)
 
     def toggleSegmentationVisibility2D(self, segmentationNode):
         segmentationDisplayNode = segmentationNode.GetDisplayNode()
@@ -1521,44 +1797,82 @@ class LungCTAnalyzerLogic(ScriptedLoadableModuleLogic):
         Called when the logic class is instantiated. Can be used for initializing member variables.
         """
         ScriptedLoadableModuleLogic.__init__(self)
-        self.defaultThresholds = {
-            'thresholdBullaLower': -1050.,
-            'thresholdBullaInflated': -950.,
-            'thresholdInflatedInfiltrated': -750.,
-            'thresholdInfiltratedCollapsed': -400.,
-            'thresholdCollapsedVessels': 0.,
-            'thresholdVesselsUpper': 3000.,
-            }
-
-        self.segmentProperties = [
-            {"name": "Emphysema", "color": [0.0,0.5,0.0], "thresholds": ['thresholdBullaLower', 'thresholdBullaInflated'],"removesmallislands":"no"},
-            {"name": "Inflated", "color": [0.0,0.5,1.0], "thresholds": ['thresholdBullaInflated', 'thresholdInflatedInfiltrated'],"removesmallislands":"no"},
-            {"name": "Infiltration", "color": [1.0,0.5,0.0], "thresholds": ['thresholdInflatedInfiltrated', 'thresholdInfiltratedCollapsed'],"removesmallislands":"no"},
-            {"name": "Collapsed", "color": [1.0,0.0,1.0], "thresholds": ['thresholdInfiltratedCollapsed', 'thresholdCollapsedVessels'],"removesmallislands":"no"},
-            {"name": "Vessels", "color": [1.0,0.0,0.0], "thresholds": ['thresholdCollapsedVessels', 'thresholdVesselsUpper'],"removesmallislands":"no"},
-            ]
-
-        self.subSegmentProperties = [
-            {"name": "ventral", "color": [0.0,0.0,0.0]}, 
-            {"name": "dorsal","color": [0.0,0.0,0.0]}, 
-            {"name": "upper half","color": [0.0,0.0,0.0]}, 
-            {"name": "lower half","color": [0.0,0.0,0.0]}, 
-            {"name": "upper","color": [0.0,0.0,0.0]}, 
-            {"name": "middle","color": [0.0,0.0,0.0]}, 
-            {"name": "lower","color": [0.0,0.0,0.0]}, 
-            ]
+        import copy
+        self.defaultThresholds = dict(LungCTAnalyzerLib.defaultThresholds)
+        self.segmentProperties = copy.deepcopy(LungCTAnalyzerLib.segmentProperties)
+        self.subSegmentProperties = copy.deepcopy(LungCTAnalyzerLib.subSegmentProperties)
+        self.lobeNames = list(LungCTAnalyzerLib.lobeNames)
 
         self.inputStats = None
         self.outputStats = None
-        self.segmentEditorNode = None
-        self.segmentEditorWidget = None
+        self.lobeLabelArray = None
+        # Bounding box of the lungs (tuple of slices in KJI order), all array processing is restricted to it
+        self.lungExtent = (slice(None), slice(None), slice(None))
+        self.lungExtentMargin = 5
+        # Islands smaller than this are removed from segments that have "removesmallislands" enabled
+        self.minimumIslandSizeMm3 = 1000.
+        # Lung mask labels in the lung extent and the state of the inputs they were computed from
+        self.lungMaskArray = None
+        self.maskedVolumeCacheKey = None
+        # HU histograms of the lung voxels for the live threshold preview
+        self.lungHistograms = None
+        self.lungHistogramsCacheKey = None
+        # Whole lung results of the live threshold preview, kept apart from the results of process()
+        self.previewResults = {}
+        # Emphysema cluster analysis results, computed if countBullae is enabled
+        self.emphysemaClusters = None
+        # Cached results have no output segments: segmentLabelArray and outputSegmentation are only valid
+        # if outputSegmentsValid is set. If outputSegmentsRequired is set, the result cache is not used.
+        self.outputSegmentsValid = False
+        self.outputSegmentsRequired = False
+        # Size limit of the on-disk result cache (used if useResultCache is enabled)
+        self.resultCacheMaxSizeMB = 200
+        # Size limit of the output array snapshots waiting to be written in batch processing
+        self.outputWriterMaxPendingMB = 1024
+        # Batch result files are rewritten when flushed, so results are flushed every few cases
+        self.resultsFlushIntervalCases = 10
         # make progress bar optional for batch operations where not needed
         self.showProgressBar = True
+        self.progressbar = None
+        # LungCTAnalyzerLib.ProgressReporter.ProgressReporter, created by getProgressReporter() if not set
+        self.progressReporter = None
+        # run the numeric stages of process() on a worker thread while the GUI keeps running (see runNumericStage)
+        self.runInBackground = False
+        # set by requestCancel(), process() stops at the next stage boundary
+        self.cancelRequested = False
+        # Timings of the stages of the last process() run (see LungCTAnalyzerLib.StageTimer), by stage name
+        self.stageTimer = None
+        self.stageTimings = {}
+        self.timingStageNames = ["masked volume", "result cache", "input stats", "thresholding", "islands",
+            "segment import", "emphysema clusters", "region split", "lobe analysis", "stats", "tables"]
+        # trace Python memory allocations in the stages of process() (slows down processing)
+        self.traceAllocations = False
         
     def showStatusMessage(self, msg, timeoutMsec=500):
-        slicer.util.showStatusMessage(msg, timeoutMsec)
+        self.getProgressReporter().report(msg)
+
+    def getProgressReporter(self):
+        """
+        Progress is shown in the status bar and the progress dialog of process() (at most every 100 ms),
+        or only logged if there is no main window.
+        """
+        if not self.progressReporter:
+            from LungCTAnalyzerLib import ProgressReporter
+            self.progressReporter = ProgressReporter.ProgressReporter(self.updateProgress if slicer.util.mainWindow() else None)
+        return self.progressReporter
+
+    def updateProgress(self, message, fraction):
+        if self.progressbar:
+            self.progressbar.setValue(int(round(fraction * 100)))
+            self.progressbar.labelText = message
+        slicer.util.showStatusMessage(message, 500)
         slicer.app.processEvents()
 
+    def closeProgressBar(self):
+        if self.progressbar:
+            self.progressbar.close()
+            self.progressbar = None
+
     def setThresholds(self, parameterNode, thresholds, overwrite=True):
         wasModified = parameterNode.StartModify()
         for parameterName in thresholds:
@@ -1622,6 +1936,8 @@ class LungCTAnalyzerLogic(ScriptedLoadableModuleLogic):
         self.setThresholds(parameterNode, self.defaultThresholds, overwrite=False)
         if not parameterNode.GetParameter("ComputeImageIntensityStatistics"):
             parameterNode.SetParameter("ComputeImageIntensityStatistics", "true")
+        if not parameterNode.GetParameter("CropToLung"):
+            parameterNode.SetParameter("CropToLung", "true")
             
     def setDefaultThresholds(self, bullaLower,bullaInflated,inflatedInfiltrated,infiltratedCollapsed,collapsedVessels,vesselsUpper):
         """
@@ -1686,6 +2002,56 @@ class LungCTAnalyzerLogic(ScriptedLoadableModuleLogic):
         colorTransferFunction.AddRGBPoint(255, 0.0, 0.0, 0.0)
         colorNode.SetAndObserveColorTransferFunction(colorTransferFunction)
 
+    def computeOutputStatistics(self):
+        """
+        Compute voxel count, volume, HU sum, sum of squares, minimum and maximum of every output segment
+        in a single pass over the lung voxels (see LungCTAnalyzerLib.computeSegmentStatistics).
+        Returns a dictionary with the same keys as SegmentStatistics results.
+        """
+        return self.runNumericStage(LungCTAnalyzerLib.computeSegmentStatistics,
+            self.segmentLabelArray,
+            slicer.util.arrayFromVolume(self.inputVolume)[self.lungExtent],
+            self.getIJKToRASArray(),
+            self.getLungGeometry() if self.areaAnalysis else None,
+            self.lobeLabelArray if self.lobeAnalysis else None,
+            self.segmentProperties, self.subSegmentProperties, self.lobeNames)
+
+    def getIJKToRASArray(self):
+        """
+        Get the IJK to RAS matrix of the lung extent of the input volume as numpy array.
+        """
+        ijkToRas = vtk.vtkMatrix4x4()
+        self.inputVolume.GetIJKToRASMatrix(ijkToRas)
+        return LungCTAnalyzerLib.cropIJKToRAS(slicer.util.arrayFromVTKMatrix(ijkToRas), self.lungExtent)
+
+    def getVoxelVolumeMm3(self):
+        import numpy as np
+        return abs(np.linalg.det(self.getIJKToRASArray()[:3, :3]))
+
+    def computeLungExtent(self, maskVolumeArray):
+        """
+        Get the bounding box of the lung masks extended by a safety margin, or the full volume if cropping is disabled.
+        """
+        fullExtent = (slice(None), slice(None), slice(None))
+        if not self.cropToLung:
+            return fullExtent
+        extent = LungCTAnalyzerLib.computeBoundingBox(maskVolumeArray, self.lungExtentMargin)
+        if extent is None:
+            return fullExtent
+        logging.info(f"Lung extent: {[(s.start, s.stop) for s in extent]} of volume size {maskVolumeArray.shape}")
+        return extent
+
+    def getLungGeometry(self):
+        """
+        Get centroid and cranio-caudal diameter of each lung from the input segment statistics.
+        """
+        lungGeometry = {}
+        for side, segmentId in [("right", self.rightLungMaskSegmentID), ("left", self.leftLungMaskSegmentID)]:
+            centroid_ras = self.inputStats[segmentId,"LabelmapSegmentStatisticsPlugin.centroid_ras"]
+            obb_diameter_mm = self.inputStats[segmentId,"LabelmapSegmentStatisticsPlugin.obb_diameter_mm"]
+            lungGeometry[side] = (centroid_ras, obb_diameter_mm[2])
+        return lungGeometry
+
     def createResultsTable(self):
         logging.info('Create results table')
 
@@ -1694,57 +2060,52 @@ class LungCTAnalyzerLogic(ScriptedLoadableModuleLogic):
         else:
             self.resultsTable.RemoveAllColumns()
 
-        # Compute stats
-        self.showStatusMessage('Computing output stats  ...')
-
-        import SegmentStatistics
-        
-        segStatLogic = SegmentStatistics.SegmentStatisticsLogic()
-       
-        segStatLogic.getParameterNode().SetParameter("Segmentation", self.outputSegmentation.GetID())
-        segStatLogic.getParameterNode().SetParameter("ScalarVolume", self.inputVolume.GetID())
-        segStatLogic.getParameterNode().SetParameter("LabelmapSegmentStatisticsPlugin.enabled", "True" if self.generateStatistics else "False")
-        segStatLogic.getParameterNode().SetParameter("ScalarVolumeSegmentStatisticsPlugin.voxel_count.enabled", "False")
-        segStatLogic.getParameterNode().SetParameter("ScalarVolumeSegmentStatisticsPlugin.volume_mm3.enabled", "False")
-        segStatLogic.computeStatistics()
-        segStatLogic.exportToTable(self.resultsTable)
-        self.outputStats = segStatLogic.getStatistics()
-        # print(str(self.outputStats))
-        segStatLogic.getParameterNode().SetParameter("LabelmapSegmentStatisticsPlugin.enabled", "True")
+        if self.outputStats is None:
+            self.showStatusMessage('Computing output stats  ...')
+            self.outputStats = self.computeOutputStatistics()
 
+        columns = [
+            ("Volume [cm3]", "volume_cm3"),
+            ("Minimum", "min"),
+            ("Maximum", "max"),
+            ("Mean", "mean"),
+            ("Standard deviation", "stdev"),
+            ]
+        if self.generateStatistics:
+            columns = [("Number of voxels [voxels]", "voxel_count"), ("Volume [mm3]", "volume_mm3")] + columns
+
+        table = self.resultsTable.GetTable()
+        segmentNameColumn = vtk.vtkStringArray()
+        segmentNameColumn.SetName("Segment")
+        table.AddColumn(segmentNameColumn)
+        valueColumns = []
+        for columnName, measurement in columns:
+            valueColumn = vtk.vtkDoubleArray()
+            valueColumn.SetName(columnName)
+            table.AddColumn(valueColumn)
+            valueColumns.append((valueColumn, measurement))
         minThrCol = vtk.vtkFloatArray()
         minThrCol.SetName("MinThr")
-        self.resultsTable.AddColumn(minThrCol)
+        table.AddColumn(minThrCol)
         maxThrCol = vtk.vtkFloatArray()
         maxThrCol.SetName("MaxThr")
-        self.resultsTable.AddColumn(maxThrCol)
+        table.AddColumn(maxThrCol)
 
         parameterNode = self.getParameterNode()
-
-        segmentNameColumn = self.resultsTable.GetTable().GetColumnByName("Segment")
-        for side in ['left', 'right']:
-            for segmentProperty in self.segmentProperties:
-                segmentName = f"{segmentProperty['name']} {side}"
-                rowIndex = segmentNameColumn.LookupValue(segmentName)
-                lowerThresholdName, upperThresholdName = segmentProperty["thresholds"]
-                if rowIndex >=0:
-                    minThrCol.SetValue(rowIndex, float(parameterNode.GetParameter(lowerThresholdName)))
-                    maxThrCol.SetValue(rowIndex, float(parameterNode.GetParameter(upperThresholdName)))
-        self.resultsTable.GetTable().Modified()
-
-
-        if self.areaAnalysis == True: 
-            segmentNameColumn = self.resultsTable.GetTable().GetColumnByName("Segment")
-            for side in ['left', 'right']:
-                for subSegmentProperty in self.subSegmentProperties:
-                    for segmentProperty in self.segmentProperties:
-                        segmentName = f"{segmentProperty['name']} {side} {subSegmentProperty['name']}"
-                        rowIndex = segmentNameColumn.LookupValue(segmentName)
-                        lowerThresholdName, upperThresholdName = segmentProperty["thresholds"]
-                        if rowIndex >=0:
-                            minThrCol.SetValue(rowIndex, float(parameterNode.GetParameter(lowerThresholdName)))
-                            maxThrCol.SetValue(rowIndex, float(parameterNode.GetParameter(upperThresholdName)))
-            self.resultsTable.GetTable().Modified()
+        thresholdsByClass = {}
+        for segmentProperty in self.segmentProperties:
+            lowerThresholdName, upperThresholdName = segmentProperty["thresholds"]
+            thresholdsByClass[segmentProperty['name']] = (
+                float(parameterNode.GetParameter(lowerThresholdName)), float(parameterNode.GetParameter(upperThresholdName)))
+
+        for segmentName in self.outputStats["SegmentIDs"]:
+            segmentNameColumn.InsertNextValue(segmentName)
+            for valueColumn, measurement in valueColumns:
+                valueColumn.InsertNextValue(self.outputStats[segmentName, "ScalarVolumeSegmentStatisticsPlugin." + measurement])
+            minThr, maxThr = thresholdsByClass[segmentName.split(" ")[0]]
+            minThrCol.InsertNextValue(minThr)
+            maxThrCol.InsertNextValue(maxThr)
+        table.Modified()
 
         # Add patient information as node metadata (available if volume is loaded from DICOM)
         self.resultsTable.SetAttribute("LungCTAnalyzer.patientFamilyName", "")
@@ -1774,177 +2135,66 @@ class LungCTAnalyzerLogic(ScriptedLoadableModuleLogic):
             result = 0.
         return result
 
-    def getResultsFor(self, area, explicit = False):
-
-        self.rightResultLungVolume = self.getVol("Emphysema right " + area) + self.getVol("Inflated right " + area) + self.getVol("Infiltration right " + area) + self.getVol("Collapsed right " + area) 
-        self.leftResultLungVolume = self.getVol("Emphysema left " + area) + self.getVol("Inflated left " + area) + self.getVol("Infiltration left " + area) + self.getVol("Collapsed left " + area) 
-        self.totalResultLungVolume = self.rightResultLungVolume + self.leftResultLungVolume
-        if self.totalResultLungVolume > 0.:
-            self.rightResultLungVolumePerc = round(self.rightResultLungVolume * 100. / self.totalResultLungVolume)
-            self.leftResultLungVolumePerc = round(self.leftResultLungVolume * 100. / self.totalResultLungVolume)
-        else:
-            self.rightResultLungVolumePerc = -1
-            self.leftResultLungVolumePerc = -1
-        self.totalResultLungVolumePerc = 100.
-        if self.countBullae: 
-            self.affectedResultRightVolume = self.getVol("Infiltration right " + area) + self.getVol("Collapsed right " + area) + self.getVol("Emphysema right " + area)
-            self.affectedResultLeftVolume = self.getVol("Infiltration left " + area) + self.getVol("Collapsed left " + area) + self.getVol("Emphysema left " + area)
-            self.affectedResultTotalVolume = self.affectedResultRightVolume + self.affectedResultLeftVolume
-            self.functionalResultRightVolume = self.getVol("Inflated right " + area)
-            self.functionalResultLeftVolume = self.getVol("Inflated left " + area)
-            self.functionalResultTotalVolume = self.functionalResultRightVolume + self.functionalResultLeftVolume
-        else: 
-            self.affectedResultRightVolume = self.getVol("Infiltration right " + area) + self.getVol("Collapsed right " + area) 
-            self.affectedResultLeftVolume = self.getVol("Infiltration left " + area) + self.getVol("Collapsed left " + area) 
-            self.affectedResultTotalVolume = self.affectedResultRightVolume + self.affectedResultLeftVolume
-            self.functionalResultRightVolume = self.getVol("Inflated right " + area) + self.getVol("Emphysema right " + area)
-            self.functionalResultLeftVolume = self.getVol("Inflated left " + area) + self.getVol("Emphysema right " + area)
-            self.functionalResultTotalVolume = self.functionalResultRightVolume + self.functionalResultLeftVolume
-        
-        self.emphysemaResultRightVolume = self.getVol("Emphysema right " + area)
-        self.emphysemaResultLeftVolume = self.getVol("Emphysema left " + area)
-        self.emphysemaResultTotalVolume = self.emphysemaResultRightVolume + self.emphysemaResultLeftVolume
-        self.infiltratedResultRightVolume = self.getVol("Infiltration right " + area)
-        self.infiltratedResultLeftVolume = self.getVol("Infiltration left " + area)
-        self.infiltratedResultTotalVolume = self.infiltratedResultRightVolume + self.infiltratedResultLeftVolume
-        self.collapsedResultRightVolume = self.getVol("Collapsed right " + area)
-        self.collapsedResultLeftVolume = self.getVol("Collapsed left " + area)
-        self.collapsedResultTotalVolume = self.collapsedResultRightVolume + self.collapsedResultLeftVolume
-        
-        if self.totalResultLungVolume > 0.:
-            self.functionalResultTotalVolumePerc = round(100 * self.functionalResultTotalVolume / self.totalResultLungVolume)
-            self.affectedResultTotalVolumePerc = round(100 * self.affectedResultTotalVolume / self.totalResultLungVolume)
-            self.emphysemaResultTotalVolumePerc = round(100 * self.emphysemaResultTotalVolume / self.totalResultLungVolume,1)
-            self.infiltratedResultTotalVolumePerc = round(100 * self.infiltratedResultTotalVolume / self.totalResultLungVolume,1)
-            self.collapsedResultTotalVolumePerc = round(100 * self.collapsedResultTotalVolume / self.totalResultLungVolume,1)
-        else :
-            self.functionalResultTotalVolumePerc = -1
-            self.affectedResultTotalVolumePerc = -1
-            self.emphysemaResultTotalVolumePerc = -1
-            self.infiltratedResultTotalVolumePerc = -1
-            self.collapsedResultTotalVolumePerc = -1 
-        
-        if self.rightResultLungVolume > 0.:
-            self.functionalResultRightVolumePerc = round(100 * self.functionalResultRightVolume / self.rightResultLungVolume)
-            self.affectedResultRightVolumePerc = round(100 * self.affectedResultRightVolume / self.rightResultLungVolume)
-            self.emphysemaResultRightVolumePerc = round(100 * self.emphysemaResultRightVolume / self.rightResultLungVolume,1)
-            self.infiltratedResultRightVolumePerc = round(100 * self.infiltratedResultRightVolume / self.rightResultLungVolume,1)
-            self.collapsedResultRightVolumePerc = round(100 * self.collapsedResultRightVolume / self.rightResultLungVolume,1)
-        else :
-            self.functionalResultRightVolumePerc = -1
-            self.affectedResultRightVolumePerc = -1
-            self.emphysemaResultRightVolumePerc = -1
-            self.infiltratedResultRightVolumePerc = -1
-            self.collapsedResultRightVolumePerc = -1
-
-        if self.leftResultLungVolume > 0.:
-            self.functionalResultLeftVolumePerc = round(100 * self.functionalResultLeftVolume / self.leftResultLungVolume)
-            self.affectedResultLeftVolumePerc = round(100 * self.affectedResultLeftVolume / self.leftResultLungVolume)
-            self.emphysemaResultLeftVolumePerc = round(100 * self.emphysemaResultLeftVolume  / self.leftResultLungVolume,1)
-            self.infiltratedResultLeftVolumePerc = round(100 * self.infiltratedResultLeftVolume  / self.leftResultLungVolume,1)
-            self.collapsedResultLeftVolumePerc = round(100 * self.collapsedResultLeftVolume  / self.leftResultLungVolume,1)
-        else: 
-            self.functionalResultLeftVolumePerc = -1
-            self.affectedResultLeftVolumePerc = -1
-            self.emphysemaResultLeftVolumePerc = -1
-            self.infiltratedResultLeftVolumePerc = -1
-            self.collapsedResultLeftVolumePerc = -1
+    def computeLungHistograms(self):
+        """
+        Get the HU histograms of the right and left lung voxels. They are only recomputed if the masked volume changed.
+        """
+        self.createMaskedVolume()
+        if self.lungHistograms is None or self.lungHistogramsCacheKey != self.maskedVolumeCacheKey:
+            self.showStatusMessage('Computing lung histograms ...')
+            self.lungHistograms = LungCTAnalyzerLib.computeLungHistograms(
+                self.lungMaskArray, slicer.util.arrayFromVolume(self.inputVolume)[self.lungExtent])
+            self.lungHistogramsCacheKey = self.maskedVolumeCacheKey
+        return self.lungHistograms
+
+    def updateResultsPreview(self):
+        """
+        Update the whole lung results of the preview tables for the current thresholds.
+        Volumes are derived from the lung histograms, so no segmentation is created. Region and lobe results require process().
+        The results of the last process() (attributes and results tables) are not changed, the preview tables are
+        removed by the next process().
+        """
+        thresholds = self.thresholds
+        # same adjustment of the low emphysema threshold as in createThresholdedSegments
+        thresholds['thresholdBullaLower'] = self.inputVolume.GetImageData().GetScalarRange()[0]
+        volumes = LungCTAnalyzerLib.volumesFromHistograms(self.computeLungHistograms(), thresholds, self.getVoxelVolumeMm3(), self.segmentProperties)
+        self.previewResults = LungCTAnalyzerLib.calculateLungResults(volumes, self.countBullae)
+        self.createCovidResultsTable(preview=True)
+        self.createEmphysemaResultsTable(preview=True)
+
+    def removeResultsPreviewTables(self):
+        for tableNode in [self.covidResultsPreviewTable, self.emphysemaResultsPreviewTable]:
+            if tableNode:
+                slicer.mrmlScene.RemoveNode(tableNode)
+        self.covidResultsPreviewTable = None
+        self.emphysemaResultsPreviewTable = None
+
+    def getVolumes(self):
+        if not self.outputStats:
+            return {}
+        return LungCTAnalyzerLib.volumesFromStatistics(self.outputStats)
 
+    def getResultsFor(self, area, explicit = False):
+        for name, value in LungCTAnalyzerLib.calculateRegionResults(self.getVolumes(), area, self.countBullae).items():
+            setattr(self, name, value)
 
-    
     def calculateStatistics(self):
+        for name, value in LungCTAnalyzerLib.calculateLungResults(self.getVolumes(), self.countBullae).items():
+            setattr(self, name, value)
 
-        resultsTableNode = self.resultsTable
-
-        col = 1        
-        
-        self.bulRightLung = self.getVol("Emphysema right")
-        self.venRightLung = self.getVol("Inflated right")
-        self.infRightLung = self.getVol("Infiltration right")
-        self.colRightLung = self.getVol("Collapsed right")
-        self.vesRightLung = self.getVol("Vessels right")
-        self.bulLeftLung = self.getVol("Emphysema left")
-        self.venLeftLung = self.getVol("Inflated left")
-        self.infLeftLung = self.getVol("Infiltration left")
-        self.colLeftLung = self.getVol("Collapsed left")
-        self.vesLeftLung = self.getVol("Vessels left")
-
-        
-        self.rightLungVolume = self.getVol("Emphysema right") + self.getVol("Inflated right") + self.getVol("Infiltration right") + self.getVol("Collapsed right")
-        self.leftLungVolume = self.getVol("Emphysema left") + self.getVol("Inflated left") + self.getVol("Infiltration left") + self.getVol("Collapsed left") 
-        self.totalLungVolume = self.rightLungVolume + self.leftLungVolume
-
-        if self.countBullae: 
-            self.functionalRightVolume = self.getVol("Inflated right")
-            self.functionalLeftVolume = self.getVol("Inflated left")
-            self.functionalTotalVolume = self.venRightLung + self.venLeftLung
-
-            self.affectedRightVolume = self.getVol("Infiltration right") + self.getVol("Collapsed right") + self.getVol("Emphysema right")
-            self.affectedLeftVolume = self.getVol("Infiltration left") + self.getVol("Collapsed left") + self.getVol("Emphysema left")
-            self.affectedTotalVolume = self.affectedRightVolume + self.affectedLeftVolume
-        else: 
-            self.functionalRightVolume = self.getVol("Inflated right") + self.getVol("Emphysema right")
-            self.functionalLeftVolume = self.getVol("Inflated left") + self.getVol("Emphysema left")
-            self.functionalTotalVolume = self.venRightLung + self.venLeftLung
-
-            self.affectedRightVolume = self.getVol("Infiltration right") + self.getVol("Collapsed right") 
-            self.affectedLeftVolume = self.getVol("Infiltration left") + self.getVol("Collapsed left") 
-            self.affectedTotalVolume = self.affectedRightVolume + self.affectedLeftVolume
-        
-        self.emphysemaRightVolume = self.getVol("Emphysema right")
-        self.emphysemaLeftVolume = self.getVol("Emphysema left")
-        self.emphysemaTotalVolume = self.emphysemaRightVolume + self.emphysemaLeftVolume
-
-        self.infiltratedRightVolume = self.getVol("Infiltration right")
-        self.infiltratedLeftVolume = self.getVol("Infiltration left")
-        self.infiltratedTotalVolume = self.infiltratedRightVolume + self.infiltratedLeftVolume
-
-        self.collapsedRightVolume = self.getVol("Collapsed right")
-        self.collapsedLeftVolume = self.getVol("Collapsed left")
-        self.collapsedTotalVolume = self.collapsedRightVolume + self.collapsedLeftVolume
-
-        if self.totalLungVolume:
-            self.rightLungVolumePerc = round(self.rightLungVolume * 100. / self.totalLungVolume)
-            self.leftLungVolumePerc = round(self.leftLungVolume * 100. / self.totalLungVolume)
-        else: 
-            self.rightLungVolumePerc = self.leftLungVolumePerc = 0
-        
-        self.totalLungVolumePerc = 100.
-
-        if self.rightLungVolume:
-            self.functionalRightVolumePerc = round(100 * self.functionalRightVolume / self.rightLungVolume)
-            self.affectedRightVolumePerc = round(100 * self.affectedRightVolume / self.rightLungVolume)
-            self.emphysemaRightVolumePerc = round(100 * self.emphysemaRightVolume / self.rightLungVolume,1)
-            self.infiltratedRightVolumePerc = round(100 * self.infiltratedRightVolume / self.rightLungVolume,1)
-            self.collapsedRightVolumePerc = round(100 * self.collapsedRightVolume / self.rightLungVolume,1)
-        else:
-            self.functionalRightVolumePerc = self.affectedRightVolumePerc = self.emphysemaRightVolumePerc = self.infiltratedRightVolumePerc = self.collapsedRightVolumePerc = 0
-        
-        if self.leftLungVolume:
-            self.functionalLeftVolumePerc = round(100 * self.functionalLeftVolume / self.leftLungVolume)
-            self.affectedLeftVolumePerc = round(100 * self.affectedLeftVolume / self.leftLungVolume)
-            self.emphysemaLeftVolumePerc = round(100 * self.emphysemaLeftVolume / self.leftLungVolume,1)
-            self.infiltratedLeftVolumePerc = round(100 * self.infiltratedLeftVolume / self.leftLungVolume,1)
-            self.collapsedLeftVolumePerc = round(100 * self.collapsedLeftVolume / self.leftLungVolume,1)
-        else:
-            self.functionalLeftVolumePerc = self.affectedLeftVolumePerc = self.emphysemaLeftVolumePerc = self.infiltratedLeftVolumePerc = self.collapsedLeftVolumePerc = 0
-        
-        if self.totalLungVolume:
-            self.functionalTotalVolumePerc = round(100 * self.functionalTotalVolume / self.totalLungVolume)
-            self.affectedTotalVolumePerc = round(100 * self.affectedTotalVolume / self.totalLungVolume)
-            self.emphysemaTotalVolumePerc = round(100 * self.emphysemaTotalVolume / self.totalLungVolume,1)
-            self.infiltratedTotalVolumePerc = round(100 * self.infiltratedTotalVolume / self.totalLungVolume,1)
-            self.collapsedTotalVolumePerc = round(100 * self.collapsedTotalVolume / self.totalLungVolume,1)
-        else:
-            self.functionalTotalVolumePerc = self.affectedTotalVolumePerc = self.emphysemaTotalVolumePerc = self.infiltratedTotalVolumePerc = self.collapsedTotalVolumePerc = 0
-
-
-    def createCovidResultsTable(self):
+    def createCovidResultsTable(self, preview=False):
     
-        if not self.covidResultsTable:
-            self.covidResultsTable = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLTableNode', 'Lung CT analysis extended results')
+        if preview:
+            if not self.covidResultsPreviewTable:
+                self.covidResultsPreviewTable = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLTableNode', 'Lung CT analysis extended results (preview)')
+            tableNode = self.covidResultsPreviewTable
+            results = self.previewResults
         else:
-            self.covidResultsTable.RemoveAllColumns()
+            if not self.covidResultsTable:
+                self.covidResultsTable = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLTableNode', 'Lung CT analysis extended results')
+            tableNode = self.covidResultsTable
+            results = LungCTAnalyzerLib.calculateLungResults(self.getVolumes(), self.countBullae)
+        tableNode.RemoveAllColumns()
 
         labelArray = vtk.vtkStringArray()
         labelArray.SetName("Lung area")
@@ -1985,61 +2235,61 @@ class LungCTAnalyzerLogic(ScriptedLoadableModuleLogic):
 
 
         labelArray.InsertNextValue("Total lungs")
-        totalMlArray.InsertNextValue(self.totalLungVolume)
+        totalMlArray.InsertNextValue(results["totalLungVolume"])
         
-        functionalMlArray.InsertNextValue(self.functionalTotalVolume)
-        functionalPercentArray.InsertNextValue(self.functionalTotalVolumePerc)
+        functionalMlArray.InsertNextValue(results["functionalTotalVolume"])
+        functionalPercentArray.InsertNextValue(results["functionalTotalVolumePerc"])
         
-        affectedMlArray.InsertNextValue(self.affectedTotalVolume)
-        affectedPercentArray.InsertNextValue(self.affectedTotalVolumePerc)
+        affectedMlArray.InsertNextValue(results["affectedTotalVolume"])
+        affectedPercentArray.InsertNextValue(results["affectedTotalVolumePerc"])
 
-        infiltratedMlArray.InsertNextValue(self.infiltratedTotalVolume)
-        infiltratedPercentArray.InsertNextValue(self.infiltratedTotalVolumePerc)
+        infiltratedMlArray.InsertNextValue(results["infiltratedTotalVolume"])
+        infiltratedPercentArray.InsertNextValue(results["infiltratedTotalVolumePerc"])
 
-        collapsedMlArray.InsertNextValue(self.collapsedTotalVolume)
-        collapsedPercentArray.InsertNextValue(self.collapsedTotalVolumePerc)
+        collapsedMlArray.InsertNextValue(results["collapsedTotalVolume"])
+        collapsedPercentArray.InsertNextValue(results["collapsedTotalVolumePerc"])
 
-        emphysemaMlArray.InsertNextValue(self.emphysemaTotalVolume)
-        emphysemaPercentArray.InsertNextValue(self.emphysemaTotalVolumePerc)
+        emphysemaMlArray.InsertNextValue(results["emphysemaTotalVolume"])
+        emphysemaPercentArray.InsertNextValue(results["emphysemaTotalVolumePerc"])
 
         labelArray.InsertNextValue("Right lung")
-        totalMlArray.InsertNextValue(self.rightLungVolume)
+        totalMlArray.InsertNextValue(results["rightLungVolume"])
         
-        functionalMlArray.InsertNextValue(self.functionalRightVolume)
-        functionalPercentArray.InsertNextValue(self.functionalRightVolumePerc)
+        functionalMlArray.InsertNextValue(results["functionalRightVolume"])
+        functionalPercentArray.InsertNextValue(results["functionalRightVolumePerc"])
         
-        affectedMlArray.InsertNextValue(self.affectedRightVolume)
-        affectedPercentArray.InsertNextValue(self.affectedRightVolumePerc)
+        affectedMlArray.InsertNextValue(results["affectedRightVolume"])
+        affectedPercentArray.InsertNextValue(results["affectedRightVolumePerc"])
 
-        infiltratedMlArray.InsertNextValue(self.infiltratedRightVolume)
-        infiltratedPercentArray.InsertNextValue(self.infiltratedRightVolumePerc)
+        infiltratedMlArray.InsertNextValue(results["infiltratedRightVolume"])
+        infiltratedPercentArray.InsertNextValue(results["infiltratedRightVolumePerc"])
 
-        collapsedMlArray.InsertNextValue(self.collapsedRightVolume)
-        collapsedPercentArray.InsertNextValue(self.collapsedRightVolumePerc)
+        collapsedMlArray.InsertNextValue(results["collapsedRightVolume"])
+        collapsedPercentArray.InsertNextValue(results["collapsedRightVolumePerc"])
 
-        emphysemaMlArray.InsertNextValue(self.emphysemaRightVolume)
-        emphysemaPercentArray.InsertNextValue(self.emphysemaRightVolumePerc)
+        emphysemaMlArray.InsertNextValue(results["emphysemaRightVolume"])
+        emphysemaPercentArray.InsertNextValue(results["emphysemaRightVolumePerc"])
 
         labelArray.InsertNextValue("Left lung")
-        totalMlArray.InsertNextValue(self.leftLungVolume)
+        totalMlArray.InsertNextValue(results["leftLungVolume"])
         
-        functionalMlArray.InsertNextValue(self.functionalLeftVolume)
-        functionalPercentArray.InsertNextValue(self.functionalLeftVolumePerc)
+        functionalMlArray.InsertNextValue(results["functionalLeftVolume"])
+        functionalPercentArray.InsertNextValue(results["functionalLeftVolumePerc"])
         
-        affectedMlArray.InsertNextValue(self.affectedLeftVolume)
-        affectedPercentArray.InsertNextValue(self.affectedLeftVolumePerc)
+        affectedMlArray.InsertNextValue(results["affectedLeftVolume"])
+        affectedPercentArray.InsertNextValue(results["affectedLeftVolumePerc"])
 
-        infiltratedMlArray.InsertNextValue(self.infiltratedLeftVolume)
-        infiltratedPercentArray.InsertNextValue(self.infiltratedLeftVolumePerc)
+        infiltratedMlArray.InsertNextValue(results["infiltratedLeftVolume"])
+        infiltratedPercentArray.InsertNextValue(results["infiltratedLeftVolumePerc"])
 
-        collapsedMlArray.InsertNextValue(self.collapsedLeftVolume)
-        collapsedPercentArray.InsertNextValue(self.collapsedLeftVolumePerc)
+        collapsedMlArray.InsertNextValue(results["collapsedLeftVolume"])
+        collapsedPercentArray.InsertNextValue(results["collapsedLeftVolumePerc"])
 
-        emphysemaMlArray.InsertNextValue(self.emphysemaLeftVolume)
-        emphysemaPercentArray.InsertNextValue(self.emphysemaLeftVolumePerc)
+        emphysemaMlArray.InsertNextValue(results["emphysemaLeftVolume"])
+        emphysemaPercentArray.InsertNextValue(results["emphysemaLeftVolumePerc"])
 
 
-        if self.areaAnalysis: 
+        if not preview and self.areaAnalysis: 
 
             for subSegmentProperty in self.subSegmentProperties:
                 self.getResultsFor(f"{subSegmentProperty['name']}")
@@ -2056,7 +2306,7 @@ class LungCTAnalyzerLogic(ScriptedLoadableModuleLogic):
                 emphysemaMlArray.InsertNextValue(self.emphysemaResultTotalVolume)
                 emphysemaPercentArray.InsertNextValue(self.emphysemaResultTotalVolumePerc)
 
-        if self.lobeAnalysis: 
+        if not preview and self.lobeAnalysis: 
             for lobeName in ['upper lobe', 'middle lobe', 'lower lobe']:
                     segmentName = lobeName
                     self.getResultsFor(segmentName)
@@ -2089,25 +2339,32 @@ class LungCTAnalyzerLogic(ScriptedLoadableModuleLogic):
                     emphysemaPercentArray.InsertNextValue(self.emphysemaResultLeftVolumePerc)
                         
 
-        self.covidResultsTable.AddColumn(labelArray)
-        self.covidResultsTable.AddColumn(totalMlArray)
-        self.covidResultsTable.AddColumn(functionalMlArray)
-        self.covidResultsTable.AddColumn(functionalPercentArray)
-        self.covidResultsTable.AddColumn(emphysemaMlArray)
-        self.covidResultsTable.AddColumn(emphysemaPercentArray)
-        self.covidResultsTable.AddColumn(infiltratedMlArray)
-        self.covidResultsTable.AddColumn(infiltratedPercentArray)
-        self.covidResultsTable.AddColumn(collapsedMlArray)
-        self.covidResultsTable.AddColumn(collapsedPercentArray)
-        self.covidResultsTable.AddColumn(affectedMlArray)
-        self.covidResultsTable.AddColumn(affectedPercentArray)
-
-    def createEmphysemaResultsTable(self):
+        tableNode.AddColumn(labelArray)
+        tableNode.AddColumn(totalMlArray)
+        tableNode.AddColumn(functionalMlArray)
+        tableNode.AddColumn(functionalPercentArray)
+        tableNode.AddColumn(emphysemaMlArray)
+        tableNode.AddColumn(emphysemaPercentArray)
+        tableNode.AddColumn(infiltratedMlArray)
+        tableNode.AddColumn(infiltratedPercentArray)
+        tableNode.AddColumn(collapsedMlArray)
+        tableNode.AddColumn(collapsedPercentArray)
+        tableNode.AddColumn(affectedMlArray)
+        tableNode.AddColumn(affectedPercentArray)
+
+    def createEmphysemaResultsTable(self, preview=False):
     
-        if not self.emphysemaResultsTable:
-            self.emphysemaResultsTable = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLTableNode', 'Lung CT analysis emphysema analysis')
+        if preview:
+            if not self.emphysemaResultsPreviewTable:
+                self.emphysemaResultsPreviewTable = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLTableNode', 'Lung CT analysis emphysema analysis (preview)')
+            tableNode = self.emphysemaResultsPreviewTable
+            results = self.previewResults
         else:
-            self.emphysemaResultsTable.RemoveAllColumns()
+            if not self.emphysemaResultsTable:
+                self.emphysemaResultsTable = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLTableNode', 'Lung CT analysis emphysema analysis')
+            tableNode = self.emphysemaResultsTable
+            results = LungCTAnalyzerLib.calculateLungResults(self.getVolumes(), self.countBullae)
+        tableNode.RemoveAllColumns()
 
         labelArray = vtk.vtkStringArray()
         labelArray.SetName("Lung areas")
@@ -2123,25 +2380,25 @@ class LungCTAnalyzerLogic(ScriptedLoadableModuleLogic):
 
 
         labelArray.InsertNextValue("Total lungs")
-        totalMlArray.InsertNextValue(self.totalLungVolume)
+        totalMlArray.InsertNextValue(results["totalLungVolume"])
                 
-        emphysemaMlArray.InsertNextValue(self.emphysemaTotalVolume)
-        emphysemaPercentArray.InsertNextValue(self.emphysemaTotalVolumePerc)
+        emphysemaMlArray.InsertNextValue(results["emphysemaTotalVolume"])
+        emphysemaPercentArray.InsertNextValue(results["emphysemaTotalVolumePerc"])
 
         labelArray.InsertNextValue("Right lung")
-        totalMlArray.InsertNextValue(self.rightLungVolume)
+        totalMlArray.InsertNextValue(results["rightLungVolume"])
                
-        emphysemaMlArray.InsertNextValue(self.emphysemaRightVolume)
-        emphysemaPercentArray.InsertNextValue(self.emphysemaRightVolumePerc)
+        emphysemaMlArray.InsertNextValue(results["emphysemaRightVolume"])
+        emphysemaPercentArray.InsertNextValue(results["emphysemaRightVolumePerc"])
 
         labelArray.InsertNextValue("Left lung")
-        totalMlArray.InsertNextValue(self.leftLungVolume)
+        totalMlArray.InsertNextValue(results["leftLungVolume"])
                 
-        emphysemaMlArray.InsertNextValue(self.emphysemaLeftVolume)
-        emphysemaPercentArray.InsertNextValue(self.emphysemaLeftVolumePerc)
+        emphysemaMlArray.InsertNextValue(results["emphysemaLeftVolume"])
+        emphysemaPercentArray.InsertNextValue(results["emphysemaLeftVolumePerc"])
 
 
-        if self.areaAnalysis: 
+        if not preview and self.areaAnalysis: 
             for subSegmentProperty in self.subSegmentProperties:
                 self.getResultsFor(f"{subSegmentProperty['name']}")
                 labelArray.InsertNextValue(f"Lungs {subSegmentProperty['name']}")
@@ -2149,7 +2406,7 @@ class LungCTAnalyzerLogic(ScriptedLoadableModuleLogic):
                 emphysemaMlArray.InsertNextValue(self.emphysemaResultTotalVolume)
                 emphysemaPercentArray.InsertNextValue(self.emphysemaResultTotalVolumePerc)
                 
-        if self.lobeAnalysis: 
+        if not preview and self.lobeAnalysis: 
             segmentName = f"upper lobe"
             self.getResultsFor(segmentName)
             labelArray.InsertNextValue("Right upper lobe")
@@ -2182,10 +2439,27 @@ class LungCTAnalyzerLogic(ScriptedLoadableModuleLogic):
             emphysemaPercentArray.InsertNextValue(self.emphysemaResultLeftVolumePerc)
 
 
-        self.emphysemaResultsTable.AddColumn(labelArray)
-        self.emphysemaResultsTable.AddColumn(totalMlArray)
-        self.emphysemaResultsTable.AddColumn(emphysemaMlArray)
-        self.emphysemaResultsTable.AddColumn(emphysemaPercentArray)
+        tableNode.AddColumn(labelArray)
+        tableNode.AddColumn(totalMlArray)
+        tableNode.AddColumn(emphysemaMlArray)
+        tableNode.AddColumn(emphysemaPercentArray)
+
+        # Emphysema cluster results are available for the whole lungs only (first three rows)
+        if not preview and self.emphysemaClusters:
+            columnNames = ["LAA clusters", "Largest LAA cluster (ml)", "LAA power law D"]
+            columnNames += [f"LAA clusters {binName}" for binName in LungCTAnalyzerLib.emphysemaClusterSizeBinNames()]
+            rowValues = []
+            for side in ["total", "right", "left"]:
+                clusters = self.emphysemaClusters[side]
+                rowValues.append([clusters["count"], round(clusters["largestMm3"] / 1000., 3), round(clusters["D"], 3)] + clusters["histogram"])
+            for columnIndex, columnName in enumerate(columnNames):
+                clusterArray = vtk.vtkStringArray()
+                clusterArray.SetName(columnName)
+                for values in rowValues:
+                    clusterArray.InsertNextValue(str(values[columnIndex]))
+                for rowIndex in range(len(rowValues), labelArray.GetNumberOfValues()):
+                    clusterArray.InsertNextValue("")
+                tableNode.AddColumn(clusterArray)
    
     def saveDataToFile(self, reportPathWithoutExtension,user_str1,user_str2,user_str3):
     
@@ -2196,16 +2470,23 @@ class LungCTAnalyzerLogic(ScriptedLoadableModuleLogic):
         
         
     def saveExtendedDataToFile(self, filename,user_str1,user_str2,user_str3):
-
-        import os.path
-
-
-        file_exists = os.path.isfile(filename)
-
         self.calculateStatistics()
+        self.saveRowToFile(filename, *self.getExtendedDataRow(user_str1,user_str2,user_str3))
 
-        import csv
+    def saveRowToFile(self, filename, header, data):
+        """
+        Append a row to a results CSV file (the header is written if the file is new).
+        """
+        from LungCTAnalyzerLib import ResultsSink
+        try:
+            ResultsSink.appendRow(filename, header, data)
+        except IOError:
+            logging.error("I/O error")
 
+    def getExtendedDataRow(self, user_str1,user_str2,user_str3):
+        """
+        Get header and values of the whole lung results (calculateStatistics must be called before).
+        """
         header = [
         'user1',
         'user2',
@@ -2284,36 +2565,27 @@ class LungCTAnalyzerLogic(ScriptedLoadableModuleLogic):
         self.affectedLeftVolume,
         self.affectedLeftVolumePerc,
         ]
-        
-        
-        try:
-            with open(filename, 'a') as f:
-                if not file_exists:
-                    for item in header: 
-                        f.write('"')
-                        f.write(item)  # file doesn't exist yet, write a header
-                        f.write('"')
-                        f.write(";")
-                    f.write("\n")
-                for item in data: 
-                    f.write(str(item))  
-                    f.write(";")
-                f.write("\n")
-        except IOError:
-            logging.error("I/O error")
-        
-        
-        
-    def saveExtendedRegionDataToFile(self, filename,user_str1,user_str2,user_str3):
 
-        import os.path
+        if self.emphysemaClusters:
+            for side in ["total", "right", "left"]:
+                clusters = self.emphysemaClusters[side]
+                header += [f"{side} LAA clusters", f"{side} largest LAA cluster ml", f"{side} LAA power law D"]
+                data += [clusters["count"], clusters["largestMm3"] / 1000., clusters["D"]]
+                for binName, binCount in zip(LungCTAnalyzerLib.emphysemaClusterSizeBinNames(), clusters["histogram"]):
+                    header.append(f"{side} LAA clusters {binName}")
+                    data.append(binCount)
 
-        file_exists = os.path.isfile(filename)
+        return header, data
 
+    def saveExtendedRegionDataToFile(self, filename,user_str1,user_str2,user_str3):
         self.calculateStatistics()
+        self.saveRowToFile(filename, *self.getExtendedRegionDataRow(user_str1,user_str2,user_str3))
 
-        import csv
-
+    def getExtendedRegionDataRow(self, user_str1,user_str2,user_str3):
+        """
+        Get header and values of the lung region results. Only the user columns have values
+        if area analysis is disabled.
+        """
         header = [
         'user1',
         'user2',
@@ -2343,57 +2615,33 @@ class LungCTAnalyzerLogic(ScriptedLoadableModuleLogic):
             for area in areas: 
                 header.append(region + " " + area)
 
-        try:
-            with open(filename, 'a') as f:
-                if not file_exists:
-                    for item in header: 
-                        f.write('"')
-                        f.write(item)  # file doesn't exist yet, write a header
-                        f.write('"')
-                        f.write(";")
-                    f.write("\n")
-                for item in data: 
-                    f.write(str(item))  
-                    f.write(";")
-                if self.areaAnalysis: 
-                    for subSegmentProperty in self.subSegmentProperties:
-                        self.getResultsFor(f"{subSegmentProperty['name']}")
-                        f.write(str(self.totalResultLungVolume))
-                        f.write(";")
-                        f.write(str(self.functionalResultTotalVolume))
-                        f.write(";")
-                        f.write(str(self.functionalResultTotalVolumePerc))
-                        f.write(";")
-                        f.write(str(self.emphysemaResultTotalVolume))
-                        f.write(";")
-                        f.write(str(self.emphysemaResultTotalVolumePerc))
-                        f.write(";")
-                        f.write(str(self.infiltratedResultTotalVolume))
-                        f.write(";")
-                        f.write(str(self.infiltratedResultTotalVolumePerc))
-                        f.write(";")
-                        f.write(str(self.collapsedResultTotalVolume))
-                        f.write(";")
-                        f.write(str(self.collapsedResultTotalVolumePerc))
-                        f.write(";")
-                        f.write(str(self.affectedResultTotalVolume))
-                        f.write(";")
-                        f.write(str(self.affectedResultTotalVolumePerc))
-                        f.write(";")
-                f.write("\n")
-        except IOError:
-            logging.error("I/O error")
+        if self.areaAnalysis: 
+            for subSegmentProperty in self.subSegmentProperties:
+                self.getResultsFor(f"{subSegmentProperty['name']}")
+                data += [
+                    self.totalResultLungVolume,
+                    self.functionalResultTotalVolume,
+                    self.functionalResultTotalVolumePerc,
+                    self.emphysemaResultTotalVolume,
+                    self.emphysemaResultTotalVolumePerc,
+                    self.infiltratedResultTotalVolume,
+                    self.infiltratedResultTotalVolumePerc,
+                    self.collapsedResultTotalVolume,
+                    self.collapsedResultTotalVolumePerc,
+                    self.affectedResultTotalVolume,
+                    self.affectedResultTotalVolumePerc,
+                    ]
+        return header, data
         
     def saveExtendedLobeDataToFile(self, filename,user_str1,user_str2,user_str3):
-
-        import os.path
-
-        file_exists = os.path.isfile(filename)
-
         self.calculateStatistics()
+        self.saveRowToFile(filename, *self.getExtendedLobeDataRow(user_str1,user_str2,user_str3))
 
-        import csv
-
+    def getExtendedLobeDataRow(self, user_str1,user_str2,user_str3):
+        """
+        Get header and values of the lobe results. Only the user columns have values
+        if lobe analysis is disabled.
+        """
         header = [
         'user1',
         'user2',
@@ -2423,74 +2671,256 @@ class LungCTAnalyzerLogic(ScriptedLoadableModuleLogic):
             for area in areas: 
                 header.append(lobe + " " + area)
 
+        if self.lobeAnalysis: 
+            lobenames = ["upper lobe", "middle lobe", "lower lobe"]
+            for lobename in lobenames:
+                self.getResultsFor(lobename)
+                data += [
+                    self.rightResultLungVolume,
+                    self.functionalResultRightVolume,
+                    self.functionalResultRightVolumePerc,
+                    self.emphysemaResultRightVolume,
+                    self.emphysemaResultRightVolumePerc,
+                    self.infiltratedResultRightVolume,
+                    self.infiltratedResultRightVolumePerc,
+                    self.collapsedResultRightVolume,
+                    self.collapsedResultRightVolumePerc,
+                    self.affectedResultRightVolume,
+                    self.affectedResultRightVolumePerc,
+                    ]
+            lobenames = ["upper lobe", "lower lobe"]
+            for lobename in lobenames:
+                self.getResultsFor(lobename)
+                data += [
+                    self.leftResultLungVolume,
+                    self.functionalResultLeftVolume,
+                    self.functionalResultLeftVolumePerc,
+                    self.emphysemaResultLeftVolume,
+                    self.emphysemaResultLeftVolumePerc,
+                    self.infiltratedResultLeftVolume,
+                    self.infiltratedResultLeftVolumePerc,
+                    self.collapsedResultLeftVolume,
+                    self.collapsedResultLeftVolumePerc,
+                    self.affectedResultLeftVolume,
+                    self.affectedResultLeftVolumePerc,
+                    ]
+        return header, data
+
+    def getBatchCaseInputNodes(self, useCalibratedCT=False):
+        """
+        Nodes that are read from the ct_seg.mrb file of a batch case, as node name -> MRML element name
+        (see LungCTAnalyzerLib/MrbReader.py).
+        """
+        from LungCTAnalyzerLib import MrbReader
+        return {
+            "CT_calibrated" if useCalibratedCT else "CT": MrbReader.volumeTagName,
+            "Lung segmentation": MrbReader.segmentationTagName,
+            }
 
+    def loadBatchCase(self, filepath, isNiiGzFormat=False, useCalibratedCT=False, inputNodesOnly=False):
+        """
+        Load one batch processing case into the (cleared) scene and select it as input.
+        filepath is the ct_seg.mrb file, the node file list of the input nodes staged by LungCTAnalyzerLib.BatchIO,
+        an extracted .mrml scene or, for NIFTI input, the CT file of the case with the lung segments in the
+        lung_segmentations subfolder. If inputNodesOnly is True, only the input volume and the lung segmentation
+        are read from a .mrb file, which is faster, but the other nodes of the scene are not saved with the results.
+        """
+        lowerFilepath = filepath.lower()
+        if not isNiiGzFormat and (lowerFilepath.endswith(".json") or (lowerFilepath.endswith(".mrb") and inputNodesOnly)):
+            import json
+            import tempfile
+            from LungCTAnalyzerLib import MrbReader
+            inputNodes = self.getBatchCaseInputNodes(useCalibratedCT)
+            volumeName = "CT_calibrated" if useCalibratedCT else "CT"
+            with tempfile.TemporaryDirectory(dir=slicer.app.temporaryPath) as extractDir:
+                if lowerFilepath.endswith(".mrb"):
+                    nodeFiles = MrbReader.extractNodeFiles(filepath, inputNodes, extractDir)
+                else:
+                    with open(filepath) as f:
+                        nodeFiles = json.load(f)
+                if volumeName not in nodeFiles:
+                    raise ValueError("No input volume.")
+                if "Lung segmentation" not in nodeFiles:
+                    raise ValueError("No input segmentation.")
+                self.inputVolume = slicer.util.loadVolume(nodeFiles[volumeName], {"name": volumeName})
+                self.inputSegmentation = slicer.util.loadSegmentation(nodeFiles["Lung segmentation"])
+                self.inputSegmentation.SetName("Lung segmentation")
+        elif not isNiiGzFormat:
+            slicer.util.loadScene(filepath)
+            if useCalibratedCT:
+                inputVolume = slicer.util.getFirstNodeByClassByName("vtkMRMLScalarVolumeNode", "CT_calibrated")
+                # to prevent crash TODO find out why
+                ctVolumeNode = slicer.util.getFirstNodeByClassByName("vtkMRMLScalarVolumeNode", "CT")
+                if ctVolumeNode:
+                    slicer.mrmlScene.RemoveNode(ctVolumeNode)
+            else:
+                inputVolume = slicer.util.getFirstNodeByClassByName("vtkMRMLScalarVolumeNode", "CT")
+            if not inputVolume:
+                raise ValueError("No input volume.")
+            self.inputVolume = inputVolume
+            self.inputSegmentation = slicer.util.getFirstNodeByClassByName("vtkMRMLSegmentationNode", "Lung segmentation")
+            if not self.inputSegmentation:
+                raise ValueError("No input segmentation.")
+        else:
+            self.inputVolume = slicer.util.loadVolume(filepath)
+            self.inputSegmentation = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLSegmentationNode', 'Lung segmentation')
+            caseDir = os.path.dirname(filepath)
+            # segments may be compressed (.nii.gz) or, if staged by LungCTAnalyzerLib.BatchIO, uncompressed (.nii)
+            for segmentFilepath in glob.iglob(caseDir + '/lung_segmentations/**/*.nii*', recursive=True):
+                segmentName = os.path.basename(segmentFilepath).replace(".gz", "").replace(".nii", "").replace("_", " ")
+                labelmapVolumeNode = slicer.util.loadLabelVolume(segmentFilepath, {"name": segmentName})
+                segmentId = self.inputSegmentation.GetSegmentation().AddEmptySegment(segmentName, segmentName)
+                updatedSegmentIds = vtk.vtkStringArray()
+                updatedSegmentIds.InsertNextValue(segmentId)
+                slicer.modules.segmentations.logic().ImportLabelmapToSegmentationNode(labelmapVolumeNode, self.inputSegmentation, updatedSegmentIds)
+                slicer.mrmlScene.RemoveNode(labelmapVolumeNode)
+
+        segmentation = self.inputSegmentation.GetSegmentation()
+        self.rightLungMaskSegmentID = segmentation.GetSegmentIdBySegmentName("right lung")
+        self.leftLungMaskSegmentID = segmentation.GetSegmentIdBySegmentName("left lung")
+        if not self.rightLungMaskSegmentID or not self.leftLungMaskSegmentID:
+            raise ValueError("Right or left lung input segment missing.")
+
+    def addBatchCaseResults(self, resultsSink, filepath, counter, caseName, resultsDatabase=None, parameters=None, timingColumns=False):
+        """
+        Add the results of the current case to the batch result files of a LungCTAnalyzerLib.ResultsSink
+        and, if given, to a LungCTAnalyzerLib.ResultsDatabase (with the batch parameters of the run).
+        If timingColumns is True, the stage timings are added as columns to the whole lung results.
+        """
+        self.calculateStatistics()
+        header, row = self.getExtendedDataRow(filepath, counter, caseName)
+        if timingColumns:
+            from LungCTAnalyzerLib import StageTimer
+            timingHeader, timingRow = StageTimer.getCsvColumns(self.stageTimings, self.timingStageNames)
+            header, row = header + timingHeader, row + timingRow
+        resultsSink.addRow("results.csv", header, row)
+        resultsSink.addRow("regionResults.csv", *self.getExtendedRegionDataRow(filepath, counter, caseName))
+        resultsSink.addRow("lobeResults.csv", *self.getExtendedLobeDataRow(filepath, counter, caseName))
+        if resultsDatabase:
+            self.addResultsToDatabase(resultsDatabase, filepath, counter, caseName, parameters)
+
+    def addResultsToDatabase(self, resultsDatabase, filepath, counter, caseName, parameters=None):
+        """
+        Add the volumes of the whole lungs and, if analyzed, of the regions and lobes of the current case
+        to a LungCTAnalyzerLib.ResultsDatabase.
+        """
+        from LungCTAnalyzerLib import ResultsDatabase
+        regions = [subSegmentProperty["name"] for subSegmentProperty in self.subSegmentProperties] if self.areaAnalysis else []
+        volumeRecords = ResultsDatabase.lungVolumeRecords(self.getVolumes(), self.countBullae, regions, self.lobeAnalysis)
+        resultsDatabase.addRun("LungCTAnalyzer", filepath, caseName, counter, parameters, volumeRecords)
+
+    def saveBatchCaseOutputs(self, targetdir, isNiiGzFormat=False, multiLabelOutput=True, segmentFilesOutput=False, compression="fast",
+        minimalOutput=False):
+        """
+        Write the volumes and output segments of the current case to targetdir,
+        either as NIFTI files or as a ct_seg_analyzed.mrb scene.
+        NIFTI segments are written as multi-label volumes and/or as a file per segment.
+        compression is one of LungCTAnalyzerLib.BatchIO.outputCompressions.
+        If minimalOutput is True, only the essential nodes (see getEssentialOutputNodes) are written,
+        the other nodes are removed from the scene before it is saved.
+        """
+        if not self.outputSegmentsValid:
+            raise ValueError("Output segments are not available, the results were taken from the result cache. "
+                "Disable the result cache to save the segmentations.")
+        if not os.path.exists(targetdir):
+            os.makedirs(targetdir)
+        if isNiiGzFormat:
+            for function, args, sizeBytes in self.getNiftiOutputWriteTasks(targetdir, multiLabelOutput, segmentFilesOutput, compression, minimalOutput):
+                function(*args)
+        else:
+            if minimalOutput:
+                self.removeIntermediateNodes(self.getEssentialOutputNodes())
+            # the scene archive itself is always compressed, the setting applies to the files in it
+            for node in slicer.util.getNodesByClass("vtkMRMLScalarVolumeNode") + slicer.util.getNodesByClass("vtkMRMLSegmentationNode"):
+                node.AddDefaultStorageNode()
+                node.GetStorageNode().SetUseCompression(compression != "none")
+            sceneSaveFilename = targetdir + "ct_seg_analyzed.mrb"
+            if slicer.util.saveScene(sceneSaveFilename):
+                logging.info("Scene saved to: {0}".format(sceneSaveFilename))
+            else:
+                logging.error("Scene saving failed")
+
+    def getEssentialOutputNodes(self):
+        """
+        Nodes that are written in the minimal output profile: the lung segmentation,
+        the output (classification) segmentation and the results tables.
+        """
+        return [node for node in [self.inputSegmentation, self.outputSegmentation,
+            self.resultsTable, self.covidResultsTable, self.emphysemaResultsTable] if node]
+
+    def removeIntermediateNodes(self, keepNodes):
+        """
+        Remove all data nodes except keepNodes (and transforms) from the scene, so that intermediate results
+        such as the masked volume are not saved. Display and storage nodes are removed with their data node.
+        """
+        keepNodeIDs = [node.GetID() for node in keepNodes]
+        for className in ["vtkMRMLVolumeNode", "vtkMRMLSegmentationNode", "vtkMRMLModelNode", "vtkMRMLTableNode", "vtkMRMLMarkupsNode"]:
+            for node in slicer.util.getNodesByClass(className):
+                if node.GetID() not in keepNodeIDs:
+                    slicer.mrmlScene.RemoveNode(node)
+
+    def getOutputSegmentLayers(self, segmentationNode=None):
+        """
+        Export the output segments (or the segments of segmentationNode) to label arrays in the geometry of
+        the input volume, one array per layer of the segmentation (segments of a layer do not overlap,
+        so they are exported in one pass).
+        Yields (labelArray, segments) tuples, label value i+1 is segments[i] = (name, color).
+        """
+        if not segmentationNode:
+            segmentationNode = self.outputSegmentation
+        segmentation = segmentationNode.GetSegmentation()
+        layerSegmentIds = {}
+        for segmentIndex in range(segmentation.GetNumberOfSegments()):
+            segmentId = segmentation.GetNthSegmentID(segmentIndex)
+            layerSegmentIds.setdefault(segmentation.GetLayerIndex(segmentId), []).append(segmentId)
+        labelmapVolumeNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLLabelMapVolumeNode")
         try:
-            with open(filename, 'a') as f:
-                if not file_exists:
-                    for item in header: 
-                        f.write('"')
-                        f.write(item)  # file doesn't exist yet, write a header
-                        f.write('"')
-                        f.write(";")
-                    f.write("\n")
-                for item in data: 
-                    f.write(str(item))  
-                    f.write(";")
-                if self.lobeAnalysis: 
-                    lobenames = ["upper lobe", "middle lobe", "lower lobe"]
-                    for lobename in lobenames:
-                        self.getResultsFor(lobename)
-                        f.write(str(self.rightResultLungVolume))
-                        f.write(";")
-                        f.write(str(self.functionalResultRightVolume))
-                        f.write(";")
-                        f.write(str(self.functionalResultRightVolumePerc))
-                        f.write(";")
-                        f.write(str(self.emphysemaResultRightVolume))
-                        f.write(";")
-                        f.write(str(self.emphysemaResultRightVolumePerc))
-                        f.write(";")
-                        f.write(str(self.infiltratedResultRightVolume))
-                        f.write(";")
-                        f.write(str(self.infiltratedResultRightVolumePerc))
-                        f.write(";")
-                        f.write(str(self.collapsedResultRightVolume))
-                        f.write(";")
-                        f.write(str(self.collapsedResultRightVolumePerc))
-                        f.write(";")
-                        f.write(str(self.affectedResultRightVolume))
-                        f.write(";")
-                        f.write(str(self.affectedResultRightVolumePerc))
-                        f.write(";")
-                    lobenames = ["upper lobe", "lower lobe"]
-                    for lobename in lobenames:
-                        self.getResultsFor(lobename)
-                        f.write(str(self.leftResultLungVolume))
-                        f.write(";")
-                        f.write(str(self.functionalResultLeftVolume))
-                        f.write(";")
-                        f.write(str(self.functionalResultLeftVolumePerc))
-                        f.write(";")
-                        f.write(str(self.emphysemaResultLeftVolume))
-                        f.write(";")
-                        f.write(str(self.emphysemaResultLeftVolumePerc))
-                        f.write(";")
-                        f.write(str(self.infiltratedResultLeftVolume))
-                        f.write(";")
-                        f.write(str(self.infiltratedResultLeftVolumePerc))
-                        f.write(";")
-                        f.write(str(self.collapsedResultLeftVolume))
-                        f.write(";")
-                        f.write(str(self.collapsedResultLeftVolumePerc))
-                        f.write(";")
-                        f.write(str(self.affectedResultLeftVolume))
-                        f.write(";")
-                        f.write(str(self.affectedResultLeftVolumePerc))
-                        f.write(";")
-                f.write("\n")
-        except IOError:
-            logging.error("I/O error")
-        
+            for segmentIds in layerSegmentIds.values():
+                # label values of the exported segments are their index in segmentIds + 1
+                slicer.modules.segmentations.logic().ExportSegmentsToLabelmapNode(segmentationNode, segmentIds, labelmapVolumeNode, self.inputVolume)
+                segments = [(segmentation.GetSegment(segmentId).GetName(), segmentation.GetSegment(segmentId).GetColor()) for segmentId in segmentIds]
+                yield slicer.util.arrayFromVolume(labelmapVolumeNode).copy(), segments
+        finally:
+            slicer.mrmlScene.RemoveNode(labelmapVolumeNode)
+
+    def getNiftiOutputWriteTasks(self, targetdir, multiLabelOutput=True, segmentFilesOutput=False, compression="fast", minimalOutput=False):
+        """
+        Take snapshots of the volumes and output segments of the current case for writing them as NIFTI files to targetdir.
+        Returns (function, args, sizeBytes) write tasks. They do not access the scene, so they can run on a background
+        thread (see LungCTAnalyzerLib.BatchIO.BackgroundWriter) while the next case is analyzed.
+        Output segments are written as multi-label volumes with a JSON label dictionary and/or as a file per segment
+        (see LungCTAnalyzerLib/LabelExport.py).
+        If minimalOutput is True, no volumes are written, but the lung segmentation as lung_labels label volume.
+        """
+        if not self.outputSegmentsValid:
+            raise ValueError("Output segments are not available, the results were taken from the result cache. "
+                "Disable the result cache to save the segmentations.")
+        from LungCTAnalyzerLib import BatchIO, LabelExport
+        tasks = []
+        ijkToRas = vtk.vtkMatrix4x4()
+        self.inputVolume.GetIJKToRASMatrix(ijkToRas)
+        inputIjkToRas = slicer.util.arrayFromVTKMatrix(ijkToRas)
+        for volumeNode in ([] if minimalOutput else slicer.util.getNodesByClass("vtkMRMLScalarVolumeNode")):
+            ijkToRas = vtk.vtkMatrix4x4()
+            volumeNode.GetIJKToRASMatrix(ijkToRas)
+            volumeArray = slicer.util.arrayFromVolume(volumeNode).copy()
+            filename = targetdir + volumeNode.GetName().lower().replace(" ", "_") + ".nii.gz"
+            tasks.append((BatchIO.writeVolumeArray, (filename, volumeArray, slicer.util.arrayFromVTKMatrix(ijkToRas), compression), volumeArray.nbytes))
+        if (multiLabelOutput or segmentFilesOutput) and self.outputSegmentation:
+            merger = LabelExport.LabelVolumeMerger()
+            for labelArray, segments in self.getOutputSegmentLayers():
+                merger.addLayer(labelArray, segments)
+            tasks.append((LabelExport.writeLabelVolumes, (merger.volumes, inputIjkToRas,
+                targetdir + "lung_analysis_labels" if multiLabelOutput else None,
+                targetdir + "lung_analysis_segmentations/" if segmentFilesOutput else None, compression),
+                sum(labelArray.nbytes for labelArray, segments in merger.volumes)))
+        if minimalOutput and self.inputSegmentation:
+            merger = LabelExport.LabelVolumeMerger()
+            for labelArray, segments in self.getOutputSegmentLayers(self.inputSegmentation):
+                merger.addLayer(labelArray, segments)
+            tasks.append((LabelExport.writeLabelVolumes, (merger.volumes, inputIjkToRas, targetdir + "lung_labels", None, compression),
+                sum(labelArray.nbytes for labelArray, segments in merger.volumes)))
+        return tasks
 
     @property
     def inputVolume(self):
@@ -2532,6 +2962,22 @@ class LungCTAnalyzerLogic(ScriptedLoadableModuleLogic):
     def emphysemaResultsTable(self, node):
         self.getParameterNode().SetNodeReferenceID("EmphysemaResultsTable", node.GetID() if node else None)
 
+    @property
+    def covidResultsPreviewTable(self):
+        return self.getParameterNode().GetNodeReference("CovidResultsPreviewTable")
+
+    @covidResultsPreviewTable.setter
+    def covidResultsPreviewTable(self, node):
+        self.getParameterNode().SetNodeReferenceID("CovidResultsPreviewTable", node.GetID() if node else None)
+
+    @property
+    def emphysemaResultsPreviewTable(self):
+        return self.getParameterNode().GetNodeReference("EmphysemaResultsPreviewTable")
+
+    @emphysemaResultsPreviewTable.setter
+    def emphysemaResultsPreviewTable(self, node):
+        self.getParameterNode().SetNodeReferenceID("EmphysemaResultsPreviewTable", node.GetID() if node else None)
+
     @property
     def volumeRenderingPropertyNode(self):
         return self.getParameterNode().GetNodeReference("VolumeRenderingPropertyNode")
@@ -2573,6 +3019,30 @@ class LungCTAnalyzerLogic(ScriptedLoadableModuleLogic):
     def lobeAnalysis(self, on):
         self.getParameterNode().SetParameter("LobeAnalysis", "true" if on else "false")
 
+    @property
+    def createLobeSegments(self):
+      return self.getParameterNode().GetParameter("CreateLobeSegments") == "true"
+
+    @createLobeSegments.setter
+    def createLobeSegments(self, on):
+        self.getParameterNode().SetParameter("CreateLobeSegments", "true" if on else "false")
+
+    @property
+    def cropToLung(self):
+      return self.getParameterNode().GetParameter("CropToLung") == "true"
+
+    @cropToLung.setter
+    def cropToLung(self, on):
+        self.getParameterNode().SetParameter("CropToLung", "true" if on else "false")
+
+    @property
+    def useResultCache(self):
+      return self.getParameterNode().GetParameter("UseResultCache") == "true"
+
+    @useResultCache.setter
+    def useResultCache(self, on):
+        self.getParameterNode().SetParameter("UseResultCache", "true" if on else "false")
+
     @property
     def areaAnalysis(self):
       return self.getParameterNode().GetParameter("AreaAnalysis") == "true"
@@ -2630,248 +3100,142 @@ class LungCTAnalyzerLogic(ScriptedLoadableModuleLogic):
             parameterNode.SetParameter(parameterName, str(values[parameterName]))
         parameterNode.EndModify(wasModified)
 
-    def trimSegmentWithCube(self, id,r,a,s,offs_r,offs_a,offs_s) :
-        
-
-        self.segmentEditorNode.SetSelectedSegmentID(id)
-        if not self.segmentEditorWidget.effectByName("Surface cut"):
-            slicer.util.errorDisplay("Please install 'SegmentEditorExtraEffects' extension using Extension Manager.")
-            raise ValueError("Installation of 'SegmentEditorExtraEffects' extension required.")
-
-        self.segmentEditorWidget.setActiveEffectByName("Surface cut")
-
-        effect = self.segmentEditorWidget.activeEffect()
-
-        effect.self().fiducialPlacementToggle.placeButton().click()
-        
-        _sv = 50
-        
-        if "dorsal" in id: 
-            right_safety = _sv
-            left_safety = _sv
-            anterior_safety = _sv
-            posterior_safety = 0
-            superior_safety = _sv
-            inferior_safety = _sv
-        if "ventral" in id: 
-            right_safety = _sv
-            left_safety = _sv
-            anterior_safety = 0
-            posterior_safety = _sv
-            superior_safety = _sv
-            inferior_safety = _sv
-        if "upper" in id: 
-            right_safety = _sv
-            left_safety = _sv
-            anterior_safety = _sv
-            posterior_safety = _sv
-            superior_safety = 0
-            inferior_safety = _sv
-        if "middle" in id: 
-            right_safety = _sv
-            left_safety = _sv
-            anterior_safety = _sv
-            posterior_safety = _sv
-            superior_safety = 0
-            inferior_safety = 0
-        if "lower" in id: 
-            right_safety = _sv
-            left_safety = _sv
-            anterior_safety = _sv
-            posterior_safety = _sv
-            superior_safety = _sv
-            inferior_safety = 0
-            
-        # trim with cube
-
-        points =[[r-offs_r-left_safety, a+offs_a+anterior_safety, s+offs_s+superior_safety], [r+offs_r+right_safety, a+offs_a+anterior_safety, s+offs_s+superior_safety],
-                 [r+offs_r+right_safety, a+offs_a+anterior_safety, s-offs_s-inferior_safety], [r-offs_r-left_safety, a+offs_a+anterior_safety, s-offs_s-inferior_safety],
-                 [r-offs_r-left_safety, a-offs_a-posterior_safety, s+offs_s+superior_safety], [r+offs_r+right_safety, a-offs_a-posterior_safety, s+offs_s+superior_safety],
-                 [r+offs_r+right_safety, a-offs_a-posterior_safety, s-offs_s-inferior_safety], [r-offs_r-left_safety, a-offs_a-posterior_safety, s-offs_s-inferior_safety],
-                ]
-
-        for p in points:
-            effect.self().segmentMarkupNode.AddFiducialFromArray(p)
-        
-        effect.setParameter("Operation","ERASE_INSIDE")
-        effect.setParameter("SmoothModel","0")
-
-        effect.self().onApply()
-        
-
-
-    def cropSubSegmentation(self, segmentSrc, sideId, typeStr): 
-
-
-        inputStats = self.inputStats
-        segmentId = sideId + " lung"
-        centroid_ras = inputStats[segmentId,"LabelmapSegmentStatisticsPlugin.centroid_ras"]
-        # get bounding box
+    def createLobeLabelArray(self):
+        """
+        Export the lobe segments of the input segmentation into a single label array.
+        Label value of a voxel is the index of its lobe in self.lobeNames + 1, 0 outside of the lobes.
+        """
         import numpy as np
-        obb_origin_ras = np.array(inputStats[segmentId,"LabelmapSegmentStatisticsPlugin.obb_origin_ras"])
-        obb_diameter_mm = np.array(inputStats[segmentId,"LabelmapSegmentStatisticsPlugin.obb_diameter_mm"])
-        obb_direction_ras_x = np.array(inputStats[segmentId,"LabelmapSegmentStatisticsPlugin.obb_direction_ras_x"])
-        obb_direction_ras_y = np.array(inputStats[segmentId,"LabelmapSegmentStatisticsPlugin.obb_direction_ras_y"])
-        obb_direction_ras_z = np.array(inputStats[segmentId,"LabelmapSegmentStatisticsPlugin.obb_direction_ras_z"])
-        obb_center_ras = obb_origin_ras+0.5*(obb_diameter_mm[0] * obb_direction_ras_x + obb_diameter_mm[1] * obb_direction_ras_y + obb_diameter_mm[2] * obb_direction_ras_z)
-        
-        axialLungDiameter = obb_diameter_mm[0]
-        sagittalLungDiameter = obb_diameter_mm[1]
-        coronalLungDiameter = obb_diameter_mm[2]
-        coronalApex = centroid_ras[2] + (coronalLungDiameter/2.)
-        if typeStr == "ventral": 
-            ####### ventral
-                        
-            r = centroid_ras[0]
-            a = centroid_ras[1] - (sagittalLungDiameter/4.)
-            s = centroid_ras[2]
-            
-            
-            crop_r = (axialLungDiameter/2.)  
-            crop_a = (sagittalLungDiameter/4.)
-            crop_s = (coronalLungDiameter/2.)
-
-            
-            self.showStatusMessage(' Cropping ' + segmentSrc.GetName() +  ' segment ...')
-            self.trimSegmentWithCube(segmentSrc.GetName(),r,a,s,crop_r,crop_a,crop_s)
-
-        elif  typeStr == "dorsal": 
-            ####### dorsal
-            
-            r = centroid_ras[0]
-            a = centroid_ras[1] + (sagittalLungDiameter/4.)
-            s = centroid_ras[2]
-            
-            crop_r = (axialLungDiameter/2.)  
-            crop_a = (sagittalLungDiameter/4.)
-            crop_s = (coronalLungDiameter/2.)
-
-            self.showStatusMessage(' Cropping ' + segmentSrc.GetName() +  ' segment ...')
-            self.trimSegmentWithCube(segmentSrc.GetName(),r,a,s,crop_r,crop_a,crop_s)
-
-        elif  typeStr == "upper half": 
-            ####### upper half
-            
-            r = centroid_ras[0]
-            a = centroid_ras[1] 
-            s = centroid_ras[2] - (coronalLungDiameter/2.)
-            
-            crop_r = axialLungDiameter
-            crop_a = sagittalLungDiameter
-            crop_s = coronalLungDiameter/2.
-
-            self.showStatusMessage(' Cropping ' + segmentSrc.GetName() +  ' segment ...')
-            self.trimSegmentWithCube(segmentSrc.GetName(),r,a,s,crop_r,crop_a,crop_s)
-
-        elif  typeStr == "lower half": 
-            ####### lower half
-            
-            r = centroid_ras[0]
-            a = centroid_ras[1] 
-            s = centroid_ras[2] + (coronalLungDiameter/2.)
-            
-            crop_r = axialLungDiameter
-            crop_a = sagittalLungDiameter
-            crop_s = coronalLungDiameter/2.
-
-            self.showStatusMessage(' Cropping ' + segmentSrc.GetName() +  ' segment ...')
-            self.trimSegmentWithCube(segmentSrc.GetName(),r,a,s,crop_r,crop_a,crop_s)
-
-        elif typeStr == "upper": 
-            ####### upper
-            
-            r = centroid_ras[0]
-            a = centroid_ras[1] 
-            s = coronalApex - ((coronalLungDiameter/3.)*2.)
-            
-            crop_r = (axialLungDiameter/2.)
-            crop_a = (sagittalLungDiameter/2.)
-            crop_s = (coronalLungDiameter/3.)
-
-            self.showStatusMessage(' Cropping ' + segmentSrc.GetName() +  ' segment ...')
-            self.trimSegmentWithCube(segmentSrc.GetName(),r,a,s,crop_r,crop_a,crop_s)
-   
-        elif typeStr == "middle": 
-            ####### middle
-            
-            ####### crop upper part
-            r = centroid_ras[0]
-            a = centroid_ras[1] 
-            s = coronalApex
 
-            
-            crop_r = (axialLungDiameter/2.) 
-            crop_a = (sagittalLungDiameter/2.)
-            crop_s = (coronalLungDiameter/3.)
-
-            self.showStatusMessage(' Cropping ' + segmentSrc.GetName() +  ' segment ...')
-            self.trimSegmentWithCube(segmentSrc.GetName(),r,a,s,crop_r,crop_a,crop_s)
+        lobeSegmentIds = vtk.vtkStringArray()
+        lobeLabelValues = []
+        for lobeIndex, lobeName in enumerate(self.lobeNames):
+            lobeSegmentId = self.inputSegmentation.GetSegmentation().GetSegmentIdBySegmentName(lobeName)
+            if not lobeSegmentId:
+                logging.warning(lobeName + " input segment missing, volumes of this lobe will be zero.")
+                continue
+            lobeSegmentIds.InsertNextValue(lobeSegmentId)
+            lobeLabelValues.append(lobeIndex + 1)
+        if not lobeLabelValues:
+            return np.zeros(self.lungMaskArray.shape, np.uint8)
+
+        lobeLabelVolume = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLLabelMapVolumeNode')
+        slicer.modules.segmentations.logic().ExportSegmentsToLabelmapNode(self.inputSegmentation, lobeSegmentIds, lobeLabelVolume, self.inputVolume)
+        # Map exported label values (1..number of exported lobes) to lobe indices
+        lobeLabelLookup = np.zeros(len(lobeLabelValues) + 1, np.uint8)
+        lobeLabelLookup[1:] = lobeLabelValues
+        lobeLabelArray = lobeLabelLookup[slicer.util.arrayFromVolume(lobeLabelVolume)[self.lungExtent]]
 
-            ####### crop lower part
-            r = centroid_ras[0]
-            a = centroid_ras[1] 
-            s = coronalApex - coronalLungDiameter 
+        # Cleanup
+        lobeLabelColorTable = lobeLabelVolume.GetDisplayNode().GetColorNode()
+        slicer.mrmlScene.RemoveNode(lobeLabelVolume)
+        slicer.mrmlScene.RemoveNode(lobeLabelColorTable)
+        return lobeLabelArray
 
-            crop_r = (axialLungDiameter/2.)  
-            crop_a = (sagittalLungDiameter/2.)
-            crop_s = (coronalLungDiameter/3.)
+    def createLobeClassSegments(self):
+        """
+        Create the lobe segments ("<class> <side> <lobe>") by intersecting the density
+        classification labels with the lobe labels. Only voxels classified on the side of the lobe are kept.
+        """
+        import numpy as np
 
-            self.trimSegmentWithCube(segmentSrc.GetName(),r,a,s,crop_r,crop_a,crop_s)
+        self.showStatusMessage('Creating lobe segments ...')
+        segmentLabelArray = self.segmentLabelArray
+        numberOfClasses = len(self.segmentProperties)
+        lungVoxelIndices = np.flatnonzero(segmentLabelArray)
+        classIndices = segmentLabelArray.reshape(-1)[lungVoxelIndices].astype(np.intp) - 1
+        lobeLabels = self.lobeLabelArray.reshape(-1)[lungVoxelIndices].astype(np.intp)
+
+        segmentNames = []
+        segmentColors = []
+        for lobeName in self.lobeNames:
+            side, lobe = lobeName.split(" ", 1)
+            for segmentProperty in self.segmentProperties:
+                segmentNames.append(f"{segmentProperty['name']} {side} {lobe}")
+                segmentColors.append(segmentProperty['color'])
+
+        # Label value of a lobe segment: lobe index * number of classes + class index
+        lobeSegmentArray = np.zeros(segmentLabelArray.shape, np.uint8)
+        sideOfLobe = np.array([0] + [0 if lobeName.startswith("right") else 1 for lobeName in self.lobeNames])
+        valid = (lobeLabels > 0) & (classIndices // numberOfClasses == sideOfLobe[lobeLabels])
+        lobeSegmentArray.reshape(-1)[lungVoxelIndices[valid]] = (
+            (lobeLabels[valid] - 1) * numberOfClasses + classIndices[valid] % numberOfClasses + 1)
+        self.importSegmentsFromLabelArray(lobeSegmentArray, segmentNames, segmentColors)
+
+    def createRegionSegments(self):
+        """
+        Create the area analysis segments ("<class> <side> <region>") by intersecting the
+        density classification labels with the lung region masks.
+        """
+        import numpy as np
 
-        elif typeStr == "lower": 
-            ####### lower
-            
-            r = centroid_ras[0]
-            a = centroid_ras[1] 
-            s = coronalApex - (coronalLungDiameter/3.)
+        segmentLabelArray = self.segmentLabelArray
+        numberOfClasses = len(self.segmentProperties)
+        lungVoxelIndices = np.flatnonzero(segmentLabelArray)
+        labels = segmentLabelArray.reshape(-1)[lungVoxelIndices]
+
+        regionMasks = self.runNumericStage(LungCTAnalyzerLib.computeLungRegionMasks, lungVoxelIndices, labels <= numberOfClasses,
+            segmentLabelArray.shape, self.getIJKToRASArray(), self.getLungGeometry())
+
+        regionLabelArray = np.zeros(segmentLabelArray.shape, np.uint8)
+        for regionIndex, subSegmentProperty in enumerate(self.subSegmentProperties):
+            region = subSegmentProperty['name']
+            self.getProgressReporter().report('Creating ' + region + ' segments ...', regionIndex / len(self.subSegmentProperties))
+            segmentNames = []
+            segmentColors = []
+            for side in ["right", "left"]:
+                for segmentProperty in self.segmentProperties:
+                    segmentNames.append(f"{segmentProperty['name']} {side} {region}")
+                    segmentColors.append(segmentProperty['color'])
+            regionLabelArray.fill(0)
+            regionVoxels = regionMasks[region]
+            regionLabelArray.reshape(-1)[lungVoxelIndices[regionVoxels]] = labels[regionVoxels]
+            self.importSegmentsFromLabelArray(regionLabelArray, segmentNames, segmentColors)
+
+    def requestCancel(self):
+        """
+        Stop process() at the next stage boundary.
+        """
+        logging.info('Cancelling processing ...')
+        self.cancelRequested = True
 
-            
-            crop_r = (axialLungDiameter/2.)  
-            crop_a = (sagittalLungDiameter/2.)
-            crop_s = (coronalLungDiameter/3.)
+    def runNumericStage(self, function, *args):
+        """
+        Run a computation of process() that does not access the scene (numpy arrays in, numpy arrays out) and
+        return its result. If runInBackground is set, it runs on a worker thread while the main thread keeps
+        processing GUI events, so that the views stay responsive (numpy releases the GIL in array operations).
+        """
+        if not self.runInBackground:
+            return function(*args)
+        import concurrent.futures
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="LungCTAnalyzerProcess") as executor:
+            future = executor.submit(function, *args)
+            while not future.done():
+                slicer.app.processEvents()
+                concurrent.futures.wait([future], timeout=0.05)
+            return future.result()
 
-            self.showStatusMessage(' Cropping ' + segmentSrc.GetName() +  ' segment ...')
-            self.trimSegmentWithCube(segmentSrc.GetName(),r,a,s,crop_r,crop_a,crop_s)
+    def startTimingStage(self, name):
+        """
+        Start measuring the next stage of process() (see stageTimings).
+        """
+        if self.stageTimer:
+            self.stageTimer.startStage(name)
 
+    def saveStageTimings(self, filename, **info):
+        """
+        Write the stage timings of the last process() run to a JSON file.
+        """
+        from LungCTAnalyzerLib import StageTimer
+        StageTimer.writeTimings(filename, self.stageTimings, **info)
 
     def showProgress(self,progressText):
-        if self.showProgressBar:
-            # Update progress value
-            self.progressbar.setValue(self.progress)
-            self.progress += self.progressStep
-            # Update label text
-            self.progressbar.labelText = progressText
-        slicer.app.processEvents()
-        self.showStatusMessage(progressText)
-
-    def subtractSegmentFromSegment(self, segmentationNode, modifierSegmentName, selectedSegmentName):
-        self.showStatusMessage('Subtracting ' + modifierSegmentName + ' from ' + selectedSegmentName + ' ...')
-        modifierSegmentID = segmentationNode.GetSegmentation().GetSegmentIdBySegmentName(modifierSegmentName)
-        selectedSegmentID = segmentationNode.GetSegmentation().GetSegmentIdBySegmentName(selectedSegmentName)
-
-        self.segmentEditorWidget = slicer.qMRMLSegmentEditorWidget()
-        self.segmentEditorWidget.setMRMLScene(slicer.mrmlScene)
-        self.segmentEditorNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLSegmentEditorNode")
-        self.segmentEditorWidget.setMRMLSegmentEditorNode(self.segmentEditorNode)
-        self.segmentEditorWidget.setSegmentationNode(self.inputSegmentation)
-        self.segmentEditorWidget.setSourceVolumeNode(self.maskLabelVolume)
-
-        self.segmentEditorWidget.setSegmentationNode(segmentationNode)
-        self.segmentEditorNode.SetOverwriteMode(slicer.vtkMRMLSegmentEditorNode.OverwriteNone) 
-        self.segmentEditorNode.SetMaskMode(slicer.vtkMRMLSegmentationNode.EditAllowedEverywhere)
-        self.segmentEditorNode.SetSelectedSegmentID(selectedSegmentID)
-        self.segmentEditorWidget.setActiveEffectByName("Logical operators")
-        effect = self.segmentEditorWidget.activeEffect()
-        effect.setParameter("BypassMasking","1")
-        effect.setParameter("ModifierSegmentID",modifierSegmentID)
-        effect.setParameter("Operation","SUBTRACT")
-        effect.self().onApply()
-
-        # Delete temporary segment editor
-        logging.info('Deleting temporary segment editor ... ')
-        self.segmentEditorWidget = None
-        slicer.mrmlScene.RemoveNode(self.segmentEditorNode)    
-        self.segmentEditorNode = None
+        """
+        Start the next stage of process().
+        """
+        if self.cancelRequested:
+            raise UserWarning("User cancelled the analysis.")
+        self.getProgressReporter().startStage(progressText)
 
     def increment_counter(self, counter):
         try:
@@ -2897,6 +3261,28 @@ class LungCTAnalyzerLogic(ScriptedLoadableModuleLogic):
         """
         Run the processing algorithm.
         Can be used without GUI widget.
+        Timings of the stages are recorded in stageTimings, also if processing fails or is cancelled.
+        """
+        # results of an earlier run must not be taken for the results of a failed run
+        self.outputStats = None
+        self.outputSegmentsValid = False
+        self.emphysemaClusters = None
+        from LungCTAnalyzerLib import StageTimer
+        self.stageTimer = StageTimer.StageTimer(self.traceAllocations)
+        self.stageTimings = self.stageTimer.timings
+        try:
+            self.processStages()
+        finally:
+            # the progress dialog is closed also if processing fails or is cancelled
+            self.closeProgressBar()
+            # also stops tracing of memory allocations
+            self.stageTimer.stop()
+            self.stageTimer = None
+        logging.info('Stage timings: ' + ', '.join(f'{name} {timing["wallTimeSec"]:.2f} s' for name, timing in self.stageTimings.items()))
+
+    def processStages(self):
+        """
+        Run the stages of process().
         """
         self.increment_counter('counter_lcta')  # increment counter_lcta
         self.increment_users('lcta')  # increment usage lcta
@@ -2904,17 +3290,24 @@ class LungCTAnalyzerLogic(ScriptedLoadableModuleLogic):
         logging.info('Processing started.')
         import time
         startTime = time.time()
+        self.cancelRequested = False
         if self.showProgressBar:
             # Prevent progress dialog from automatically closing
             self.progressbar = slicer.util.createProgressDialog(parent=slicer.util.mainWindow(), windowTitle='Processing...', autoClose=False)
-            self.progressbar.setCancelButton(None)
+            if self.runInBackground:
+                # views can be used while the analysis is running
+                self.progressbar.setWindowModality(qt.Qt.NonModal)
+                self.progressbar.connect('canceled()', self.requestCancel)
+            else:
+                self.progressbar.setCancelButton(None)
 
-        self.progress =0
-        steps = 7
+        # stages started by showProgress()
+        steps = 5
         if self.areaAnalysis: 
             steps +=1
-            
-        self.progressStep = 100/steps
+        if self.lobeAnalysis:
+            steps +=1
+        self.getProgressReporter().setNumberOfStages(steps)
         self.showProgress("Starting processing ...")
 
         # Validate inputs
@@ -2923,13 +3316,11 @@ class LungCTAnalyzerLogic(ScriptedLoadableModuleLogic):
 
         inputVolume = parameterNode.GetNodeReference("InputVolume")
         if not inputVolume:
-            self.progressbar.close()
             raise ValueError("Input lung CT is invalid.")
 
 
         inputSegmentationNode = parameterNode.GetNodeReference("InputSegmentation")
         if not inputSegmentationNode:
-            self.progressbar.close()
             raise ValueError("Input lung segmentation node is invalid.")
 
         rightMaskSegmentName = inputSegmentationNode.GetSegmentation().GetSegment(self.rightLungMaskSegmentID).GetName().upper()
@@ -2948,15 +3339,83 @@ class LungCTAnalyzerLogic(ScriptedLoadableModuleLogic):
 
  
         self.showProgress("Creating masked volume ...")
+        self.startTimingStage("masked volume")
 
         # create masked volume
-        self.maskLabelVolume = self.createMaskedVolume(keepMaskLabelVolume=True)
+        self.createMaskedVolume()
+
+
+        # Reuse statistics of an earlier analysis of the same data with the same parameters
+        self.lobeLabelArray = None
+        resultCacheKey = None
+        cachedResults = None
+        if self.useResultCache and not self.outputSegmentsRequired:
+            self.startTimingStage("result cache")
+            self.showStatusMessage('Looking up cached results ...')
+            if self.lobeAnalysis:
+                self.lobeLabelArray = self.createLobeLabelArray()
+            resultCacheKey = self.computeResultCacheKey()
+            cachedResults = self.getResultCache().get(resultCacheKey)
+
+        if cachedResults:
+            # segments of an earlier analysis must not be shown or saved with these results
+            logging.info('Using cached results, output segments are removed.')
+            from LungCTAnalyzerLib import ResultCache
+            self.outputStats = ResultCache.decodeStatistics(cachedResults["outputStats"])
+            self.emphysemaClusters = cachedResults["emphysemaClusters"]
+            self.inputStats = None
+            self.segmentLabelArray = None
+            if self.outputSegmentation:
+                self.outputSegmentation.GetSegmentation().RemoveAllSegments()
+        else:
+            self.computeResults()
+            self.outputSegmentsValid = True
+            if resultCacheKey:
+                from LungCTAnalyzerLib import ResultCache
+                self.getResultCache().put(resultCacheKey, {
+                    "outputStats": ResultCache.encodeStatistics(self.outputStats),
+                    "emphysemaClusters": self.emphysemaClusters,
+                    })
 
+        # Compute quantitative results
+        self.showProgress("Creating result tables ...")
+        self.startTimingStage("tables")
+        self.createResultsTable()
+
+        self.showStatusMessage('Calculating statistics ...')
+        self.calculateStatistics()
+        self.showStatusMessage('Creating special table ...')
+        self.createCovidResultsTable()
+        self.createEmphysemaResultsTable()
+        # the preview of the thresholds is superseded by the results
+        self.removeResultsPreviewTables()
+
+        # turn visibility of subregions off if created
+        if self.areaAnalysis == True and self.outputSegmentation: 
+            for segmentProperty in self.segmentProperties:
+                for side in ['left', 'right']:
+                    for region in ['ventral', 'dorsal','upper','middle','lower']: 
+                            segmentName = f"{segmentProperty['name']} {side} {region}"
+                            segID = self.outputSegmentation.GetSegmentation().GetSegmentIdBySegmentName(segmentName)
+                            if segID:
+                                self.outputSegmentation.GetDisplayNode().SetSegmentVisibility(segID,False)
+                        
+        self.getProgressReporter().finish("Processing complete.")
+        stopTime = time.time()
+        logging.info('Processing completed in {0:.2f} seconds'.format(stopTime-startTime))
+        print('Processing completed in {0:.2f} seconds'.format(stopTime-startTime))
+
+    def computeResults(self):
+        """
+        Compute the output segments and their statistics from the masked volume.
+        """
+        inputSegmentationNode = self.inputSegmentation
 
         # Compute centroids
 
         import SegmentStatistics
         self.showProgress("Computing input stats and centroids ...")
+        self.startTimingStage("input stats")
         logging.info("Computing input stats and centroids ...")    
         rightMaskSegmentName = inputSegmentationNode.GetSegmentation().GetSegment(self.rightLungMaskSegmentID).GetName()        
         leftMaskSegmentName = inputSegmentationNode.GetSegmentation().GetSegment(self.leftLungMaskSegmentID).GetName()        
@@ -2984,213 +3443,91 @@ class LungCTAnalyzerLogic(ScriptedLoadableModuleLogic):
         # create main outout segmentation
         # Update progress value
         self.showProgress("Creating thresholded segments ...")
-        self.createThresholdedSegments(self.maskLabelVolume)
-
-
-        self.segmentEditorWidget = slicer.qMRMLSegmentEditorWidget()
-        self.segmentEditorWidget.setMRMLScene(slicer.mrmlScene)
-        self.segmentEditorNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLSegmentEditorNode")
-        self.segmentEditorNode.SetMaskMode(slicer.vtkMRMLSegmentationNode.EditAllowedEverywhere)
-        self.segmentEditorNode.SetOverwriteMode(slicer.vtkMRMLSegmentEditorNode.OverwriteAllSegments)
-        self.segmentEditorWidget.setMRMLSegmentEditorNode(self.segmentEditorNode)
-        self.segmentEditorWidget.setSegmentationNode(self.outputSegmentation)
-        self.segmentEditorWidget.setSourceVolumeNode(self.maskLabelVolume)
-
-        #for side in ['right','left']:
-            # fill holes in vessel segmentations
-            #self.showProgress(f'Filling holes in segment "Vessels {side}" ...')
-            #self.segmentEditorNode.SetSelectedSegmentID(f'Vessels {side}')
-            #self.segmentEditorWidget.setActiveEffectByName("Smoothing")
-            #effect = self.segmentEditorWidget.activeEffect()
-            #effect.setParameter("SmoothingMethod","MORPHOLOGICAL_CLOSING")
-            #spacing = self.inputVolume.GetSpacing()
-            #kernelSize = spacing[0] * 3.
-            #effect.setParameter("KernelSizeMm",str(kernelSize))
-            #effect.self().onApply()
-
-        # Delete temporary segment editor
-        logging.info('Deleting temporary segment editor ... ')
-        self.segmentEditorWidget = None
-        slicer.mrmlScene.RemoveNode(self.segmentEditorNode)    
-        self.segmentEditorNode = None      
-        
+        self.createThresholdedSegments()
+
+        if self.countBullae:
+            self.showStatusMessage('Analyzing emphysema clusters ...')
+            self.startTimingStage("emphysema clusters")
+            self.emphysemaClusters = self.runNumericStage(LungCTAnalyzerLib.computeEmphysemaClusters,
+                self.segmentLabelArray, self.getVoxelVolumeMm3(), len(self.segmentProperties))
+        else:
+            self.emphysemaClusters = None
+
         if self.areaAnalysis == True: 
 
             # split lung into subregions
             self.showProgress("Splitting output segments into subregions ...")
+            self.startTimingStage("region split")
    
-            logging.info('Creating temporary segment editor ... ')
-            self.segmentEditorWidget = slicer.qMRMLSegmentEditorWidget()
-            self.segmentEditorWidget.setMRMLScene(slicer.mrmlScene)
-            self.segmentEditorNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLSegmentEditorNode")
-            self.segmentEditorWidget.setMRMLSegmentEditorNode(self.segmentEditorNode)
-            self.segmentEditorWidget.setSegmentationNode(self.outputSegmentation)
-            self.segmentEditorWidget.setSourceVolumeNode(self.maskLabelVolume)
-
-            for side in ['left', 'right']:
-                for region in ['ventral', 'dorsal', 'upper half', 'lower half', 'upper', 'middle', 'lower']: 
-                    for segmentProperty in self.segmentProperties:
-                        segmentName = f"{segmentProperty['name']} {side}"
-                        sourceSegID = self.outputSegmentation.GetSegmentation().GetSegmentIdBySegmentName(segmentName)
-                        sourceSeg = self.outputSegmentation.GetSegmentation().GetSegment(sourceSegID)
-                        newSegId = self.outputSegmentation.GetSegmentation().AddEmptySegment(segmentName + " " + region,segmentName +" " + region,segmentProperty['color'])
-                        newSeg = self.outputSegmentation.GetSegmentation().GetSegment(newSegId)
-                        newSeg.DeepCopy(sourceSeg)
-                        newSeg.SetName(segmentName + " " + region)
-                        self.outputSegmentation.GetDisplayNode().SetSegmentVisibility(newSeg.GetName(),True)
-                        self.cropSubSegmentation(newSeg, side, region)
-                    
-             # Delete temporary segment editor
-            logging.info('Deleting temporary segment editor ... ')
-            self.segmentEditorWidget = None
-            slicer.mrmlScene.RemoveNode(self.segmentEditorNode)    
-            self.segmentEditorNode = None
+            self.createRegionSegments()
 
         if self.lobeAnalysis == True:
         
-            # copy lobe masks from input to output segmentation
-            self.showProgress("Copying lobe masks ...")
-            numberLobesFound = 0
-            for lobeName in ['right upper lobe', 'right middle lobe', 'right lower lobe', 'left upper lobe', 'left lower lobe' ]:
-                sourceSegID = self.inputSegmentation.GetSegmentation().GetSegmentIdBySegmentName(lobeName)
-                sourceSeg = self.inputSegmentation.GetSegmentation().GetSegment(sourceSegID)
-                if sourceSeg:
-                    numberLobesFound += 1
-                newSegId = self.outputSegmentation.GetSegmentation().AddEmptySegment(lobeName, lobeName)
-                newSeg = self.outputSegmentation.GetSegmentation().GetSegment(newSegId)
-                newSeg.DeepCopy(sourceSeg)
-            
-            lobeName = "upper lobe"
-            side = "right"
-            self.showProgress("Analyzing " + side + " " + lobeName + " ...")
-            for segmentProperty in self.segmentProperties:
-                segmentName = f"{segmentProperty['name']} {side}"
-                sourceSegID = self.outputSegmentation.GetSegmentation().GetSegmentIdBySegmentName(segmentName)
-                sourceSeg = self.outputSegmentation.GetSegmentation().GetSegment(sourceSegID)
-                newSegId = self.outputSegmentation.GetSegmentation().AddEmptySegment(segmentName + " " + lobeName,segmentName,segmentProperty['color'])
-                newSeg = self.outputSegmentation.GetSegmentation().GetSegment(newSegId)
-                newSeg.DeepCopy(sourceSeg)
-                newSeg.SetName(segmentName + " " + lobeName)                
-                self.subtractSegmentFromSegment(self.outputSegmentation, "right lower lobe", segmentName + " " + lobeName)                
-                self.subtractSegmentFromSegment(self.outputSegmentation, "right middle lobe", segmentName + " " + lobeName)                
-                self.outputSegmentation.GetDisplayNode().SetSegmentVisibility(newSeg.GetName(),True)
-
-            lobeName = "middle lobe"
-            side = "right"
-            self.showProgress("Analyzing " + side + " " + lobeName + " ...")
-            for segmentProperty in self.segmentProperties:
-                segmentName = f"{segmentProperty['name']} {side}"
-                sourceSegID = self.outputSegmentation.GetSegmentation().GetSegmentIdBySegmentName(segmentName)
-                sourceSeg = self.outputSegmentation.GetSegmentation().GetSegment(sourceSegID)
-                newSegId = self.outputSegmentation.GetSegmentation().AddEmptySegment(segmentName + " " + lobeName,segmentName,segmentProperty['color'])
-                newSeg = self.outputSegmentation.GetSegmentation().GetSegment(newSegId)
-                newSeg.DeepCopy(sourceSeg)
-                newSeg.SetName(segmentName + " " + lobeName)                
-                self.subtractSegmentFromSegment(self.outputSegmentation, "right upper lobe", segmentName + " " + lobeName)                
-                self.subtractSegmentFromSegment(self.outputSegmentation, "right lower lobe", segmentName + " " + lobeName)                
-                self.outputSegmentation.GetDisplayNode().SetSegmentVisibility(newSeg.GetName(),True)
-
-            lobeName = "lower lobe"
-            side = "right"
-            self.showProgress("Analyzing " + side + " " + lobeName + " ...")
-            for segmentProperty in self.segmentProperties:
-                segmentName = f"{segmentProperty['name']} {side}"
-                sourceSegID = self.outputSegmentation.GetSegmentation().GetSegmentIdBySegmentName(segmentName)
-                sourceSeg = self.outputSegmentation.GetSegmentation().GetSegment(sourceSegID)
-                newSegId = self.outputSegmentation.GetSegmentation().AddEmptySegment(segmentName + " " + lobeName,segmentName,segmentProperty['color'])
-                newSeg = self.outputSegmentation.GetSegmentation().GetSegment(newSegId)
-                newSeg.DeepCopy(sourceSeg)
-                newSeg.SetName(segmentName + " " + lobeName)                
-                self.subtractSegmentFromSegment(self.outputSegmentation, "right upper lobe", segmentName + " " + lobeName)                
-                self.subtractSegmentFromSegment(self.outputSegmentation, "right middle lobe", segmentName + " " + lobeName)                
-                self.outputSegmentation.GetDisplayNode().SetSegmentVisibility(newSeg.GetName(),True)
-
-            lobeName = "upper lobe"
-            side = "left"
-            self.showProgress("Analyzing " + side + " " + lobeName + " ...")
-            for segmentProperty in self.segmentProperties:
-                segmentName = f"{segmentProperty['name']} {side}"
-                sourceSegID = self.outputSegmentation.GetSegmentation().GetSegmentIdBySegmentName(segmentName)
-                sourceSeg = self.outputSegmentation.GetSegmentation().GetSegment(sourceSegID)
-                newSegId = self.outputSegmentation.GetSegmentation().AddEmptySegment(segmentName + " " + lobeName,segmentName,segmentProperty['color'])
-                newSeg = self.outputSegmentation.GetSegmentation().GetSegment(newSegId)
-                newSeg.DeepCopy(sourceSeg)
-                newSeg.SetName(segmentName + " " + lobeName)                
-                self.subtractSegmentFromSegment(self.outputSegmentation, "left lower lobe", segmentName + " " + lobeName)                
-                self.outputSegmentation.GetDisplayNode().SetSegmentVisibility(newSeg.GetName(),True)
-
-            lobeName = "lower lobe"
-            side = "left"
-            self.showProgress("Analyzing " + side + " " + lobeName + " ...")
-            for segmentProperty in self.segmentProperties:
-                segmentName = f"{segmentProperty['name']} {side}"
-                sourceSegID = self.outputSegmentation.GetSegmentation().GetSegmentIdBySegmentName(segmentName)
-                sourceSeg = self.outputSegmentation.GetSegmentation().GetSegment(sourceSegID)
-                newSegId = self.outputSegmentation.GetSegmentation().AddEmptySegment(segmentName + " " + lobeName,segmentName,segmentProperty['color'])
-                newSeg = self.outputSegmentation.GetSegmentation().GetSegment(newSegId)
-                newSeg.DeepCopy(sourceSeg)
-                newSeg.SetName(segmentName + " " + lobeName)                
-                self.subtractSegmentFromSegment(self.outputSegmentation, "left upper lobe", segmentName + " " + lobeName)                
-                self.outputSegmentation.GetDisplayNode().SetSegmentVisibility(newSeg.GetName(),True)
-       
-            # cleanup lobe masks in output segmentation
-            for lobeName in ['right upper lobe', 'right middle lobe', 'right lower lobe', 'left upper lobe', 'left lower lobe' ]:
-                sourceSegID = self.outputSegmentation.GetSegmentation().GetSegmentIdBySegmentName(lobeName)
-                sourceSeg = self.outputSegmentation.GetSegmentation().RemoveSegment(sourceSegID)
-                
-        # Cleanup
-        self.showStatusMessage('Cleaning up ...')
-        self.maskLabelColorTable = self.maskLabelVolume.GetDisplayNode().GetColorNode()
-        slicer.mrmlScene.RemoveNode(self.maskLabelVolume)
-        slicer.mrmlScene.RemoveNode(self.maskLabelColorTable)
-        allModelNodes = slicer.util.getNodes('vtkMRMLModelNode*').values()
-        for ctn in allModelNodes:
-          #logging.info('Name:>' + ctn.GetName()+'<')
-          teststr = ctn.GetName()
-          if 'SegmentEditorSurfaceCutModel' in teststr:
-            #logging.info('Found:' + ctn.GetName())
-            slicer.mrmlScene.RemoveNode(ctn)
-                #break        
-        allMarkupNodes = slicer.util.getNodes('vtkMRMLMarkupsFiducialNode*').values()
-        for ctn in allMarkupNodes:
-          #logging.info('Name:>' + ctn.GetName()+'<')
-          teststr = ctn.GetName()
-          if teststr == "C":
-            #logging.info('Found:' + ctn.GetName())
-            slicer.mrmlScene.RemoveNode(ctn)
-                #break               
+            self.showProgress("Analyzing lobes ...")
+            self.startTimingStage("lobe analysis")
+            if self.lobeLabelArray is None:
+                self.lobeLabelArray = self.createLobeLabelArray()
+            if self.createLobeSegments:
+                self.createLobeClassSegments()
 
-        # Compute quantitative results
-        self.showProgress("Creating result tables ...")
-        self.createResultsTable()
+        self.showStatusMessage('Computing output stats  ...')
+        self.startTimingStage("stats")
+        self.outputStats = self.computeOutputStatistics()
 
-        self.showStatusMessage('Calculating statistics ...')
-        self.calculateStatistics()
-        self.showStatusMessage('Creating special table ...')
-        self.createCovidResultsTable()
-        self.createEmphysemaResultsTable()
+    def getResultCache(self):
+        from LungCTAnalyzerLib import ResultCache
+        return ResultCache.ResultCache(os.path.join(slicer.app.cachePath, "LungCTAnalyzer", "results"),
+            self.resultCacheMaxSizeMB * 1024 * 1024)
 
-        # turn visibility of subregions off if created
-        if self.areaAnalysis == True: 
-            for segmentProperty in self.segmentProperties:
-                for side in ['left', 'right']:
-                    for region in ['ventral', 'dorsal','upper','middle','lower']: 
-                            segmentName = f"{segmentProperty['name']} {side} {region}"
-                            segID = self.outputSegmentation.GetSegmentation().GetSegmentIdBySegmentName(segmentName)
-                            sourceSeg = self.outputSegmentation.GetSegmentation().GetSegment(segID)
-                            self.outputSegmentation.GetDisplayNode().SetSegmentVisibility(sourceSeg.GetName(),False)
-                        
-        # Update progress value
-        self.progress = 99
-        self.showProgress("Processing complete.")
-        slicer.app.processEvents()
-        if self.showProgressBar: 
-            self.progressbar.close()
-        stopTime = time.time()
-        logging.info('Processing completed in {0:.2f} seconds'.format(stopTime-startTime))
-        print('Processing completed in {0:.2f} seconds'.format(stopTime-startTime))
+    def computeResultCacheKey(self):
+        """
+        Get the result cache key of the current analysis: hash of the input voxels and the lung masks
+        in the lung extent (and the lobes if lobe analysis is enabled) and all analysis parameters.
+        """
+        from LungCTAnalyzerLib import ResultCache
+        arrays = [slicer.util.arrayFromVolume(self.inputVolume)[self.lungExtent], self.lungMaskArray, self.getIJKToRASArray()]
+        if self.lobeAnalysis:
+            arrays.append(self.lobeLabelArray)
+        parameters = {
+            "thresholds": self.thresholds,
+            "areaAnalysis": self.areaAnalysis,
+            "lobeAnalysis": self.lobeAnalysis,
+            "countBullae": self.countBullae,
+            "minimumIslandSizeMm3": self.minimumIslandSizeMm3,
+            "segmentProperties": self.segmentProperties,
+            "subSegmentProperties": self.subSegmentProperties,
+            "lobeNames": self.lobeNames,
+            }
+        return ResultCache.computeCacheKey(arrays, parameters)
+
+    def getMaskedVolumeCacheKey(self):
+        """
+        Get a key that changes whenever the masked volume has to be recomputed:
+        when the input volume, the lung mask segments or the crop setting change.
+        """
+        labelmapRepresentationName = slicer.vtkSegmentationConverter.GetBinaryLabelmapRepresentationName()
+        segmentMTimes = []
+        for segmentId in [self.rightLungMaskSegmentID, self.leftLungMaskSegmentID]:
+            segment = self.inputSegmentation.GetSegmentation().GetSegment(segmentId)
+            representation = segment.GetRepresentation(labelmapRepresentationName) if segment else None
+            segmentMTimes.append(representation.GetMTime() if representation else 0)
+        return (self.inputVolume.GetID(), self.inputVolume.GetMTime(), self.inputVolume.GetImageData().GetMTime(),
+            self.inputSegmentation.GetID(), self.rightLungMaskSegmentID, self.leftLungMaskSegmentID, *segmentMTimes,
+            self.lungMaskedVolume.GetID() if self.lungMaskedVolume else None, self.cropToLung)
+
+    def createMaskedVolume(self):
+        """
+        Update the lung masked volume (input volume with voxels outside of the lungs set to -3000)
+        and the lung mask array (self.lungMaskArray, 1 right lung, 2 left lung, in the lung extent).
+        The masked volume is written into the existing image buffer and nothing is recomputed
+        if the input volume and lung segments did not change since the last call.
+        """
+        import numpy as np
+
+        if self.lungMaskArray is not None and self.maskedVolumeCacheKey == self.getMaskedVolumeCacheKey():
+            logging.info('Lung masked volume is up-to-date')
+            return
 
-    def createMaskedVolume(self, keepMaskLabelVolume=False):
         self.showStatusMessage('Creating masked volume ...')
         maskLabelVolume = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLLabelMapVolumeNode')
 
@@ -3202,6 +3539,15 @@ class LungCTAnalyzerLogic(ScriptedLoadableModuleLogic):
         fillValue = -3000  # self.inputVolume.GetImageData().GetScalarRange()[0]  # volume's minimum value
         maskVolumeArray = slicer.util.arrayFromVolume(maskLabelVolume)
 
+        # All further array processing is restricted to the lung extent
+        self.lungExtent = self.computeLungExtent(maskVolumeArray)
+        self.lungMaskArray = maskVolumeArray[self.lungExtent].copy()
+
+        maskLabelColorTable = maskLabelVolume.GetDisplayNode().GetColorNode()
+        slicer.mrmlScene.RemoveNode(maskLabelVolume)
+        slicer.mrmlScene.RemoveNode(maskLabelColorTable)
+        del maskVolumeArray
+
         if not self.lungMaskedVolume:
             self.lungMaskedVolume = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode", "Lung masked volume")
             self.lungMaskedVolume.CreateDefaultDisplayNodes()
@@ -3211,71 +3557,63 @@ class LungCTAnalyzerLogic(ScriptedLoadableModuleLogic):
         self.lungMaskedVolume.SetIJKToRASMatrix(ijkToRas)
         self.lungMaskedVolume.GetDisplayNode().CopyContent(self.inputVolume.GetDisplayNode())
 
-        import numpy as np
+        # Reuse the image buffer of the masked volume if it matches the input volume
+        inputImageData = self.inputVolume.GetImageData()
+        maskedImageData = self.lungMaskedVolume.GetImageData()
+        if (not maskedImageData or maskedImageData.GetDimensions() != inputImageData.GetDimensions()
+            or maskedImageData.GetScalarType() != inputImageData.GetScalarType()
+            or maskedImageData.GetNumberOfScalarComponents() != 1):
+            maskedImageData = vtk.vtkImageData()
+            maskedImageData.SetDimensions(inputImageData.GetDimensions())
+            maskedImageData.AllocateScalars(inputImageData.GetScalarType(), 1)
+            self.lungMaskedVolume.SetAndObserveImageData(maskedImageData)
+
         inputVolumeArray = slicer.util.arrayFromVolume(self.inputVolume)
-        maskedVolumeArray = np.copy(inputVolumeArray)
-        maskedVolumeArray[maskVolumeArray==0] = fillValue
-        slicer.util.updateVolumeFromArray(self.lungMaskedVolume, maskedVolumeArray)
+        maskedVolumeArray = slicer.util.arrayFromVolume(self.lungMaskedVolume)
+        maskedVolumeArray.fill(fillValue)
+        np.copyto(maskedVolumeArray[self.lungExtent], inputVolumeArray[self.lungExtent], where=self.lungMaskArray!=0)
+        slicer.util.arrayFromVolumeModified(self.lungMaskedVolume)
 
-        if keepMaskLabelVolume:
-            return maskLabelVolume
-        else:
-            maskLabelColorTable = maskLabelVolume.GetDisplayNode().GetColorNode()
-            slicer.mrmlScene.RemoveNode(maskLabelVolume)
-            slicer.mrmlScene.RemoveNode(maskLabelColorTable)
+        self.maskedVolumeCacheKey = self.getMaskedVolumeCacheKey()
 
-    def createThresholdedSegments(self, maskLabelVolume):
+    def createThresholdedSegments(self):
  
         self.showStatusMessage('Creating thresholded segments ...')
 
-        # Create color table to store segment names and colors
-        segmentLabelColorTable = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLColorTableNode')
-        segmentLabelColorTable.SetTypeToUser()
-        segmentLabelColorTable.NamesInitialisedOn()
-        segmentLabelColorTable.SetAttribute("Category", "Segmentations")
-        numberOfSegments = len(self.segmentProperties)*2
-        segmentLabelColorTable.SetNumberOfColors(numberOfSegments+1)
-        segmentLabelColorTable.GetLookupTable().SetRange(0, numberOfSegments)
-        segmentLabelColorTable.GetLookupTable().SetNumberOfTableValues(numberOfSegments+1)
-        segmentLabelColorTable.SetColor(0, "Background", 0.0, 0.0, 0.0, 0.0)
-
-        # Create numpy array to store segments
-        import numpy as np
-        maskVolumeArray = slicer.util.arrayFromVolume(maskLabelVolume)
-        inputVolumeArray = slicer.util.arrayFromVolume(self.inputVolume)
-        segmentArray = np.zeros(inputVolumeArray.shape, np.uint8)
+        # Get voxel arrays of lung masks and input volume in the lung extent
+        maskVolumeArray = self.lungMaskArray
+        inputVolumeArray = slicer.util.arrayFromVolume(self.inputVolume)[self.lungExtent]
         thresholds = self.thresholds
-        segmentLabelValue = 0
 
-        # set low emphysema threshold to lowest possible value in maskLabelVolume to avoid missing some very dark bullae
+        # set low emphysema threshold to lowest possible value in input volume to avoid missing some very dark bullae
         logging.info('Low emphysema threshold automatically adjusted to: ' + str(self.inputVolume.GetImageData().GetScalarRange()[0]))
         thresholds['thresholdBullaLower'] = self.inputVolume.GetImageData().GetScalarRange()[0]
-       
 
-        
+        # Label values of the classification: 1..N right lung, N+1..2N left lung
+        segmentNames = []
+        segmentColors = []
         for side in ["right", "left"]:
-            maskLabelValue = 1 if side == "right" else 2
             for segmentProperty in self.segmentProperties:
-                segmentLabelValue += 1
-                segmentName = f"{segmentProperty['name']} {side}"
-                r, g, b = segmentProperty['color']
-                segmentLabelColorTable.SetColor(segmentLabelValue, segmentName, r, g, b, 1.0)
-                lowerThresholdName, upperThresholdName = segmentProperty["thresholds"]
-                segmentArray[np.logical_and(
-                    maskVolumeArray == maskLabelValue,
-                    inputVolumeArray >= thresholds[lowerThresholdName],
-                    inputVolumeArray < thresholds[upperThresholdName])] = segmentLabelValue
-
-        # Create temporary labelmap volume from numpy array
-        segmentLabelVolume = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLLabelMapVolumeNode')
-        slicer.util.updateVolumeFromArray(segmentLabelVolume, segmentArray)
-        ijkToRas = vtk.vtkMatrix4x4()
-        self.inputVolume.GetIJKToRASMatrix(ijkToRas)
-        segmentLabelVolume.SetIJKToRASMatrix(ijkToRas)
-        segmentLabelVolume.CreateDefaultDisplayNodes()
-        segmentLabelVolume.GetDisplayNode().SetAndObserveColorNodeID(segmentLabelColorTable.GetID())
+                segmentNames.append(f"{segmentProperty['name']} {side}")
+                segmentColors.append(segmentProperty['color'])
+
+        # Remove small islands from the classes that request it, in both lungs
+        islandLabels = []
+        for sideIndex, side in enumerate(["right", "left"]):
+            for classIndex, segmentProperty in enumerate(self.segmentProperties):
+                if segmentProperty["removesmallislands"] == "yes":
+                    logging.info(f"Removing small islands in {segmentProperty['name']} {side}")
+                    islandLabels.append(sideIndex * len(self.segmentProperties) + classIndex + 1)
+        minimumSize = max(1, int(round(self.minimumIslandSizeMm3 / self.getVoxelVolumeMm3())))
+
+        self.startTimingStage("thresholding")
+        self.segmentLabelArray = self.runNumericStage(self.classifyLungVoxels, maskVolumeArray, inputVolumeArray, thresholds)
+        if islandLabels:
+            self.startTimingStage("islands")
+            self.runNumericStage(LungCTAnalyzerLib.removeSmallIslands, self.segmentLabelArray, islandLabels, minimumSize)
 
         # Import labelmap volume to segmentation
+        self.startTimingStage("segment import")
         if not self.outputSegmentation:
             self.outputSegmentation = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLSegmentationNode", "Lung analysis segmentation")
             self.outputSegmentation.CreateDefaultDisplayNodes()
@@ -3285,39 +3623,46 @@ class LungCTAnalyzerLogic(ScriptedLoadableModuleLogic):
             segmentationDisplayNode.SetOpacity2DOutline(0.2)
         else:
             self.outputSegmentation.GetSegmentation().RemoveAllSegments()
-        slicer.modules.segmentations.logic().ImportLabelmapToSegmentationNode(segmentLabelVolume, self.outputSegmentation)
-        
-        # Remove small islands
-        # Create temporary segment editor to get access to effects
-        logging.info('Creating temporary segment editor ... ')
-        segmentEditorWidget = slicer.qMRMLSegmentEditorWidget()
-        segmentEditorWidget.setMRMLScene(slicer.mrmlScene)
-        segmentEditorNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLSegmentEditorNode")
-        segmentEditorWidget.setMRMLSegmentEditorNode(segmentEditorNode)
-        segmentEditorWidget.setSegmentationNode(self.outputSegmentation)
-        segmentEditorWidget.setSourceVolumeNode(maskLabelVolume)
-        for side in ["right", "left"]:
-              maskLabelValue = 1 if side == "right" else 2
-              for segmentProperty in self.segmentProperties:
-                  segmentName = f"{segmentProperty['name']} {side}"
-                  if segmentProperty["removesmallislands"] == "yes":
-                      logging.info('Removing small islands in  ' + segmentName)
-                      segmentEditorNode.SetSelectedSegmentID(segmentName)
-                      segmentEditorWidget.setActiveEffectByName("Islands")
-                      effect = segmentEditorWidget.activeEffect()
-                      effect.setParameter("MinimumSize","1000")
-                      effect.setParameter("Operation","REMOVE_SMALL_ISLANDS")
-                      effect.self().onApply()
-        # Delete temporary segment editor
-        logging.info('Deleting temporary segment editor ... ')
-        segmentEditorWidget = None
-        slicer.mrmlScene.RemoveNode(segmentEditorNode)    
+        self.importSegmentsFromLabelArray(self.segmentLabelArray, segmentNames, segmentColors)
+
+    def importSegmentsFromLabelArray(self, labelArray, segmentNames, segmentColors):
+        """
+        Import a label array that has the geometry of the lung extent of the input volume into the output segmentation.
+        Label value i+1 becomes a segment named segmentNames[i] with color segmentColors[i].
+        """
+        # Create color table to store segment names and colors
+        segmentLabelColorTable = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLColorTableNode')
+        segmentLabelColorTable.SetTypeToUser()
+        segmentLabelColorTable.NamesInitialisedOn()
+        segmentLabelColorTable.SetAttribute("Category", "Segmentations")
+        numberOfSegments = len(segmentNames)
+        segmentLabelColorTable.SetNumberOfColors(numberOfSegments+1)
+        segmentLabelColorTable.GetLookupTable().SetRange(0, numberOfSegments)
+        segmentLabelColorTable.GetLookupTable().SetNumberOfTableValues(numberOfSegments+1)
+        segmentLabelColorTable.SetColor(0, "Background", 0.0, 0.0, 0.0, 0.0)
+        for segmentLabelValue, (segmentName, color) in enumerate(zip(segmentNames, segmentColors), start=1):
+            r, g, b = color
+            segmentLabelColorTable.SetColor(segmentLabelValue, segmentName, r, g, b, 1.0)
+
+        # Create temporary labelmap volume from numpy array
+        segmentLabelVolume = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLLabelMapVolumeNode')
+        slicer.util.updateVolumeFromArray(segmentLabelVolume, labelArray)
+        segmentLabelVolume.SetIJKToRASMatrix(slicer.util.vtkMatrixFromArray(self.getIJKToRASArray()))
+        segmentLabelVolume.CreateDefaultDisplayNodes()
+        segmentLabelVolume.GetDisplayNode().SetAndObserveColorNodeID(segmentLabelColorTable.GetID())
 
+        slicer.modules.segmentations.logic().ImportLabelmapToSegmentationNode(segmentLabelVolume, self.outputSegmentation)
 
         # Cleanup
         slicer.mrmlScene.RemoveNode(segmentLabelVolume)
         slicer.mrmlScene.RemoveNode(segmentLabelColorTable)
 
+    def classifyLungVoxels(self, maskVolumeArray, inputVolumeArray, thresholds, segmentArray=None):
+        """
+        Label every lung voxel with its density class (see LungCTAnalyzerLib.classifyLungVoxels).
+        """
+        return LungCTAnalyzerLib.classifyLungVoxels(maskVolumeArray, inputVolumeArray, thresholds, self.segmentProperties, segmentArray)
+
     def showTable(self, tableNode):
         currentLayout = slicer.app.layoutManager().layout
         layoutWithTable = slicer.modules.tables.logic().GetLayoutWithTable(currentLayout)
@@ -3345,8 +3690,292 @@ class LungCTAnalyzerTest(ScriptedLoadableModuleTest):
         """Run as few or as many tests as needed here.
         """
         self.setUp()
+        self.test_LungCTAnalyzerClassifier()
+        self.test_LungCTAnalyzerCore()
+        self.test_LungCTAnalyzerResultCache()
+        self.test_LungCTAnalyzerResultsDatabase()
+        self.test_LungCTAnalyzerResultsSink()
+        self.test_LungCTAnalyzerLabelExport()
+        self.test_LungCTAnalyzerMrbReader()
+        self.test_LungCTAnalyzerProgressReporter()
+        self.test_LungCTAnalyzerStageTimer()
         self.test_LungCTAnalyzer1()
 
+    def test_LungCTAnalyzerClassifier(self):
+        """ Check the single pass density classifier against a per class reference computation.
+        """
+
+        self.delayDisplay("Starting the classifier test")
+
+        import numpy as np
+        logic = LungCTAnalyzerLogic()
+        rng = np.random.default_rng(0)
+        inputVolumeArray = rng.integers(-1100, 3100, (20, 30, 40)).astype(np.int16)
+        maskVolumeArray = rng.integers(0, 3, (20, 30, 40)).astype(np.uint8)
+        thresholds = dict(logic.defaultThresholds)
+        thresholds['thresholdBullaLower'] = float(inputVolumeArray.min())
+
+        segmentArray = logic.classifyLungVoxels(maskVolumeArray, inputVolumeArray, thresholds)
+
+        expectedArray = np.zeros(inputVolumeArray.shape, np.uint8)
+        segmentLabelValue = 0
+        for maskLabelValue in [1, 2]:
+            for segmentProperty in logic.segmentProperties:
+                segmentLabelValue += 1
+                lowerThresholdName, upperThresholdName = segmentProperty["thresholds"]
+                expectedArray[(maskVolumeArray == maskLabelValue)
+                    & (inputVolumeArray >= thresholds[lowerThresholdName])
+                    & (inputVolumeArray < thresholds[upperThresholdName])] = segmentLabelValue
+        self.assertTrue(np.array_equal(segmentArray, expectedArray))
+
+        self.delayDisplay('Test passed')
+
+    def test_LungCTAnalyzerCore(self):
+        """ Check the array-level analysis on a synthetic volume with known class volumes.
+        """
+
+        self.delayDisplay("Starting the analysis core test")
+
+        import numpy as np
+        ctArray = np.full((20, 30, 40), -1000, np.int16)
+        maskArray = np.zeros(ctArray.shape, np.uint8)
+        maskArray[2:18, 5:25, 2:18] = 1
+        maskArray[2:18, 5:25, 22:38] = 2
+        # Inflated lung with an infiltrated block in the right lung
+        ctArray[maskArray > 0] = -850
+        ctArray[2:10, 5:25, 2:18] = -500
+        ijkToRas = LungCTAnalyzerLib.ijkToRasMatrix([0.5, 1.0, 2.0])
+
+        analysis = LungCTAnalyzerLib.analyzeLung(ctArray, maskArray, ijkToRas, areaAnalysis=True)
+        results = analysis["results"]
+        self.assertAlmostEqual(results["infRightLung"], 8 * 20 * 16 * 0.5 * 1.0 * 2.0 / 1000.)
+        self.assertAlmostEqual(results["rightLungVolume"], 16 * 20 * 16 * 0.5 * 1.0 * 2.0 / 1000.)
+        self.assertAlmostEqual(results["venLeftLung"], results["leftLungVolume"])
+        self.assertEqual(results["infiltratedRightVolumePerc"], 50.)
+        stats = analysis["statistics"]
+        self.assertEqual(stats["Infiltration right", "ScalarVolumeSegmentStatisticsPlugin.mean"], -500.)
+        self.assertEqual(stats["Inflated left", "ScalarVolumeSegmentStatisticsPlugin.min"], -850.)
+        self.assertEqual(stats["Inflated left", "ScalarVolumeSegmentStatisticsPlugin.max"], -850.)
+        self.assertEqual(analysis["regionResults"]["upper half"]["infiltratedResultRightVolume"], 0.)
+        # Processing the lung extent only must not change the results
+        self.assertEqual(LungCTAnalyzerLib.analyzeLung(ctArray, maskArray, ijkToRas, areaAnalysis=True, cropMargin=None)["results"], results)
+        # A single vessel voxel is removed as a small island if the vessel class requests it
+        ctArray[12, 10, 25] = 100
+        self.assertAlmostEqual(LungCTAnalyzerLib.analyzeLung(ctArray, maskArray, ijkToRas)["results"]["vesLeftLung"], 0.001)
+        islandSegmentProperties = [dict(segmentProperty, removesmallislands="yes") if segmentProperty["name"] == "Vessels" else segmentProperty
+            for segmentProperty in LungCTAnalyzerLib.segmentProperties]
+        self.assertEqual(LungCTAnalyzerLib.analyzeLung(ctArray, maskArray, ijkToRas,
+            segmentProperties=islandSegmentProperties)["results"]["vesLeftLung"], 0.)
+
+        self.delayDisplay('Test passed')
+
+    def test_LungCTAnalyzerResultCache(self):
+        """ Check that cached statistics are restored unchanged and the cache size is limited.
+        """
+
+        self.delayDisplay("Starting the result cache test")
+
+        import numpy as np
+        import tempfile
+        from LungCTAnalyzerLib import ResultCache
+        ctArray = np.full((10, 10, 10), -850, np.int16)
+        maskArray = np.ones(ctArray.shape, np.uint8)
+        ijkToRas = LungCTAnalyzerLib.ijkToRasMatrix([1.0, 1.0, 1.0])
+        stats = LungCTAnalyzerLib.analyzeLung(ctArray, maskArray, ijkToRas)["statistics"]
+
+        key = ResultCache.computeCacheKey([ctArray, maskArray], {"thresholds": LungCTAnalyzerLib.defaultThresholds})
+        ctArray[0, 0, 0] = -900
+        self.assertNotEqual(ResultCache.computeCacheKey([ctArray, maskArray], {"thresholds": LungCTAnalyzerLib.defaultThresholds}), key)
+
+        with tempfile.TemporaryDirectory() as cacheDir:
+            cache = ResultCache.ResultCache(cacheDir)
+            self.assertIsNone(cache.get(key))
+            cache.put(key, {"outputStats": ResultCache.encodeStatistics(stats)})
+            self.assertEqual(ResultCache.decodeStatistics(cache.get(key)["outputStats"]), stats)
+            # the entry does not fit into a zero size cache
+            cache.maxSizeBytes = 0
+            cache.evict()
+            self.assertIsNone(cache.get(key))
+
+        self.delayDisplay('Test passed')
+
+    def test_LungCTAnalyzerResultsDatabase(self):
+        """ Check that cohort queries of the results database return the stored volumes and reruns replace results.
+        """
+
+        self.delayDisplay("Starting the results database test")
+
+        import os
+        import tempfile
+        from LungCTAnalyzerLib import ResultsDatabase
+        volumes = {"Inflated right": 900., "Emphysema right": 100., "Inflated left": 1000.}
+        records = ResultsDatabase.lungVolumeRecords(volumes)
+        self.assertIn(("lung", "right", "emphysema", 100., 10.), records)
+
+        with tempfile.TemporaryDirectory() as outputDir:
+            with ResultsDatabase.ResultsDatabase(os.path.join(outputDir, ResultsDatabase.databaseFilename)) as resultsDatabase:
+                resultsDatabase.addRun("LungCTAnalyzer", "/data/case1/ct_seg.mrb", "case1", 1, {"countBullae": False}, records)
+                resultsDatabase.addRun("LungCTAnalyzer", "/data/case2/ct_seg.mrb", "case2", 2, {"countBullae": False},
+                    ResultsDatabase.lungVolumeRecords({"Inflated right": 1000., "Inflated left": 1000.}))
+                # rerun of case 1 replaces its results
+                resultsDatabase.addRun("LungCTAnalyzer", "/data/case1/ct_seg.mrb", "case1", 1, {"countBullae": False}, records)
+                result = resultsDatabase.volumes("emphysema", side="right", minPercent=5.)
+                self.assertEqual(list(result["caseName"]), ["case1"])
+                self.assertEqual(list(result["volumeMl"]), [100.])
+                self.assertEqual(len(resultsDatabase.volumes("emphysema")["percent"]), 2)
+
+        self.delayDisplay('Test passed')
+
+    def test_LungCTAnalyzerResultsSink(self):
+        """ Check that flushed rows of a rerun case replace its old rows and that changed columns start a new file.
+        """
+
+        self.delayDisplay("Starting the results sink test")
+
+        import glob
+        import os
+        import tempfile
+        from LungCTAnalyzerLib import ResultsSink
+        with tempfile.TemporaryDirectory() as outputDir:
+            resultsSink = ResultsSink.ResultsSink(outputDir)
+            resultsSink.addRow("results.csv", ["file", "case", "total ml"], ["/data/case2/ct.mrb", 2, 4000])
+            resultsSink.addRow("results.csv", ["file", "case", "total ml"], ["/data/case1/ct.mrb", 1, 5000])
+            resultsSink.addRow("results.csv", ["file", "case", "total ml"], ["/data/case3/ct.mrb", 3, 4500])
+            resultsSink.discardRows("/data/case3/ct.mrb")
+            resultsSink.flush()
+            resultsSink.addRow("results.csv", ["file", "case", "total ml"], ["/data/case1/ct.mrb", 1, 5100])
+            resultsSink.flush()
+            header, rows = ResultsSink.readCsv(os.path.join(outputDir, "results.csv"))
+            self.assertEqual(header, ["file", "case", "total ml"])
+            self.assertEqual(rows, [["/data/case1/ct.mrb", "1", "5100"], ["/data/case2/ct.mrb", "2", "4000"]])
+
+            with self.assertRaises(ValueError):
+                resultsSink.addRow("results.csv", ["file", "case", "total ml"], ["/data/case3/ct.mrb", 3, 4500])
+                resultsSink.addRow("results.csv", ["file", "case", "total ml", "bullae ml"], ["/data/case4/ct.mrb", 4, 4500, 10])
+            resultsSink.discardRows("/data/case3/ct.mrb")
+            resultsSink.addRow("results.csv", ["file", "case", "total ml", "bullae ml"], ["/data/case4/ct.mrb", 4, 4500, 10])
+            resultsSink.flush()
+            header, rows = ResultsSink.readCsv(os.path.join(outputDir, "results.csv"))
+            self.assertEqual(len(header), 4)
+            self.assertEqual(rows, [["/data/case4/ct.mrb", "4", "4500", "10"]])
+            self.assertEqual(len(glob.glob(os.path.join(outputDir, "results.*.csv"))), 1)
+
+            # appended rows do not change existing rows
+            ResultsSink.appendRow(os.path.join(outputDir, "extended.csv"), ["file", "case"], ["/data/case2/ct.mrb", 2])
+            ResultsSink.appendRow(os.path.join(outputDir, "extended.csv"), ["file", "case"], ["/data/case1/ct.mrb", 1])
+            header, rows = ResultsSink.readCsv(os.path.join(outputDir, "extended.csv"))
+            self.assertEqual(rows, [["/data/case2/ct.mrb", "2"], ["/data/case1/ct.mrb", "1"]])
+
+        self.delayDisplay('Test passed')
+
+    def test_LungCTAnalyzerLabelExport(self):
+        """ Check that non-overlapping label layers share a multi-label volume and overlapping layers do not.
+        """
+
+        self.delayDisplay("Starting the label export test")
+
+        import numpy as np
+        from LungCTAnalyzerLib import LabelExport
+        classArray = np.zeros((4, 5, 6), np.uint8)
+        classArray[:, :, :3] = 1
+        classArray[:, :, 3:] = 2
+        ventralArray = np.zeros(classArray.shape, np.uint8)
+        ventralArray[:2] = classArray[:2]
+        dorsalArray = np.zeros(classArray.shape, np.uint8)
+        dorsalArray[2:] = classArray[2:]
+        merger = LabelExport.LabelVolumeMerger()
+        merger.addLayer(classArray, [("Inflated right", (0., 0.5, 1.)), ("Inflated left", (0., 0.5, 1.))])
+        merger.addLayer(ventralArray, [("Inflated right ventral", (0., 0.5, 1.)), ("Inflated left ventral", (0., 0.5, 1.))])
+        merger.addLayer(dorsalArray, [("Inflated right dorsal", (0., 0.5, 1.)), ("Inflated left dorsal", (0., 0.5, 1.))])
+
+        self.assertEqual(len(merger.volumes), 2)
+        regionArray, regionSegments = merger.volumes[1]
+        self.assertEqual(regionArray.dtype, np.uint8)
+        self.assertEqual([name for name, color in regionSegments][regionArray[3, 0, 5] - 1], "Inflated left dorsal")
+        self.assertTrue(np.array_equal(regionArray > 0, classArray > 0))
+
+        self.delayDisplay('Test passed')
+
+    def test_LungCTAnalyzerMrbReader(self):
+        """ Check that only the data files of the requested nodes are read from a scene bundle.
+        """
+
+        self.delayDisplay("Starting the scene bundle reader test")
+
+        import tempfile
+        import zipfile
+        from LungCTAnalyzerLib import MrbReader
+        sceneXml = ('<MRML version="Slicer4.4.0">'
+            '<VolumeArchetypeStorage id="vtkMRMLVolumeArchetypeStorageNode1" fileName="Data/CT.nrrd"/>'
+            '<Volume id="vtkMRMLScalarVolumeNode1" name="CT" references="storage:vtkMRMLVolumeArchetypeStorageNode1;"/>'
+            '<SegmentationStorage id="vtkMRMLSegmentationStorageNode1" fileName="Data/Lung%20segmentation.seg.nrrd"/>'
+            '<Segmentation id="vtkMRMLSegmentationNode1" name="Lung%20segmentation" references="storage:vtkMRMLSegmentationStorageNode1;"/>'
+            '<SegmentationStorage id="vtkMRMLSegmentationStorageNode2" fileName="Data/TotalSegmentator.seg.nrrd"/>'
+            '<Segmentation id="vtkMRMLSegmentationNode2" name="TotalSegmentator" references="storage:vtkMRMLSegmentationStorageNode2;"/>'
+            '</MRML>')
+        with tempfile.TemporaryDirectory() as tempDir:
+            with zipfile.ZipFile(tempDir + "/ct_seg.mrb", "w") as mrb:
+                mrb.writestr("ct_seg/ct_seg.mrml", sceneXml)
+                mrb.writestr("ct_seg/Data/CT.nrrd", "CT")
+                mrb.writestr("ct_seg/Data/Lung segmentation.seg.nrrd", "Lung segmentation")
+                mrb.writestr("ct_seg/Data/TotalSegmentator.seg.nrrd", "TotalSegmentator")
+            nodeFiles = MrbReader.extractNodeFiles(tempDir + "/ct_seg.mrb", LungCTAnalyzerLogic().getBatchCaseInputNodes(), tempDir + "/extracted")
+
+            self.assertEqual(sorted(nodeFiles.keys()), ["CT", "Lung segmentation"])
+            with open(nodeFiles["Lung segmentation"]) as f:
+                self.assertEqual(f.read(), "Lung segmentation")
+            self.assertEqual(len(os.listdir(tempDir + "/extracted")), 2)
+
+        self.delayDisplay('Test passed')
+
+    def test_LungCTAnalyzerProgressReporter(self):
+        """ Check that messages within a stage are rate limited and stage starts are always shown.
+        """
+
+        self.delayDisplay("Starting the progress reporter test")
+
+        from LungCTAnalyzerLib import ProgressReporter
+        updates = []
+        progressReporter = ProgressReporter.ProgressReporter(lambda message, fraction: updates.append((message, fraction)), minIntervalSec=60.)
+        progressReporter.setNumberOfStages(4)
+        progressReporter.startStage("Stage 1")
+        for regionIndex in range(70):
+            progressReporter.report(f"Region {regionIndex}", regionIndex / 70)
+        progressReporter.startStage("Stage 2")
+        progressReporter.finish("Done")
+
+        self.assertEqual(updates, [("Stage 1", 0.), ("Stage 2", 0.25), ("Done", 1.)])
+
+        self.delayDisplay('Test passed')
+
+    def test_LungCTAnalyzerStageTimer(self):
+        """ Check that timings of repeated stages are accumulated and CSV columns do not depend on the stages that ran.
+        """
+
+        self.delayDisplay("Starting the stage timer test")
+
+        import numpy as np
+        from LungCTAnalyzerLib import StageTimer
+        stageTimer = StageTimer.StageTimer(traceAllocations=True)
+        stageTimer.startStage("allocate")
+        array = np.ones(2**21)
+        stageTimer.startStage("sum")
+        array.sum()
+        stageTimer.startStage("allocate")
+        array = np.ones(2**20)
+        timings = stageTimer.stop()
+
+        self.assertEqual(list(timings.keys()), ["allocate", "sum", "total"])
+        self.assertGreaterEqual(timings["total"]["wallTimeSec"], timings["allocate"]["wallTimeSec"] + timings["sum"]["wallTimeSec"])
+        # 16 MB array
+        self.assertGreater(timings["allocate"]["allocatedPeakMB"], 15.)
+        header, row = StageTimer.getCsvColumns(timings, ["allocate", "sum", "islands"])
+        self.assertEqual(len(header), 12)
+        self.assertEqual(header[6:9], ["islands s", "islands cpu s", "islands peak rss MB"])
+        self.assertEqual(row[6:9], ["", "", ""])
+
+        self.delayDisplay('Test passed')
+
     def test_LungCTAnalyzer1(self):
         """ Ideally you should have several levels of tests.  At the lowest level
         tests should exercise the functionality of the logic with different inputs
@@ -3381,4 +4010,16 @@ class LungCTAnalyzerTest(ScriptedLoadableModuleTest):
         logic.process() # 3D
         self.delayDisplay('Processing ends.')
 
+        # Timings of each stage that ran and of the whole processing
+        for stageName in ["masked volume", "thresholding", "stats", "tables", "total"]:
+            self.assertGreaterEqual(logic.stageTimings[stageName]["wallTimeSec"], 0.)
+
+        # Minimal output keeps only the segmentations and results tables
+        import tempfile
+        with tempfile.TemporaryDirectory() as targetdir:
+            logic.saveBatchCaseOutputs(targetdir + "/", minimalOutput=True)
+            self.assertTrue(os.path.isfile(targetdir + "/ct_seg_analyzed.mrb"))
+        self.assertEqual(len(slicer.util.getNodesByClass("vtkMRMLScalarVolumeNode")), 0)
+        self.assertIsNotNone(logic.outputSegmentation)
+
         self.delayDisplay('Test passed')
@@ -0,0 +1,642 @@
+"""
+Array-level lung CT analysis.
+
+This module only depends on numpy (and scipy.ndimage for connected components, which is
+bundled with Slicer), therefore it can be used outside of the Slicer scene,
+for example in plain Python worker processes. All volumes are numpy arrays in KJI order
+(as returned by slicer.util.arrayFromVolume) and geometry is described by a 4x4 IJK to RAS matrix.
+LungCTAnalyzerLogic uses these functions on the arrays of its MRML nodes.
+"""
+
+import numpy as np
+
+defaultThresholds = {
+    'thresholdBullaLower': -1050.,
+    'thresholdBullaInflated': -950.,
+    'thresholdInflatedInfiltrated': -750.,
+    'thresholdInfiltratedCollapsed': -400.,
+    'thresholdCollapsedVessels': 0.,
+    'thresholdVesselsUpper': 3000.,
+    }
+
+segmentProperties = [
+    {"name": "Emphysema", "color": [0.0,0.5,0.0], "thresholds": ['thresholdBullaLower', 'thresholdBullaInflated'],"removesmallislands":"no"},
+    {"name": "Inflated", "color": [0.0,0.5,1.0], "thresholds": ['thresholdBullaInflated', 'thresholdInflatedInfiltrated'],"removesmallislands":"no"},
+    {"name": "Infiltration", "color": [1.0,0.5,0.0], "thresholds": ['thresholdInflatedInfiltrated', 'thresholdInfiltratedCollapsed'],"removesmallislands":"no"},
+    {"name": "Collapsed", "color": [1.0,0.0,1.0], "thresholds": ['thresholdInfiltratedCollapsed', 'thresholdCollapsedVessels'],"removesmallislands":"no"},
+    {"name": "Vessels", "color": [1.0,0.0,0.0], "thresholds": ['thresholdCollapsedVessels', 'thresholdVesselsUpper'],"removesmallislands":"no"},
+    ]
+
+subSegmentProperties = [
+    {"name": "ventral", "color": [0.0,0.0,0.0]},
+    {"name": "dorsal","color": [0.0,0.0,0.0]},
+    {"name": "upper half","color": [0.0,0.0,0.0]},
+    {"name": "lower half","color": [0.0,0.0,0.0]},
+    {"name": "upper","color": [0.0,0.0,0.0]},
+    {"name": "middle","color": [0.0,0.0,0.0]},
+    {"name": "lower","color": [0.0,0.0,0.0]},
+    ]
+
+lobeNames = ['right upper lobe', 'right middle lobe', 'right lower lobe', 'left upper lobe', 'left lower lobe']
+
+# Upper limits of the emphysema cluster size histogram bins in mm3, the last bin is open ended
+emphysemaClusterSizeBinsMm3 = [10., 100., 1000., 10000.]
+
+# Number of voxels processed at once when iterating over a volume slab by slab
+slabVoxelCount = 1 << 24
+
+
+def ijkToRasMatrix(spacing, origin=(0., 0., 0.), directions=((1., 0., 0.), (0., 1., 0.), (0., 0., 1.))):
+    """
+    Create a 4x4 IJK to RAS matrix from spacing, origin and IJK to RAS direction matrix
+    (same convention as vtkMRMLVolumeNode::GetIJKToRASDirections).
+    """
+    ijkToRas = np.eye(4)
+    ijkToRas[:3, :3] = np.array(directions, dtype=np.float64) * np.array(spacing, dtype=np.float64)
+    ijkToRas[:3, 3] = origin
+    return ijkToRas
+
+
+def computeBoundingBox(maskArray, margin=0):
+    """
+    Compute the bounding box of the nonzero voxels of maskArray, extended by margin voxels
+    on each side and clipped to the array.
+    Returns a tuple of slices in KJI order that can be used for indexing, or None if maskArray is empty.
+    """
+    sliceProfile = np.flatnonzero(maskArray.any(axis=(1, 2)))
+    if len(sliceProfile) == 0:
+        return None
+    # Only the slices that contain lung voxels are scanned for the row and column ranges
+    slab = maskArray[sliceProfile[0]:sliceProfile[-1] + 1]
+    profiles = [sliceProfile, np.flatnonzero(slab.any(axis=(0, 2))), np.flatnonzero(slab.any(axis=(0, 1)))]
+    return tuple(slice(int(max(profile[0] - margin, 0)), int(min(profile[-1] + 1 + margin, size)))
+        for profile, size in zip(profiles, maskArray.shape))
+
+
+def cropIJKToRAS(ijkToRas, extent):
+    """
+    Get the IJK to RAS matrix of the sub-volume specified by extent (tuple of slices in KJI order).
+    """
+    ijkToRas = np.array(ijkToRas, dtype=np.float64)
+    if extent is None:
+        return ijkToRas
+    offsetIjk = [(extent[axis].start or 0) for axis in [2, 1, 0]]
+    ijkToRas[:3, 3] += ijkToRas[:3, :3] @ offsetIjk
+    return ijkToRas
+
+
+def classifyLungVoxels(maskArray, ctArray, thresholds, segmentProperties=segmentProperties, segmentArray=None):
+    """
+    Label every lung voxel with its density class in a single pass over the lung voxels.
+    maskArray contains 1 for right lung and 2 for left lung voxels.
+    Labels 1..N are the segment properties of the right lung, N+1..2N the ones of the left lung,
+    voxels outside of the lungs or outside of all threshold ranges are set to 0.
+    Results are written into segmentArray (uint8) if specified, otherwise a new array is returned.
+    """
+    numberOfClasses = len(segmentProperties)
+
+    # Class boundaries in ascending order: lower threshold of each class followed by the upper threshold of the last one.
+    # A voxel belongs to class i if boundaries[i-1] <= value < boundaries[i].
+    boundaries = [thresholds[segmentProperty["thresholds"][0]] for segmentProperty in segmentProperties]
+    boundaries.append(thresholds[segmentProperties[-1]["thresholds"][1]])
+    boundaries = np.array(boundaries, dtype=np.float64)
+
+    if segmentArray is None:
+        segmentArray = np.zeros(maskArray.shape, np.uint8)
+    else:
+        segmentArray.fill(0)
+
+    lungVoxelIndices = np.flatnonzero(maskArray)
+    sides = maskArray.reshape(-1)[lungVoxelIndices].astype(np.intp)
+    classIndices = np.searchsorted(boundaries, ctArray.reshape(-1)[lungVoxelIndices], side='right')
+    valid = (classIndices >= 1) & (classIndices <= numberOfClasses) & (sides <= 2)
+    labels = classIndices + (sides - 1) * numberOfClasses
+    segmentArray.reshape(-1)[lungVoxelIndices[valid]] = labels[valid]
+    return segmentArray
+
+
+def removeSmallIslands(segmentArray, labels, minimumSize):
+    """
+    Remove connected components (face connectivity, as in the Islands segment editor effect)
+    of the specified label values that are smaller than minimumSize voxels. segmentArray is modified in place.
+    All components of a label are found in one labeling pass and their sizes are counted with bincount.
+    Returns the number of removed voxels.
+    """
+    from scipy import ndimage
+    numberOfRemovedVoxels = 0
+    for label in labels:
+        componentArray, numberOfComponents = ndimage.label(segmentArray == label)
+        if numberOfComponents == 0:
+            continue
+        smallComponents = np.bincount(componentArray.reshape(-1)) < minimumSize
+        smallComponents[0] = False
+        smallComponentVoxels = smallComponents[componentArray]
+        segmentArray[smallComponentVoxels] = 0
+        numberOfRemovedVoxels += np.count_nonzero(smallComponentVoxels)
+    return numberOfRemovedVoxels
+
+
+def computePowerLawExponent(clusterSizes):
+    """
+    Compute the exponent D of the power law Y = K * X^-D fitted to the cumulative size distribution
+    of clusters (Y is the number of clusters with size >= X), as proposed by Mishima et al. (PNAS 1999)
+    for low attenuation areas. Returns 0 if there are less than two different cluster sizes.
+    """
+    uniqueSizes, counts = np.unique(clusterSizes, return_counts=True)
+    if len(uniqueSizes) < 2:
+        return 0.
+    cumulativeCounts = np.cumsum(counts[::-1])[::-1]
+    slope = np.polyfit(np.log10(uniqueSizes), np.log10(cumulativeCounts), 1)[0]
+    return float(-slope)
+
+
+def computeEmphysemaClusters(segmentArray, voxelVolumeMm3, numberOfClasses=len(segmentProperties), emphysemaClassIndex=0):
+    """
+    Analyze the connected components (clusters) of the emphysema class (low attenuation areas) of both lungs
+    with a single labeling pass. Cluster sizes are counted with bincount, a cluster that crosses
+    from one lung to the other counts as one cluster in each lung.
+    Returns a dict that maps "right", "left" and "total" to a dict of "count" (number of clusters),
+    "largestMm3" (size of the largest cluster), "histogram" (number of clusters in the size bins
+    defined by emphysemaClusterSizeBinsMm3) and "D" (power law exponent of the cluster size distribution).
+    """
+    from scipy import ndimage
+    rightLabel = emphysemaClassIndex + 1
+    leftLabel = rightLabel + numberOfClasses
+    componentArray, numberOfComponents = ndimage.label((segmentArray == rightLabel) | (segmentArray == leftLabel))
+    clusterVoxelIndices = np.flatnonzero(componentArray)
+    components = componentArray.reshape(-1)[clusterVoxelIndices].astype(np.intp)
+    isLeft = segmentArray.reshape(-1)[clusterVoxelIndices] == leftLabel
+    del componentArray, clusterVoxelIndices
+
+    # Size of each (component, side) in mm3
+    sizes = np.bincount(components * 2 + isLeft, minlength=2 * (numberOfComponents + 1)).reshape(-1, 2)[1:] * voxelVolumeMm3
+    clusterSizes = {
+        "right": sizes[:, 0][sizes[:, 0] > 0],
+        "left": sizes[:, 1][sizes[:, 1] > 0],
+        }
+    clusterSizes["total"] = np.concatenate([clusterSizes["right"], clusterSizes["left"]])
+
+    histogramBins = [0.] + emphysemaClusterSizeBinsMm3 + [np.inf]
+    clusters = {}
+    for side, sideClusterSizes in clusterSizes.items():
+        clusters[side] = {
+            "count": len(sideClusterSizes),
+            "largestMm3": float(sideClusterSizes.max()) if len(sideClusterSizes) else 0.,
+            "histogram": np.histogram(sideClusterSizes, bins=histogramBins)[0].tolist(),
+            "D": computePowerLawExponent(sideClusterSizes),
+            }
+    return clusters
+
+
+def emphysemaClusterSizeBinNames():
+    """
+    Get the names of the emphysema cluster size histogram bins, for example "10-100 mm3".
+    """
+    limits = [f"{limit:g}" for limit in emphysemaClusterSizeBinsMm3]
+    return [f"<{limits[0]} mm3"] + [f"{lower}-{upper} mm3" for lower, upper in zip(limits[:-1], limits[1:])] + [f">={limits[-1]} mm3"]
+
+
+def computeLungHistograms(maskArray, ctArray):
+    """
+    Compute the histogram of CT values of the right (mask label 1) and left (mask label 2) lung voxels
+    in a single pass, with 1 HU wide bins (values are rounded down).
+    Returns (value of the first bin, counts array of shape (2, number of bins)).
+    """
+    lungVoxelIndices = np.flatnonzero(maskArray)
+    sides = maskArray.reshape(-1)[lungVoxelIndices].astype(np.intp)
+    valid = sides <= 2
+    sides = sides[valid]
+    values = np.floor(ctArray.reshape(-1)[lungVoxelIndices[valid]]).astype(np.intp)
+    if len(values) == 0:
+        return 0, np.zeros((2, 1))
+    firstValue = values.min()
+    numberOfBins = values.max() - firstValue + 1
+    counts = np.bincount((sides - 1) * numberOfBins + (values - firstValue), minlength=2 * numberOfBins)
+    return int(firstValue), counts.reshape(2, numberOfBins)
+
+
+def volumesFromHistograms(histograms, thresholds, voxelVolumeMm3, segmentProperties=segmentProperties):
+    """
+    Get segment name -> volume in cm3 of the "<class> <side>" segments for any set of thresholds
+    from lung histograms computed by computeLungHistograms, in time proportional to the number of bins.
+    Results are the same as the ones of classifyLungVoxels for integer CT values.
+    """
+    firstValue, counts = histograms
+    numberOfBins = counts.shape[1]
+    # voxelsBelow[:, n] is the number of voxels with value < firstValue + n
+    voxelsBelow = np.zeros((2, numberOfBins + 1))
+    np.cumsum(counts, axis=1, out=voxelsBelow[:, 1:])
+
+    def countVoxelsBelow(threshold):
+        return voxelsBelow[:, int(np.clip(np.ceil(threshold) - firstValue, 0, numberOfBins))]
+
+    volumes = {}
+    for segmentProperty in segmentProperties:
+        lowerThresholdName, upperThresholdName = segmentProperty["thresholds"]
+        voxelCounts = np.maximum(countVoxelsBelow(thresholds[upperThresholdName]) - countVoxelsBelow(thresholds[lowerThresholdName]), 0)
+        for sideIndex, side in enumerate(["right", "left"]):
+            volumes[f"{segmentProperty['name']} {side}"] = voxelCounts[sideIndex] * voxelVolumeMm3 / 1000.
+    return volumes
+
+
+def computeLungGeometry(maskArray, ijkToRas):
+    """
+    Compute centroid and cranio-caudal diameter of the right (mask label 1) and left (mask label 2) lung.
+    The diameter is the extent of the lung along its longest principal axis (PCA of the voxel coordinates).
+    This approximates obb_diameter_mm[2] of LabelmapSegmentStatisticsPlugin, whose oriented bounding box
+    is computed differently, so the two may differ slightly.
+    Returns a dict that maps "right" and "left" to (centroid RAS, diameter in mm).
+    """
+    directions = np.asarray(ijkToRas)[:3, :3]
+    shape = maskArray.shape
+    slabSize = max(1, slabVoxelCount // (shape[1] * shape[2]))
+
+    # First pass: first and second order moments of the IJK coordinates
+    counts = np.zeros(3)
+    sums = np.zeros((3, 3))
+    sumProducts = np.zeros((3, 3, 3))
+    for firstSlice in range(0, shape[0], slabSize):
+        slab = maskArray[firstSlice:firstSlice + slabSize]
+        for side in [1, 2]:
+            k, j, i = np.nonzero(slab == side)
+            if len(k) == 0:
+                continue
+            ijk = np.stack([i, j, k + firstSlice]).astype(np.float64)
+            counts[side] += len(k)
+            sums[side] += ijk.sum(axis=1)
+            sumProducts[side] += ijk @ ijk.T
+
+    principalAxes = {}
+    geometry = {}
+    for side, sideName in [(1, "right"), (2, "left")]:
+        if counts[side] == 0:
+            geometry[sideName] = (np.zeros(3), 0.)
+            continue
+        meanIjk = sums[side] / counts[side]
+        covarianceIjk = sumProducts[side] / counts[side] - np.outer(meanIjk, meanIjk)
+        eigenValues, eigenVectors = np.linalg.eigh(directions @ covarianceIjk @ directions.T)
+        principalAxes[side] = eigenVectors[:, -1]
+        geometry[sideName] = (directions @ meanIjk + np.asarray(ijkToRas)[:3, 3], 0.)
+
+    # Second pass: extent of the voxels along the longest principal axis
+    for side, sideName in [(1, "right"), (2, "left")]:
+        if side not in principalAxes:
+            continue
+        weights = directions.T @ principalAxes[side]
+        minimum = np.inf
+        maximum = -np.inf
+        for firstSlice in range(0, shape[0], slabSize):
+            k, j, i = np.nonzero(maskArray[firstSlice:firstSlice + slabSize] == side)
+            if len(k) == 0:
+                continue
+            projections = weights[0] * i + weights[1] * j + weights[2] * (k + firstSlice)
+            minimum = min(minimum, projections.min())
+            maximum = max(maximum, projections.max())
+        # Add the size of one voxel along the axis, as the extent is measured between voxel centers
+        geometry[sideName] = (geometry[sideName][0], maximum - minimum + np.abs(weights).sum())
+    return geometry
+
+
+def computeLungRegionMasks(lungVoxelIndices, rightLungVoxels, shape, ijkToRas, lungGeometry):
+    """
+    Compute the area analysis regions of the lung voxels specified by their flat voxel indices.
+    Regions are defined per side by the lung centroid and the cranio-caudal diameter in lungGeometry
+    ("right"/"left" -> (centroid RAS, diameter)): ventral/dorsal are split at the anterior-posterior
+    centroid coordinate, upper/lower half at the superior-inferior centroid coordinate,
+    upper/middle/lower are thirds of the cranio-caudal diameter measured from the apex.
+    rightLungVoxels is a boolean array that tells for each lung voxel if it belongs to the right lung.
+    Returns a dict that maps each region name to a boolean array over the lung voxels.
+    """
+    ijkToRas = np.asarray(ijkToRas)
+
+    # RAS coordinates of the lung voxels (only A and S are needed)
+    k, j, i = np.unravel_index(lungVoxelIndices, shape)
+    a = ijkToRas[1, 0] * i + ijkToRas[1, 1] * j + ijkToRas[1, 2] * k + ijkToRas[1, 3]
+    s = ijkToRas[2, 0] * i + ijkToRas[2, 1] * j + ijkToRas[2, 2] * k + ijkToRas[2, 3]
+    del i, j, k
+
+    # Region boundaries of each lung voxel, taken from the geometry of its side
+    centroidA = np.empty(len(lungVoxelIndices))
+    centroidS = np.empty(len(lungVoxelIndices))
+    coronalApex = np.empty(len(lungVoxelIndices))
+    coronalLungDiameter = np.empty(len(lungVoxelIndices))
+    for side, sideVoxels in [("right", rightLungVoxels), ("left", ~rightLungVoxels)]:
+        centroid_ras, diameter = lungGeometry[side]
+        centroidA[sideVoxels] = centroid_ras[1]
+        centroidS[sideVoxels] = centroid_ras[2]
+        coronalLungDiameter[sideVoxels] = diameter
+        coronalApex[sideVoxels] = centroid_ras[2] + (diameter/2.)
+
+    upperBoundary = coronalApex - coronalLungDiameter/3.
+    lowerBoundary = coronalApex - (coronalLungDiameter/3.)*2.
+    regionMasks = {
+        "ventral": a >= centroidA,
+        "dorsal": a < centroidA,
+        "upper half": s >= centroidS,
+        "lower half": s < centroidS,
+        "upper": s >= upperBoundary,
+        "middle": (s >= lowerBoundary) & (s < upperBoundary),
+        "lower": s < lowerBoundary,
+        }
+    return regionMasks
+
+
+def computeSegmentStatistics(segmentLabelArray, ctArray, ijkToRas, lungGeometry=None, lobeLabelArray=None,
+    segmentProperties=segmentProperties, subSegmentProperties=subSegmentProperties, lobeNames=lobeNames):
+    """
+    Compute voxel count, volume, HU sum, sum of squares, minimum and maximum of every output segment
+    ("<class> <side>", "<class> <side> <region>", "<class> <side> <lobe>") in a single pass over the lung voxels.
+    Each lung voxel gets one combined code of its classification label, region and lobe and all sums are
+    accumulated into a histogram of these codes, which is then summed up for each output segment.
+    Region segments are computed if lungGeometry is specified, lobe segments if lobeLabelArray
+    (index in lobeNames + 1, 0 outside of the lobes) is specified.
+    Returns a dictionary with the same keys as SegmentStatistics results.
+    """
+    numberOfClasses = len(segmentProperties)
+    numberOfLabels = 2 * numberOfClasses + 1
+    numberOfLobeLabels = len(lobeNames) + 1
+    # Combined code = label + numberOfLabels * (dorsal + 2 * (lower half + 2 * (third + 3 * lobe)))
+    histogramShape = (numberOfLobeLabels, 3, 2, 2, numberOfLabels)
+    numberOfCodes = int(np.prod(histogramShape))
+    counts = np.zeros(numberOfCodes)
+    sums = np.zeros(numberOfCodes)
+    sumSquares = np.zeros(numberOfCodes)
+    minimums = np.full(numberOfCodes, np.inf)
+    maximums = np.full(numberOfCodes, -np.inf)
+
+    shape = segmentLabelArray.shape
+    # Process the volume in slabs of slices to limit the size of temporary arrays
+    sliceSize = shape[1] * shape[2]
+    slabSize = max(1, slabVoxelCount // sliceSize)
+    for firstSlice in range(0, shape[0], slabSize):
+        lastSlice = min(firstSlice + slabSize, shape[0])
+        lungVoxelIndices = np.flatnonzero(segmentLabelArray[firstSlice:lastSlice]) + firstSlice * sliceSize
+        if len(lungVoxelIndices) == 0:
+            continue
+        labels = segmentLabelArray.reshape(-1)[lungVoxelIndices].astype(np.intp)
+        values = ctArray.reshape(-1)[lungVoxelIndices].astype(np.float64)
+        codes = labels
+        if lungGeometry is not None:
+            regionMasks = computeLungRegionMasks(lungVoxelIndices, labels <= numberOfClasses, shape, ijkToRas, lungGeometry)
+            regionCodes = (regionMasks["dorsal"].astype(np.intp) + 2 * regionMasks["lower half"]
+                + 4 * (regionMasks["middle"] + 2 * regionMasks["lower"].astype(np.intp)))
+            codes = codes + numberOfLabels * regionCodes
+        if lobeLabelArray is not None:
+            lobeLabels = lobeLabelArray.reshape(-1)[lungVoxelIndices].astype(np.intp)
+            codes = codes + (numberOfCodes // numberOfLobeLabels) * lobeLabels
+        counts += np.bincount(codes, minlength=numberOfCodes)
+        sums += np.bincount(codes, weights=values, minlength=numberOfCodes)
+        sumSquares += np.bincount(codes, weights=values * values, minlength=numberOfCodes)
+        # ufunc.at is unbuffered and slow: sort the values by code and reduce each run of equal codes instead
+        # (stable sorting of codes of at most 16 bits is a radix sort)
+        order = np.argsort(codes.astype(np.min_scalar_type(numberOfCodes - 1)), kind="stable")
+        sortedCodes = codes[order]
+        sortedValues = values[order]
+        runStarts = np.flatnonzero(np.r_[True, sortedCodes[1:] != sortedCodes[:-1]])
+        runCodes = sortedCodes[runStarts]
+        minimums[runCodes] = np.minimum(minimums[runCodes], np.minimum.reduceat(sortedValues, runStarts))
+        maximums[runCodes] = np.maximum(maximums[runCodes], np.maximum.reduceat(sortedValues, runStarts))
+
+    counts = counts.reshape(histogramShape)
+    sums = sums.reshape(histogramShape)
+    sumSquares = sumSquares.reshape(histogramShape)
+    minimums = minimums.reshape(histogramShape)
+    maximums = maximums.reshape(histogramShape)
+
+    voxelVolumeMm3 = abs(np.linalg.det(np.asarray(ijkToRas)[:3, :3]))
+    stats = {"SegmentIDs": []}
+
+    def addSegmentStatistics(segmentName, selection):
+        voxelCount = counts[selection].sum()
+        stats["SegmentIDs"].append(segmentName)
+        stats[segmentName, "ScalarVolumeSegmentStatisticsPlugin.voxel_count"] = int(voxelCount)
+        stats[segmentName, "ScalarVolumeSegmentStatisticsPlugin.volume_mm3"] = voxelCount * voxelVolumeMm3
+        stats[segmentName, "ScalarVolumeSegmentStatisticsPlugin.volume_cm3"] = voxelCount * voxelVolumeMm3 / 1000.
+        stats[segmentName, "ScalarVolumeSegmentStatisticsPlugin.sum"] = sums[selection].sum()
+        stats[segmentName, "ScalarVolumeSegmentStatisticsPlugin.sum_squares"] = sumSquares[selection].sum()
+        if voxelCount > 0:
+            mean = sums[selection].sum() / voxelCount
+            variance = max(sumSquares[selection].sum() / voxelCount - mean * mean, 0.)
+            stats[segmentName, "ScalarVolumeSegmentStatisticsPlugin.min"] = minimums[selection].min()
+            stats[segmentName, "ScalarVolumeSegmentStatisticsPlugin.max"] = maximums[selection].max()
+            stats[segmentName, "ScalarVolumeSegmentStatisticsPlugin.mean"] = mean
+            stats[segmentName, "ScalarVolumeSegmentStatisticsPlugin.stdev"] = np.sqrt(variance)
+        else:
+            for measurement in ["min", "max", "mean", "stdev"]:
+                stats[segmentName, "ScalarVolumeSegmentStatisticsPlugin." + measurement] = 0.
+
+    # Selections are (lobe, third, half, ventral/dorsal, label)
+    regionSelections = {
+        "ventral": (slice(None), slice(None), slice(None), 0),
+        "dorsal": (slice(None), slice(None), slice(None), 1),
+        "upper half": (slice(None), slice(None), 0, slice(None)),
+        "lower half": (slice(None), slice(None), 1, slice(None)),
+        "upper": (slice(None), 0, slice(None), slice(None)),
+        "middle": (slice(None), 1, slice(None), slice(None)),
+        "lower": (slice(None), 2, slice(None), slice(None)),
+        }
+    for sideIndex, side in enumerate(["right", "left"]):
+        for classIndex, segmentProperty in enumerate(segmentProperties):
+            label = sideIndex * numberOfClasses + classIndex + 1
+            addSegmentStatistics(f"{segmentProperty['name']} {side}", (Ellipsis, label))
+    if lungGeometry is not None:
+        for subSegmentProperty in subSegmentProperties:
+            region = subSegmentProperty['name']
+            for sideIndex, side in enumerate(["right", "left"]):
+                for classIndex, segmentProperty in enumerate(segmentProperties):
+                    label = sideIndex * numberOfClasses + classIndex + 1
+                    addSegmentStatistics(f"{segmentProperty['name']} {side} {region}", regionSelections[region] + (label,))
+    if lobeLabelArray is not None:
+        for lobeIndex, lobeName in enumerate(lobeNames, start=1):
+            side, lobe = lobeName.split(" ", 1)
+            sideIndex = 0 if side == "right" else 1
+            for classIndex, segmentProperty in enumerate(segmentProperties):
+                label = sideIndex * numberOfClasses + classIndex + 1
+                addSegmentStatistics(f"{segmentProperty['name']} {side} {lobe}", (lobeIndex, Ellipsis, label))
+    return stats
+
+
+def volumesFromStatistics(stats):
+    """
+    Get segment name -> volume in cm3 from statistics returned by computeSegmentStatistics.
+    """
+    return {segmentName: stats[segmentName, "ScalarVolumeSegmentStatisticsPlugin.volume_cm3"] for segmentName in stats["SegmentIDs"]}
+
+
+def calculateLungResults(volumes, countBullae=False):
+    """
+    Compute the lung volumes and percentages of the whole lungs from segment name -> volume in cm3.
+    Returns a dict, keys are the names of the corresponding LungCTAnalyzerLogic attributes.
+    """
+    def getVol(segmentName):
+        return float(volumes.get(segmentName, 0.))
+
+    r = {}
+    r["bulRightLung"] = getVol("Emphysema right")
+    r["venRightLung"] = getVol("Inflated right")
+    r["infRightLung"] = getVol("Infiltration right")
+    r["colRightLung"] = getVol("Collapsed right")
+    r["vesRightLung"] = getVol("Vessels right")
+    r["bulLeftLung"] = getVol("Emphysema left")
+    r["venLeftLung"] = getVol("Inflated left")
+    r["infLeftLung"] = getVol("Infiltration left")
+    r["colLeftLung"] = getVol("Collapsed left")
+    r["vesLeftLung"] = getVol("Vessels left")
+
+    r["rightLungVolume"] = getVol("Emphysema right") + getVol("Inflated right") + getVol("Infiltration right") + getVol("Collapsed right")
+    r["leftLungVolume"] = getVol("Emphysema left") + getVol("Inflated left") + getVol("Infiltration left") + getVol("Collapsed left")
+    r["totalLungVolume"] = r["rightLungVolume"] + r["leftLungVolume"]
+
+    if countBullae:
+        r["functionalRightVolume"] = getVol("Inflated right")
+        r["functionalLeftVolume"] = getVol("Inflated left")
+        r["affectedRightVolume"] = getVol("Infiltration right") + getVol("Collapsed right") + getVol("Emphysema right")
+        r["affectedLeftVolume"] = getVol("Infiltration left") + getVol("Collapsed left") + getVol("Emphysema left")
+    else:
+        r["functionalRightVolume"] = getVol("Inflated right") + getVol("Emphysema right")
+        r["functionalLeftVolume"] = getVol("Inflated left") + getVol("Emphysema left")
+        r["affectedRightVolume"] = getVol("Infiltration right") + getVol("Collapsed right")
+        r["affectedLeftVolume"] = getVol("Infiltration left") + getVol("Collapsed left")
+    r["functionalTotalVolume"] = r["venRightLung"] + r["venLeftLung"]
+    r["affectedTotalVolume"] = r["affectedRightVolume"] + r["affectedLeftVolume"]
+
+    r["emphysemaRightVolume"] = getVol("Emphysema right")
+    r["emphysemaLeftVolume"] = getVol("Emphysema left")
+    r["emphysemaTotalVolume"] = r["emphysemaRightVolume"] + r["emphysemaLeftVolume"]
+
+    r["infiltratedRightVolume"] = getVol("Infiltration right")
+    r["infiltratedLeftVolume"] = getVol("Infiltration left")
+    r["infiltratedTotalVolume"] = r["infiltratedRightVolume"] + r["infiltratedLeftVolume"]
+
+    r["collapsedRightVolume"] = getVol("Collapsed right")
+    r["collapsedLeftVolume"] = getVol("Collapsed left")
+    r["collapsedTotalVolume"] = r["collapsedRightVolume"] + r["collapsedLeftVolume"]
+
+    if r["totalLungVolume"]:
+        r["rightLungVolumePerc"] = round(r["rightLungVolume"] * 100. / r["totalLungVolume"])
+        r["leftLungVolumePerc"] = round(r["leftLungVolume"] * 100. / r["totalLungVolume"])
+    else:
+        r["rightLungVolumePerc"] = r["leftLungVolumePerc"] = 0
+    r["totalLungVolumePerc"] = 100.
+
+    for side in ["Right", "Left", "Total"]:
+        lungVolume = r[side.lower() + "LungVolume"]
+        if lungVolume:
+            r[f"functional{side}VolumePerc"] = round(100 * r[f"functional{side}Volume"] / lungVolume)
+            r[f"affected{side}VolumePerc"] = round(100 * r[f"affected{side}Volume"] / lungVolume)
+            r[f"emphysema{side}VolumePerc"] = round(100 * r[f"emphysema{side}Volume"] / lungVolume,1)
+            r[f"infiltrated{side}VolumePerc"] = round(100 * r[f"infiltrated{side}Volume"] / lungVolume,1)
+            r[f"collapsed{side}VolumePerc"] = round(100 * r[f"collapsed{side}Volume"] / lungVolume,1)
+        else:
+            for result in ["functional", "affected", "emphysema", "infiltrated", "collapsed"]:
+                r[f"{result}{side}VolumePerc"] = 0
+    return r
+
+
+def calculateRegionResults(volumes, area, countBullae=False):
+    """
+    Compute the lung volumes and percentages of a region or lobe (for example "ventral" or "upper lobe")
+    from segment name -> volume in cm3.
+    Returns a dict, keys are the names of the corresponding LungCTAnalyzerLogic attributes.
+    """
+    def getVol(segmentName):
+        return float(volumes.get(segmentName + " " + area, 0.))
+
+    r = {}
+    r["rightResultLungVolume"] = getVol("Emphysema right") + getVol("Inflated right") + getVol("Infiltration right") + getVol("Collapsed right")
+    r["leftResultLungVolume"] = getVol("Emphysema left") + getVol("Inflated left") + getVol("Infiltration left") + getVol("Collapsed left")
+    r["totalResultLungVolume"] = r["rightResultLungVolume"] + r["leftResultLungVolume"]
+    if r["totalResultLungVolume"] > 0.:
+        r["rightResultLungVolumePerc"] = round(r["rightResultLungVolume"] * 100. / r["totalResultLungVolume"])
+        r["leftResultLungVolumePerc"] = round(r["leftResultLungVolume"] * 100. / r["totalResultLungVolume"])
+    else:
+        r["rightResultLungVolumePerc"] = -1
+        r["leftResultLungVolumePerc"] = -1
+    r["totalResultLungVolumePerc"] = 100.
+
+    if countBullae:
+        r["affectedResultRightVolume"] = getVol("Infiltration right") + getVol("Collapsed right") + getVol("Emphysema right")
+        r["affectedResultLeftVolume"] = getVol("Infiltration left") + getVol("Collapsed left") + getVol("Emphysema left")
+        r["functionalResultRightVolume"] = getVol("Inflated right")
+        r["functionalResultLeftVolume"] = getVol("Inflated left")
+    else:
+        r["affectedResultRightVolume"] = getVol("Infiltration right") + getVol("Collapsed right")
+        r["affectedResultLeftVolume"] = getVol("Infiltration left") + getVol("Collapsed left")
+        r["functionalResultRightVolume"] = getVol("Inflated right") + getVol("Emphysema right")
+        r["functionalResultLeftVolume"] = getVol("Inflated left") + getVol("Emphysema left")
+    r["affectedResultTotalVolume"] = r["affectedResultRightVolume"] + r["affectedResultLeftVolume"]
+    r["functionalResultTotalVolume"] = r["functionalResultRightVolume"] + r["functionalResultLeftVolume"]
+
+    r["emphysemaResultRightVolume"] = getVol("Emphysema right")
+    r["emphysemaResultLeftVolume"] = getVol("Emphysema left")
+    r["emphysemaResultTotalVolume"] = r["emphysemaResultRightVolume"] + r["emphysemaResultLeftVolume"]
+    r["infiltratedResultRightVolume"] = getVol("Infiltration right")
+    r["infiltratedResultLeftVolume"] = getVol("Infiltration left")
+    r["infiltratedResultTotalVolume"] = r["infiltratedResultRightVolume"] + r["infiltratedResultLeftVolume"]
+    r["collapsedResultRightVolume"] = getVol("Collapsed right")
+    r["collapsedResultLeftVolume"] = getVol("Collapsed left")
+    r["collapsedResultTotalVolume"] = r["collapsedResultRightVolume"] + r["collapsedResultLeftVolume"]
+
+    for side in ["Total", "Right", "Left"]:
+        lungVolume = r[side.lower() + "ResultLungVolume"]
+        if lungVolume > 0.:
+            r[f"functionalResult{side}VolumePerc"] = round(100 * r[f"functionalResult{side}Volume"] / lungVolume)
+            r[f"affectedResult{side}VolumePerc"] = round(100 * r[f"affectedResult{side}Volume"] / lungVolume)
+            r[f"emphysemaResult{side}VolumePerc"] = round(100 * r[f"emphysemaResult{side}Volume"] / lungVolume,1)
+            r[f"infiltratedResult{side}VolumePerc"] = round(100 * r[f"infiltratedResult{side}Volume"] / lungVolume,1)
+            r[f"collapsedResult{side}VolumePerc"] = round(100 * r[f"collapsedResult{side}Volume"] / lungVolume,1)
+        else:
+            for result in ["functional", "affected", "emphysema", "infiltrated", "collapsed"]:
+                r[f"{result}Result{side}VolumePerc"] = -1
+    return r
+
+
+def analyzeLung(ctArray, maskArray, ijkToRas, thresholds=None, lobeLabelArray=None, areaAnalysis=False, countBullae=False,
+    cropMargin=5, segmentProperties=segmentProperties, minimumIslandSizeMm3=1000.):
+    """
+    Run the complete analysis on arrays, without any Slicer dependency.
+    maskArray contains 1 for right lung and 2 for left lung voxels, lobeLabelArray (optional) the index
+    of the lobe in lobeNames + 1. The lower emphysema threshold is adjusted to the lowest CT value and
+    islands smaller than minimumIslandSizeMm3 are removed from the classes that have "removesmallislands"
+    enabled, as it is done in LungCTAnalyzerLogic. All processing is done on the bounding box of the lungs
+    (extended by cropMargin voxels), cropMargin=None processes the full arrays.
+    Regions are based on the centroid and principal axis extent of each lung (see computeLungGeometry),
+    which approximate the oriented bounding box of SegmentStatistics used by LungCTAnalyzerLogic,
+    so region volumes may differ slightly from the ones of the logic.
+    Returns a dict with "statistics" (SegmentStatistics compatible), "results" (whole lung results),
+    "regionResults" (region or lobe name -> results) and "emphysemaClusters" (if countBullae is enabled).
+    """
+    thresholds = dict(thresholds if thresholds else defaultThresholds)
+    thresholds['thresholdBullaLower'] = float(ctArray.min())
+    if cropMargin is not None:
+        extent = computeBoundingBox(maskArray, cropMargin)
+        if extent is not None:
+            ctArray = ctArray[extent]
+            maskArray = maskArray[extent]
+            lobeLabelArray = lobeLabelArray[extent] if lobeLabelArray is not None else None
+            ijkToRas = cropIJKToRAS(ijkToRas, extent)
+    voxelVolumeMm3 = abs(np.linalg.det(np.asarray(ijkToRas)[:3, :3]))
+    segmentLabelArray = classifyLungVoxels(maskArray, ctArray, thresholds, segmentProperties)
+    islandLabels = [sideIndex * len(segmentProperties) + classIndex + 1 for sideIndex in range(2)
+        for classIndex, segmentProperty in enumerate(segmentProperties) if segmentProperty["removesmallislands"] == "yes"]
+    if islandLabels:
+        removeSmallIslands(segmentLabelArray, islandLabels, max(1, int(round(minimumIslandSizeMm3 / voxelVolumeMm3))))
+    lungGeometry = computeLungGeometry(maskArray, ijkToRas) if areaAnalysis else None
+    stats = computeSegmentStatistics(segmentLabelArray, ctArray, ijkToRas, lungGeometry, lobeLabelArray, segmentProperties)
+    emphysemaClusters = None
+    if countBullae:
+        emphysemaClusters = computeEmphysemaClusters(segmentLabelArray, voxelVolumeMm3, len(segmentProperties))
+    volumes = volumesFromStatistics(stats)
+    regionResults = {}
+    if areaAnalysis:
+        for subSegmentProperty in subSegmentProperties:
+            regionResults[subSegmentProperty['name']] = calculateRegionResults(volumes, subSegmentProperty['name'], countBullae)
+    if lobeLabelArray is not None:
+        for lobe in ['upper lobe', 'middle lobe', 'lower lobe']:
+            regionResults[lobe] = calculateRegionResults(volumes, lobe, countBullae)
+    return {
+        "statistics": stats,
+        "results": calculateLungResults(volumes, countBullae),
+        "regionResults": regionResults,
+        "emphysemaClusters": emphysemaClusters,
+        }
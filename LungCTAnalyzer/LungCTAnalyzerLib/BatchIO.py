@@ -0,0 +1,252 @@
+"""
+Background file I/O for batch processing.
+
+MRML nodes can only be loaded and saved on the main thread, but most of the time spent on
+input and output in batch processing is reading, decompressing and copying files, which
+can overlap with the analysis of another case:
+
+- CasePrefetcher copies and decompresses the input files of the next cases into a local
+  staging folder on a background thread, so the main thread loads uncompressed local files.
+  Of scene bundles (.mrb), only the data files of the required nodes are extracted (see MrbReader).
+- BackgroundWriter runs write tasks (e.g. moving outputs from a local staging folder to a slow
+  network share, or writing snapshots of output arrays with writeVolumeArray) on a background
+  thread. Its queue is bounded by the number of tasks and optionally by the size of the data
+  held by the tasks, so submitting a task blocks when the writer falls behind.
+
+This module does not depend on Slicer (writeVolumeArray requires SimpleITK).
+"""
+
+import glob
+import gzip
+import json
+import logging
+import os
+import queue
+import shutil
+import threading
+import zipfile
+
+import numpy as np
+
+from . import MrbReader
+
+# File of the node data files extracted from a scene bundle by stageCaseInput
+nodeFileListFilename = "nodeFiles.json"
+
+# Compression settings of output volumes: zlib compression level (0: no compression)
+outputCompressions = {
+    "none": 0,
+    "fast": 1,
+    "max": 9,
+    }
+
+
+def stageCaseInput(filepath, stagingDir, mrbNodes=None):
+    """
+    Copy the input files of a batch case into stagingDir in a form that loads fast and return
+    the file to load instead of filepath:
+
+    - .mrb scene with mrbNodes (node name -> MRML element name, see MrbReader.findNodeFiles): only the
+      data files of these nodes are extracted and the path of a JSON file with the node name -> data file
+      path dict (nodeFileListFilename) is returned.
+    - .mrb scene: the archive is extracted and the path of the extracted .mrml file is returned.
+    - .nii.gz volume: the volume and the lung_segmentations folder next to it are decompressed
+      to .nii files with the same folder layout and the path of the decompressed volume is returned.
+    """
+    os.makedirs(stagingDir, exist_ok=True)
+    if filepath.lower().endswith(".mrb") and mrbNodes:
+        nodeFiles = MrbReader.extractNodeFiles(filepath, mrbNodes, stagingDir)
+        nodeFileListFilepath = os.path.join(stagingDir, nodeFileListFilename)
+        with open(nodeFileListFilepath, "w") as f:
+            json.dump(nodeFiles, f)
+        return nodeFileListFilepath
+    if filepath.lower().endswith(".mrb"):
+        with zipfile.ZipFile(filepath) as mrb:
+            mrb.extractall(stagingDir)
+        sceneFilepaths = glob.glob(stagingDir + "/**/*.mrml", recursive=True)
+        if not sceneFilepaths:
+            raise ValueError(f"No scene file found in '{filepath}'.")
+        return sceneFilepaths[0]
+
+    def decompress(sourceFilepath, targetFilepath):
+        with gzip.open(sourceFilepath, "rb") as source, open(targetFilepath, "wb") as target:
+            shutil.copyfileobj(source, target, 1 << 20)
+
+    caseDir = os.path.dirname(filepath)
+    stagedFilepath = os.path.join(stagingDir, os.path.basename(filepath)[:-len(".gz")])
+    decompress(filepath, stagedFilepath)
+    for segmentFilepath in glob.glob(caseDir + "/lung_segmentations/**/*.nii.gz", recursive=True):
+        stagedSegmentFilepath = os.path.join(stagingDir, os.path.relpath(segmentFilepath, caseDir))[:-len(".gz")]
+        os.makedirs(os.path.dirname(stagedSegmentFilepath), exist_ok=True)
+        decompress(segmentFilepath, stagedSegmentFilepath)
+    return stagedFilepath
+
+
+class CasePrefetcher:
+    """
+    Iterate over batch cases while the following cases are staged on a background thread.
+    Yields (filepath, stagedFilepath, stagingDir, error) tuples. If staging of a case failed,
+    stagedFilepath and stagingDir are None and error is the exception, so that the caller can
+    skip the case and continue with the next one. The caller removes stagingDir when it is
+    done with a case (see removeStagingDir). mrbNodes are passed to stageCaseInput.
+    """
+
+    def __init__(self, filepaths, stagingRootDir, prefetchCount=1, mrbNodes=None):
+        self.filepaths = list(filepaths)
+        self.stagingRootDir = stagingRootDir
+        self.prefetchCount = prefetchCount
+        self.mrbNodes = mrbNodes
+        self._queue = queue.Queue(maxsize=prefetchCount)
+        self._stopEvent = threading.Event()
+        self._thread = None
+
+    def _run(self):
+        for index, filepath in enumerate(self.filepaths):
+            stagingDir = os.path.join(self.stagingRootDir, str(index))
+            try:
+                item = (filepath, stageCaseInput(filepath, stagingDir, self.mrbNodes), stagingDir, None)
+            except Exception as e:
+                removeStagingDir(stagingDir)
+                item = (filepath, None, None, e)
+            # wait for the consumer, checking regularly whether we should stop
+            while not self._stopEvent.is_set():
+                try:
+                    self._queue.put(item, timeout=0.2)
+                    break
+                except queue.Full:
+                    pass
+            if self._stopEvent.is_set():
+                removeStagingDir(item[2])
+                return
+
+    def __iter__(self):
+        self._thread = threading.Thread(target=self._run, name="LungCTAnalyzerPrefetcher", daemon=True)
+        self._thread.start()
+        try:
+            for _ in self.filepaths:
+                yield self._queue.get()
+        finally:
+            self.close()
+
+    def close(self):
+        """
+        Stop prefetching and remove cases that were staged but not consumed.
+        """
+        self._stopEvent.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+        while not self._queue.empty():
+            removeStagingDir(self._queue.get_nowait()[2])
+
+
+def removeStagingDir(stagingDir):
+    if stagingDir:
+        shutil.rmtree(stagingDir, ignore_errors=True)
+
+
+def moveTree(sourceDir, targetDir):
+    """
+    Move the content of sourceDir into targetDir (existing files are overwritten) and remove sourceDir.
+    """
+    for dirpath, dirnames, filenames in os.walk(sourceDir):
+        targetDirpath = os.path.join(targetDir, os.path.relpath(dirpath, sourceDir))
+        os.makedirs(targetDirpath, exist_ok=True)
+        for filename in filenames:
+            shutil.move(os.path.join(dirpath, filename), os.path.join(targetDirpath, filename))
+    shutil.rmtree(sourceDir, ignore_errors=True)
+
+
+def writeVolumeArray(filename, volumeArray, ijkToRas, compression="fast"):
+    """
+    Write a voxel array (KJI index order, as returned by slicer.util.arrayFromVolume) with the given
+    IJK to RAS matrix to a NIFTI, NRRD or any other file format supported by SimpleITK.
+    compression is one of the outputCompressions.
+    """
+    import SimpleITK as sitk
+    ijkToRas = np.asarray(ijkToRas, np.float64)
+    spacing = np.linalg.norm(ijkToRas[:3, :3], axis=0)
+    # ITK uses LPS coordinates
+    rasToLps = np.diag([-1., -1., 1.])
+    image = sitk.GetImageFromArray(volumeArray)
+    image.SetSpacing(spacing.tolist())
+    image.SetOrigin((rasToLps @ ijkToRas[:3, 3]).tolist())
+    image.SetDirection((rasToLps @ (ijkToRas[:3, :3] / spacing)).reshape(-1).tolist())
+    compressionLevel = outputCompressions[compression]
+    if not filename.lower().endswith(".gz"):
+        sitk.WriteImage(image, filename, compressionLevel > 0, compressionLevel)
+        return
+    # ITK ignores the compression level of gzip compressed files (e.g. .nii.gz), so the file
+    # is written uncompressed and compressed here (with level 0 it is only wrapped into gzip)
+    uncompressedFilenameBase, extension = os.path.splitext(filename[:-len(".gz")])
+    uncompressedFilename = uncompressedFilenameBase + ".tmp" + extension
+    sitk.WriteImage(image, uncompressedFilename, False)
+    try:
+        with open(uncompressedFilename, "rb") as source, gzip.open(filename, "wb", compressionLevel) as target:
+            shutil.copyfileobj(source, target, 1 << 20)
+    finally:
+        os.remove(uncompressedFilename)
+
+
+class BackgroundWriter:
+    """
+    Run write tasks in submission order on a background thread.
+    At most maxPendingTasks tasks wait in the queue, submit() blocks while the queue is full.
+    If maxPendingBytes is set, submit() also blocks while the data held by pending tasks (their sizeBytes)
+    would exceed it. A task larger than the limit is accepted when no other task is pending.
+    Tasks can be submitted in a group (e.g. the outputs of a batch case, followed by marking the case finished):
+    when a task of a group fails, the following tasks of the group are skipped and the error is stored in
+    self.failedGroups. Errors of tasks without group are collected in self.errors and the first one is raised
+    by close(). All errors are logged when they occur.
+    """
+
+    def __init__(self, maxPendingTasks=2, maxPendingBytes=None):
+        self._queue = queue.Queue(maxsize=maxPendingTasks)
+        self.maxPendingBytes = maxPendingBytes
+        self._pendingBytes = 0
+        self._pendingBytesChanged = threading.Condition()
+        self.errors = []
+        self.failedGroups = {}
+        self._thread = threading.Thread(target=self._run, name="LungCTAnalyzerWriter", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            task = self._queue.get()
+            if task is None:
+                return
+            function, args, sizeBytes, group = task
+            if group is None or group not in self.failedGroups:
+                try:
+                    function(*args)
+                except Exception as e:
+                    if group is None:
+                        logging.error(f"Writing batch outputs failed: {e}")
+                        self.errors.append(e)
+                    else:
+                        logging.error(f"Writing batch outputs of '{group}' failed: {e}")
+                        self.failedGroups[group] = e
+            # release the task (and the data it holds) before the size is given back
+            task = function = args = None
+            with self._pendingBytesChanged:
+                self._pendingBytes -= sizeBytes
+                self._pendingBytesChanged.notify_all()
+
+    def submit(self, function, *args, sizeBytes=0, group=None):
+        with self._pendingBytesChanged:
+            if self.maxPendingBytes is not None:
+                self._pendingBytesChanged.wait_for(
+                    lambda: self._pendingBytes == 0 or self._pendingBytes + sizeBytes <= self.maxPendingBytes)
+            self._pendingBytes += sizeBytes
+        self._queue.put((function, args, sizeBytes, group))
+
+    def close(self):
+        """
+        Wait until all submitted tasks are done. Failed groups are not raised, see failedGroups.
+        """
+        if self._thread:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+        if self.errors:
+            raise self.errors[0]
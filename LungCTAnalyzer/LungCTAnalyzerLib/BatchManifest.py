@@ -0,0 +1,107 @@
+"""
+Manifest of a batch processing output folder.
+
+The manifest (batchManifest.json in the output folder) records for each case the size and
+modification time of its input files, a hash of the analysis parameters, the case number
+used in the CSV files and the processing status. A new batch run over the same input and
+output folder only processes cases that are new, changed, failed or were interrupted.
+
+This module does not depend on Slicer.
+"""
+
+import glob
+import hashlib
+import json
+import os
+import threading
+import time
+
+manifestFilename = "batchManifest.json"
+
+
+def caseInputFiles(filepath):
+    """
+    Get all input files of a batch case: the .mrb scene, or the NIFTI volume and its lung segments.
+    """
+    filepaths = [filepath]
+    if filepath.lower().endswith(".nii.gz"):
+        caseDir = os.path.dirname(filepath)
+        filepaths += sorted(glob.glob(caseDir + "/lung_segmentations/**/*.nii.gz", recursive=True))
+    return filepaths
+
+
+def caseFingerprint(filepath):
+    """
+    Size and modification time of each input file of a case.
+    """
+    fingerprint = {}
+    for inputFilepath in caseInputFiles(filepath):
+        fileStat = os.stat(inputFilepath)
+        fingerprint[inputFilepath] = [fileStat.st_size, fileStat.st_mtime_ns]
+    return fingerprint
+
+
+def parametersHash(parameters):
+    """
+    Hash of JSON-serializable analysis parameters (thresholds, options).
+    """
+    return hashlib.sha1(json.dumps(parameters, sort_keys=True).encode()).hexdigest()
+
+
+class BatchManifest:
+
+    def __init__(self, outputDir):
+        self.filename = os.path.join(outputDir, manifestFilename)
+        self.cases = {}
+        # cases may be finished from a background writer thread
+        self.lock = threading.RLock()
+        if os.path.isfile(self.filename):
+            with open(self.filename) as f:
+                self.cases = json.load(f)["cases"]
+
+    def save(self):
+        with self.lock:
+            self._save()
+
+    def _save(self):
+        # write to a temporary file and rename it, so that a crash can not leave a truncated manifest
+        with open(self.filename + ".tmp", "w") as f:
+            json.dump({"cases": self.cases}, f, indent=1)
+        os.replace(self.filename + ".tmp", self.filename)
+
+    def caseNumber(self, filepath):
+        """
+        Number of the case in the CSV files. It is assigned when the case is first seen and kept on reruns.
+        """
+        with self.lock:
+            if filepath not in self.cases:
+                numbers = [case["number"] for case in self.cases.values()]
+                self.cases[filepath] = {"number": max(numbers) + 1 if numbers else 1, "status": "new"}
+            return self.cases[filepath]["number"]
+
+    def needsProcessing(self, filepath, parametersHash):
+        """
+        Returns True if the case has not been processed successfully yet with the current
+        input files and parameters.
+        """
+        case = self.cases.get(filepath)
+        if not case or case["status"] != "done":
+            return True
+        return case.get("parametersHash") != parametersHash or case.get("inputFiles") != caseFingerprint(filepath)
+
+    def setCaseStarted(self, filepath, parametersHash):
+        inputFiles = caseFingerprint(filepath)
+        with self.lock:
+            self.caseNumber(filepath)
+            self.cases[filepath].update({"status": "started", "parametersHash": parametersHash,
+                "inputFiles": inputFiles, "started": time.time()})
+            self._save()
+
+    def setCaseFinished(self, filepath, succeeded=True, error=None):
+        with self.lock:
+            self.cases[filepath].update({"status": "done" if succeeded else "failed", "finished": time.time()})
+            if error:
+                self.cases[filepath]["error"] = error
+            else:
+                self.cases[filepath].pop("error", None)
+            self._save()
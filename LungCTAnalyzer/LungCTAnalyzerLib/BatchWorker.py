@@ -0,0 +1,121 @@
+"""
+Headless worker process for parallel batch processing of Lung CT Analyzer.
+
+The Lung CT Analyzer module starts the requested number of workers as
+
+  Slicer --no-splash --no-main-window --python-script BatchWorker.py <job.json> <worker index>
+
+All workers share the same job file (case list, options and thresholds). A worker
+claims a case by creating its claim file exclusively, so faster workers simply take
+more cases. Results are written to the CSV files of the output folder through a
+ResultsSink, which serializes the writes of the workers, and optionally to the shared
+ResultsDatabase. Results are flushed every few cases, the status files of the cases (which the
+GUI process follows) are written after their results.
+Creating a "cancel" file in the job folder stops the workers after their current case.
+The stage timings of each case are written to timings.json in its output folder.
+"""
+
+import json
+import os
+import sys
+import time
+import traceback
+
+import slicer
+
+# Logic options passed from the GUI to the workers
+batchOptionNames = ["generateStatistics", "lobeAnalysis", "createLobeSegments", "cropToLung", "areaAnalysis", "countBullae"]
+
+
+def claimCase(jobDir, counter):
+    """
+    Atomically claim a case. Returns False if another worker has claimed it already.
+    """
+    try:
+        fd = os.open(f"{jobDir}/claims/{counter}", os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        return False
+    os.close(fd)
+    return True
+
+
+def runWorker(jobFilename, workerIndex):
+    with open(jobFilename) as f:
+        job = json.load(f)
+    jobDir = os.path.dirname(jobFilename)
+
+    import LungCTAnalyzer
+    from LungCTAnalyzerLib import ResultsSink
+    resultsSink = ResultsSink.ResultsSink(job["outputDir"])
+    resultsDatabase = None
+    if job.get("writeResultsDatabase"):
+        from LungCTAnalyzerLib import ResultsDatabase
+        resultsDatabase = ResultsDatabase.ResultsDatabase(job["outputDir"] + "/" + ResultsDatabase.databaseFilename)
+    batchParameters = {name: value for name, value in job.items() if name not in ["outputDir", "cases", "writeResultsDatabase", "timingColumns"]}
+    logic = LungCTAnalyzer.LungCTAnalyzerLogic()
+    logic.showProgressBar = False
+
+    unflushedStatuses = []
+
+    def flushResults():
+        try:
+            resultsSink.flush()
+        except Exception as e:
+            traceback.print_exc()
+            for status in unflushedStatuses:
+                if status["status"] == "done":
+                    status["status"] = "failed"
+                    status["error"] = f"Writing results failed: {e}"
+        for status in unflushedStatuses:
+            statusFilename = f"{jobDir}/status/{status['counter']}.json"
+            with open(statusFilename + ".tmp", "w") as f:
+                json.dump(status, f)
+            os.replace(statusFilename + ".tmp", statusFilename)
+        unflushedStatuses.clear()
+
+    for counter, filepath in job["cases"]:
+        if os.path.exists(jobDir + "/cancel"):
+            break
+        if not claimCase(jobDir, counter):
+            continue
+        print(f"Worker {workerIndex}: analyzing '{filepath}' ...")
+        startTime = time.time()
+        status = {"counter": counter, "filepath": filepath, "worker": workerIndex}
+        try:
+            slicer.mrmlScene.Clear(0)
+            parameterNode = logic.getParameterNode()
+            logic.setDefaultParameters(parameterNode)
+            logic.setThresholds(parameterNode, job["thresholds"])
+            for optionName in batchOptionNames:
+                setattr(logic, optionName, job["options"][optionName])
+            logic.loadBatchCase(filepath, job["isNiiGzFormat"], job["useCalibratedCT"], inputNodesOnly=job["csvOnly"] or job["minimalOutput"])
+            logic.process()
+            caseName = os.path.basename(os.path.dirname(filepath))
+            if not job["csvOnly"]:
+                logic.saveBatchCaseOutputs(job["outputDir"] + "/" + caseName + "/", job["isNiiGzFormat"],
+                    job["multiLabelOutput"], job["segmentFilesOutput"], job["outputCompression"], job["minimalOutput"])
+            logic.addBatchCaseResults(resultsSink, filepath, counter, caseName, resultsDatabase, batchParameters, job.get("timingColumns", False))
+            logic.saveStageTimings(job["outputDir"] + "/" + caseName + "/timings.json", filepath=filepath)
+            status["status"] = "done"
+        except Exception as e:
+            traceback.print_exc()
+            resultsSink.discardRows(filepath)
+            status["status"] = "failed"
+            status["error"] = str(e)
+        status["duration"] = time.time() - startTime
+        unflushedStatuses.append(status)
+        if len(unflushedStatuses) >= logic.resultsFlushIntervalCases:
+            flushResults()
+    flushResults()
+    if resultsDatabase:
+        resultsDatabase.close()
+
+
+if __name__ == "__main__":
+    exitCode = 0
+    try:
+        runWorker(sys.argv[1], int(sys.argv[2]))
+    except Exception:
+        traceback.print_exc()
+        exitCode = 1
+    slicer.util.exit(exitCode)
@@ -0,0 +1,91 @@
+"""
+Export of segmentations as multi-label NIFTI volumes.
+
+Writing each segment to a separate .seg.nii.gz file rasterizes and compresses a full-size volume
+per segment. Instead, segments are collected into as few label volumes as possible: segments
+that do not overlap share a volume (uint8, or uint16 if there are more than 255 labels), and a
+JSON label dictionary next to the volumes maps label values to segment names and colors.
+Separate files per segment can still be written, by a thread pool from the merged volumes.
+
+This module only depends on numpy and SimpleITK.
+"""
+
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from .BatchIO import writeVolumeArray
+
+
+class LabelVolumeMerger:
+    """
+    Merge label layers into as few label volumes as possible.
+    A layer is a label array with the segments of label value i+1 in segments[i]
+    (segments are (name, color) tuples); segments of a layer must not overlap.
+    A layer is added to the first volume that it does not overlap with.
+    """
+
+    def __init__(self):
+        # list of [labelArray, segments] with label value i+1 of the volume in segments[i]
+        self.volumes = []
+
+    def addLayer(self, labelArray, segments):
+        if not segments:
+            return
+        layerMask = labelArray > 0
+        for volume in self.volumes:
+            volumeArray, volumeSegments = volume
+            numberOfLabels = len(volumeSegments) + len(segments)
+            if numberOfLabels > np.iinfo(np.uint16).max or np.any(volumeArray[layerMask]):
+                continue
+            if numberOfLabels > np.iinfo(volumeArray.dtype).max:
+                volumeArray = volume[0] = volumeArray.astype(np.uint16)
+            volumeArray[layerMask] = labelArray[layerMask].astype(volumeArray.dtype) + len(volumeSegments)
+            volumeSegments += segments
+            return
+        dtype = np.uint8 if len(segments) <= np.iinfo(np.uint8).max else np.uint16
+        self.volumes.append([labelArray.astype(dtype), list(segments)])
+
+
+def segmentFilename(segmentName):
+    return segmentName.lower().replace(" ", "_") + ".seg.nii.gz"
+
+
+def writeLabelVolumes(volumes, ijkToRas, baseFilename=None, segmentsDir=None, compression="fast", maxWorkers=4):
+    """
+    Write merged label volumes (see LabelVolumeMerger) as <baseFilename>.nii.gz, <baseFilename>_2.nii.gz, ...
+    with the label dictionary in <baseFilename>.json and/or each segment to a separate file in segmentsDir.
+    compression is one of BatchIO.outputCompressions. Files are written in parallel by a pool of maxWorkers threads.
+    Returns the list of written files.
+    """
+    labelDictionary = {}
+    tasks = []
+    for volumeIndex, (labelArray, segments) in enumerate(volumes):
+        if baseFilename:
+            filename = baseFilename + (f"_{volumeIndex + 1}" if volumeIndex else "") + ".nii.gz"
+            labelDictionary[os.path.basename(filename)] = {str(labelValue): {"name": name, "color": [float(c) for c in color]}
+                for labelValue, (name, color) in enumerate(segments, start=1)}
+            tasks.append((filename, labelArray, None))
+        if segmentsDir:
+            for labelValue, (name, color) in enumerate(segments, start=1):
+                tasks.append((os.path.join(segmentsDir, segmentFilename(name)), labelArray, labelValue))
+    for filename, _, _ in tasks:
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+
+    def writeTask(filename, labelArray, labelValue):
+        if labelValue is not None:
+            labelArray = (labelArray == labelValue).astype(np.uint8)
+        writeVolumeArray(filename, labelArray, ijkToRas, compression)
+
+    with ThreadPoolExecutor(max_workers=maxWorkers) as executor:
+        # list() raises the first exception of the tasks
+        list(executor.map(lambda task: writeTask(*task), tasks))
+
+    writtenFilenames = [filename for filename, _, _ in tasks]
+    if baseFilename:
+        with open(baseFilename + ".json", "w") as f:
+            json.dump(labelDictionary, f, indent=1)
+        writtenFilenames.append(baseFilename + ".json")
+    return writtenFilenames
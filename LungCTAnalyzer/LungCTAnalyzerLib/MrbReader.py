@@ -0,0 +1,88 @@
+"""
+Partial reading of Slicer scene bundles (.mrb).
+
+An .mrb file is a zip archive of a scene file (.mrml) and the data files of the nodes of the scene.
+slicer.util.loadScene extracts the whole archive and loads every node, although batch analysis only
+needs the CT and the lung segmentation of a case. Here the scene file is parsed to find the data
+files of the requested nodes and only these members are read from the archive, so load time and
+memory do not depend on what else (e.g. TotalSegmentator segmentations) is stored in the scene.
+
+This module does not depend on Slicer.
+"""
+
+import os
+import posixpath
+import shutil
+import urllib.parse
+import xml.etree.ElementTree as ElementTree
+import zipfile
+
+# MRML element names of the node types read by batch analysis
+volumeTagName = "Volume"
+segmentationTagName = "Segmentation"
+
+
+def _nodeReferences(element):
+    """
+    Get role -> list of node IDs of the node references of an MRML element.
+    """
+    references = {}
+    # e.g. references="display:vtkMRMLScalarVolumeDisplayNode1;storage:vtkMRMLVolumeArchetypeStorageNode1;"
+    for reference in element.get("references", "").split(";"):
+        if ":" in reference:
+            role, nodeIDs = reference.split(":", 1)
+            references[role.strip()] = nodeIDs.split()
+    # scenes of old Slicer versions
+    if "storage" not in references and element.get("storageNodeRef"):
+        references["storage"] = element.get("storageNodeRef").split()
+    return references
+
+
+def findNodeFiles(mrb, nodes):
+    """
+    Find the data files of nodes in an opened .mrb archive (zipfile.ZipFile).
+    nodes is a dict of node name -> MRML element name (e.g. {"CT": volumeTagName}).
+    If there are several nodes of the same name, the first one is used.
+    Returns a dict of node name -> archive member name for the nodes that are found.
+    """
+    sceneMembers = [name for name in mrb.namelist() if name.lower().endswith(".mrml")]
+    if not sceneMembers:
+        raise ValueError(f"No scene file found in '{mrb.filename}'.")
+    sceneMember = sceneMembers[0]
+    root = ElementTree.fromstring(mrb.read(sceneMember))
+    elementsByID = {element.get("id"): element for element in root if element.get("id")}
+    memberNames = set(mrb.namelist())
+    nodeFiles = {}
+    for element in root:
+        # names and file names are URL encoded in the scene file
+        name = urllib.parse.unquote(element.get("name", ""))
+        if name not in nodes or name in nodeFiles or element.tag != nodes[name]:
+            continue
+        storageNodeIDs = _nodeReferences(element).get("storage", [])
+        storageElement = elementsByID.get(storageNodeIDs[0]) if storageNodeIDs else None
+        if storageElement is None or not storageElement.get("fileName"):
+            raise ValueError(f"Node '{name}' has no data file in '{mrb.filename}'.")
+        fileName = urllib.parse.unquote(storageElement.get("fileName"))
+        memberName = posixpath.normpath(posixpath.join(posixpath.dirname(sceneMember), fileName))
+        if memberName not in memberNames:
+            raise ValueError(f"Data file '{fileName}' of node '{name}' is missing in '{mrb.filename}'.")
+        nodeFiles[name] = memberName
+    return nodeFiles
+
+
+def extractNodeFiles(filepath, nodes, targetDir):
+    """
+    Extract the data files of nodes (see findNodeFiles) from the .mrb file filepath into targetDir.
+    Only these archive members are read. Returns a dict of node name -> extracted file path
+    for the nodes that are found.
+    """
+    os.makedirs(targetDir, exist_ok=True)
+    extractedFiles = {}
+    with zipfile.ZipFile(filepath) as mrb:
+        for nodeIndex, (name, memberName) in enumerate(findNodeFiles(mrb, nodes).items()):
+            # prefixed, as nodes of the scene may have data files of the same name in different folders
+            extractedFilepath = os.path.join(targetDir, f"{nodeIndex}_{posixpath.basename(memberName)}")
+            with mrb.open(memberName) as source, open(extractedFilepath, "wb") as target:
+                shutil.copyfileobj(source, target, 1 << 20)
+            extractedFiles[name] = extractedFilepath
+    return extractedFiles
@@ -0,0 +1,75 @@
+"""
+Progress reporting of long running logic methods.
+
+Showing a message in the Slicer GUI (status bar, progress dialog) requires processing application
+events, which repaints the views and dispatches all pending events. Doing that for every message of
+a loop slows processing down and may re-enter the module through event handlers. A ProgressReporter
+forwards messages to an update function at most every minIntervalSec; the start of a stage is always
+forwarded. Without update function, messages are only logged (batch processing and headless runs).
+
+Progress is structured in stages: the overall progress fraction is (index of the current stage +
+fraction of the current stage) / number of stages.
+
+This module does not depend on Slicer.
+"""
+
+import logging
+import time
+
+
+class ProgressReporter:
+
+    def __init__(self, updateFunction=None, minIntervalSec=0.1):
+        """
+        updateFunction(message, fraction) shows a message with the overall progress fraction (0..1).
+        If it is None, stages are logged with level INFO and other messages with level DEBUG.
+        """
+        self.updateFunction = updateFunction
+        self.minIntervalSec = minIntervalSec
+        self.numberOfStages = 1
+        self.stageIndex = 0
+        self.stageFraction = 0.
+        self.message = ""
+        self._lastUpdateTime = None
+
+    @property
+    def fraction(self):
+        return min(1., (self.stageIndex + self.stageFraction) / self.numberOfStages)
+
+    def setNumberOfStages(self, numberOfStages):
+        """
+        Start reporting a run of numberOfStages stages. The first startStage() call starts stage 0.
+        """
+        self.numberOfStages = max(1, numberOfStages)
+        self.stageIndex = -1
+        self.stageFraction = 0.
+
+    def startStage(self, message):
+        self.stageIndex = min(self.stageIndex + 1, self.numberOfStages - 1)
+        self.stageFraction = 0.
+        self._update(message, True, logging.INFO)
+
+    def report(self, message, stageFraction=None):
+        """
+        Report a message within the current stage, optionally with the fraction (0..1) of the stage that is done.
+        The message is dropped if the last update is less than minIntervalSec ago.
+        """
+        if stageFraction is not None:
+            self.stageFraction = min(max(stageFraction, 0.), 1.)
+        self._update(message, False, logging.DEBUG)
+
+    def finish(self, message):
+        self.stageIndex = self.numberOfStages
+        self.stageFraction = 0.
+        self._update(message, True, logging.INFO)
+
+    def _update(self, message, force, logLevel):
+        self.message = message
+        if not self.updateFunction:
+            logging.log(logLevel, message)
+            return
+        now = time.monotonic()
+        if not force and self._lastUpdateTime is not None and now - self._lastUpdateTime < self.minIntervalSec:
+            return
+        self._lastUpdateTime = now
+        self.updateFunction(message, self.fraction)
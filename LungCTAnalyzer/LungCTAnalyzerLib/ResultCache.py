@@ -0,0 +1,124 @@
+"""
+On-disk cache of analysis results.
+
+Results are stored as JSON files named by a content hash of the input arrays and the analysis
+parameters, so analyzing the same data with the same settings again (e.g. when a study is
+reopened for review) can skip the computation. Only statistics are cached, not segmentations.
+The least recently used entries are removed when the cache grows over its size limit.
+
+This module only depends on numpy.
+"""
+
+import hashlib
+import json
+import os
+
+import numpy as np
+
+# Increment when the content of the cached results changes, to invalidate old entries
+cacheVersion = 1
+
+
+def computeCacheKey(arrays, parameters):
+    """
+    Hash of the content, type and shape of numpy arrays and of JSON-serializable parameters.
+    """
+    keyHash = hashlib.blake2b(digest_size=20)
+    keyHash.update(f"LungCTAnalyzer results {cacheVersion}".encode())
+    for array in arrays:
+        array = np.ascontiguousarray(array)
+        keyHash.update(f"{array.dtype.str} {array.shape}".encode())
+        keyHash.update(array.reshape(-1).view(np.uint8))
+    keyHash.update(json.dumps(parameters, sort_keys=True).encode())
+    return keyHash.hexdigest()
+
+
+def encodeStatistics(stats):
+    """
+    Convert statistics with (segment name, measurement) keys to a JSON-serializable dictionary.
+    """
+    measurements = {}
+    for key, value in stats.items():
+        if key == "SegmentIDs":
+            continue
+        segmentName, measurement = key
+        measurements.setdefault(segmentName, {})[measurement] = value
+    return {"SegmentIDs": list(stats["SegmentIDs"]), "measurements": measurements}
+
+
+def decodeStatistics(encodedStats):
+    stats = {"SegmentIDs": encodedStats["SegmentIDs"]}
+    for segmentName, measurements in encodedStats["measurements"].items():
+        for measurement, value in measurements.items():
+            stats[segmentName, measurement] = value
+    return stats
+
+
+def _jsonDefault(value):
+    # numpy scalars and arrays
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+class ResultCache:
+
+    def __init__(self, cacheDir, maxSizeBytes=200 * 1024 * 1024):
+        self.cacheDir = cacheDir
+        self.maxSizeBytes = maxSizeBytes
+
+    def _filename(self, key):
+        return os.path.join(self.cacheDir, key + ".json")
+
+    def get(self, key):
+        """
+        Get cached results or None if not found.
+        """
+        filename = self._filename(key)
+        try:
+            with open(filename) as f:
+                results = json.load(f)
+        except (OSError, ValueError):
+            return None
+        # modification time is the last use time for eviction
+        try:
+            os.utime(filename)
+        except OSError:
+            pass
+        return results
+
+    def put(self, key, results):
+        os.makedirs(self.cacheDir, exist_ok=True)
+        filename = self._filename(key)
+        with open(filename + ".tmp", "w") as f:
+            json.dump(results, f, default=_jsonDefault)
+        os.replace(filename + ".tmp", filename)
+        self.evict()
+
+    def evict(self):
+        """
+        Remove least recently used entries until the cache size is within the limit.
+        """
+        entries = []
+        for entry in os.scandir(self.cacheDir):
+            if entry.name.endswith(".json"):
+                entryStat = entry.stat()
+                entries.append((entryStat.st_mtime, entryStat.st_size, entry.path))
+        totalSize = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if totalSize <= self.maxSizeBytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            totalSize -= size
+
+    def clear(self):
+        if not os.path.isdir(self.cacheDir):
+            return
+        for entry in os.scandir(self.cacheDir):
+            if entry.name.endswith(".json"):
+                os.remove(entry.path)
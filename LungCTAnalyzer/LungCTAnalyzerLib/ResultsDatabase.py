@@ -0,0 +1,212 @@
+"""
+SQLite store of analysis and segmentation results.
+
+The CSV result files contain one wide row per case, with the case identified by free text user
+columns. The database stores the same results in narrow, indexed tables, so cohort queries (for
+example all cases with more than 10 % emphysema) are index lookups instead of CSV scans:
+
+- cases: one row per input file (file path, case name and case number as in the CSV files)
+- runs: one row per analysis or segmentation of a case, with the parameters as JSON
+- volumes: volume (ml) and percentage of the lung (or region) per run, region, side and class
+- calibration: named calibration values per run (e.g. mean air and muscle HU of the segmenter)
+
+Several processes (e.g. parallel batch workers) may write to the same database file.
+Query results are returned as dictionaries of numpy arrays (one per column), which can be
+passed to pandas.DataFrame directly.
+
+This module only depends on numpy.
+"""
+
+import json
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+from .AnalysisCore import calculateLungResults, calculateRegionResults, lobeNames
+
+databaseFilename = "results.sqlite"
+
+# Result classes as named in the CSV files and the corresponding result attribute prefixes
+volumeClasses = {
+    "inflated": "functional",
+    "emphysema": "emphysema",
+    "infiltrated": "infiltrated",
+    "collapsed": "collapsed",
+    "affected": "affected",
+    }
+
+schema = """
+CREATE TABLE IF NOT EXISTS cases (
+    id INTEGER PRIMARY KEY,
+    filepath TEXT NOT NULL UNIQUE,
+    name TEXT,
+    number INTEGER);
+CREATE INDEX IF NOT EXISTS casesName ON cases (name);
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    caseId INTEGER NOT NULL REFERENCES cases (id),
+    module TEXT NOT NULL,
+    time REAL NOT NULL,
+    parameters TEXT);
+CREATE INDEX IF NOT EXISTS runsCase ON runs (caseId, module);
+CREATE TABLE IF NOT EXISTS volumes (
+    runId INTEGER NOT NULL REFERENCES runs (id),
+    region TEXT NOT NULL,
+    side TEXT NOT NULL,
+    className TEXT NOT NULL,
+    volumeMl REAL,
+    percent REAL);
+CREATE INDEX IF NOT EXISTS volumesClass ON volumes (className, region, side, percent);
+CREATE INDEX IF NOT EXISTS volumesRun ON volumes (runId);
+CREATE TABLE IF NOT EXISTS calibration (
+    runId INTEGER NOT NULL REFERENCES runs (id),
+    name TEXT NOT NULL,
+    value REAL);
+CREATE INDEX IF NOT EXISTS calibrationName ON calibration (name, value);
+CREATE INDEX IF NOT EXISTS calibrationRun ON calibration (runId);
+"""
+
+
+def lungVolumeRecords(volumes, countBullae=False, regions=(), lobeAnalysis=False):
+    """
+    Get (region, side, class, volume ml, percent) records from segment name -> volume in cm3.
+    The whole lungs are stored as region "lung", regions (e.g. "ventral") and lobes
+    (e.g. "upper lobe") only if they are given resp. lobeAnalysis is enabled.
+    Percentages of the "total" class are the share of the side in the volume of both lungs.
+    """
+    records = []
+    lungResults = calculateLungResults(volumes, countBullae)
+    for side in ["Total", "Right", "Left"]:
+        records.append(("lung", side.lower(), "total", lungResults[side.lower() + "LungVolume"],
+            lungResults[side.lower() + "LungVolumePerc"]))
+        for className, prefix in volumeClasses.items():
+            records.append(("lung", side.lower(), className, lungResults[f"{prefix}{side}Volume"],
+                lungResults[f"{prefix}{side}VolumePerc"]))
+
+    def addRegionRecords(region, sides):
+        regionResults = calculateRegionResults(volumes, region, countBullae)
+        for side in sides:
+            records.append((region, side.lower(), "total", regionResults[side.lower() + "ResultLungVolume"],
+                regionResults[side.lower() + "ResultLungVolumePerc"]))
+            for className, prefix in volumeClasses.items():
+                records.append((region, side.lower(), className, regionResults[f"{prefix}Result{side}Volume"],
+                    regionResults[f"{prefix}Result{side}VolumePerc"]))
+
+    for region in regions:
+        addRegionRecords(region, ["Total", "Right", "Left"])
+    if lobeAnalysis:
+        lobeSides = {}
+        for lobeName in lobeNames:
+            side, lobe = lobeName.split(" ", 1)
+            lobeSides.setdefault(lobe, []).append(side.capitalize())
+        for lobe, sides in lobeSides.items():
+            addRegionRecords(lobe, sides)
+    return records
+
+
+def _toArrays(columnNames, rows):
+    columns = {}
+    for columnIndex, columnName in enumerate(columnNames):
+        values = [row[columnIndex] for row in rows]
+        if all(value is None or isinstance(value, (int, float)) for value in values):
+            columns[columnName] = np.array([np.nan if value is None else value for value in values], np.float64)
+        else:
+            columns[columnName] = np.array(["" if value is None else str(value) for value in values], str)
+    return columns
+
+
+class ResultsDatabase:
+
+    def __init__(self, filename, timeoutSec=120.):
+        self.filename = filename
+        # the connection is shared with background writer threads, access is serialized by the lock
+        self.connection = sqlite3.connect(filename, timeout=timeoutSec, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock:
+            # write-ahead logging lets readers work while another process writes
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            with self.connection:
+                self.connection.executescript(schema)
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def addRun(self, module, filepath, caseName=None, caseNumber=None, parameters=None,
+        volumeRecords=(), calibrationValues=None, replaceExisting=True):
+        """
+        Add the results of one run of a module (e.g. "LungCTAnalyzer") on a case.
+        volumeRecords are (region, side, class, volume ml, percent) tuples (see lungVolumeRecords),
+        calibrationValues a dict of name -> value. If replaceExisting is True, earlier runs
+        of the same module on the case are removed. Returns the id of the run.
+        """
+        parametersJson = json.dumps(parameters, sort_keys=True, default=str) if parameters is not None else None
+        with self.lock, self.connection:
+            cursor = self.connection.cursor()
+            cursor.execute("INSERT INTO cases (filepath, name, number) VALUES (?, ?, ?) "
+                "ON CONFLICT (filepath) DO UPDATE SET name = excluded.name, number = excluded.number",
+                (filepath, caseName, caseNumber))
+            caseId = cursor.execute("SELECT id FROM cases WHERE filepath = ?", (filepath,)).fetchone()[0]
+            if replaceExisting:
+                runIds = [(runId,) for runId, in cursor.execute(
+                    "SELECT id FROM runs WHERE caseId = ? AND module = ?", (caseId, module))]
+                cursor.executemany("DELETE FROM volumes WHERE runId = ?", runIds)
+                cursor.executemany("DELETE FROM calibration WHERE runId = ?", runIds)
+                cursor.executemany("DELETE FROM runs WHERE id = ?", runIds)
+            cursor.execute("INSERT INTO runs (caseId, module, time, parameters) VALUES (?, ?, ?, ?)",
+                (caseId, module, time.time(), parametersJson))
+            runId = cursor.lastrowid
+            cursor.executemany("INSERT INTO volumes (runId, region, side, className, volumeMl, percent) VALUES (?, ?, ?, ?, ?, ?)",
+                [(runId, region, side, className, float(volumeMl), float(percent))
+                for region, side, className, volumeMl, percent in volumeRecords])
+            if calibrationValues:
+                cursor.executemany("INSERT INTO calibration (runId, name, value) VALUES (?, ?, ?)",
+                    [(runId, name, float(value)) for name, value in calibrationValues.items()])
+        return runId
+
+    def query(self, sql, parameters=()):
+        """
+        Run an SQL query and return a dict of column name -> numpy array.
+        Columns containing only numbers (or NULL, returned as NaN) are float64, others are strings.
+        """
+        with self.lock:
+            cursor = self.connection.execute(sql, parameters)
+            rows = cursor.fetchall()
+        return _toArrays([description[0] for description in cursor.description], rows)
+
+    def volumes(self, className, region="lung", side="total", minPercent=None, maxPercent=None, module="LungCTAnalyzer"):
+        """
+        Get the volume and percentage of a class (e.g. "emphysema") of all cases, optionally
+        only cases with a percentage in [minPercent, maxPercent].
+        Returns arrays of filepath, caseName, caseNumber, volumeMl and percent.
+        """
+        sql = ("SELECT cases.filepath AS filepath, cases.name AS caseName, cases.number AS caseNumber, "
+            "volumes.volumeMl AS volumeMl, volumes.percent AS percent FROM volumes "
+            "JOIN runs ON runs.id = volumes.runId JOIN cases ON cases.id = runs.caseId "
+            "WHERE volumes.className = ? AND volumes.region = ? AND volumes.side = ? AND runs.module = ?")
+        parameters = [className, region, side, module]
+        if minPercent is not None:
+            sql += " AND volumes.percent >= ?"
+            parameters.append(minPercent)
+        if maxPercent is not None:
+            sql += " AND volumes.percent <= ?"
+            parameters.append(maxPercent)
+        return self.query(sql + " ORDER BY cases.number, cases.filepath", parameters)
+
+    def calibration(self, name, module="LungCTSegmenter"):
+        """
+        Get a calibration value (e.g. "meanAirHU") of all cases.
+        Returns arrays of filepath, caseName, caseNumber and value.
+        """
+        return self.query("SELECT cases.filepath AS filepath, cases.name AS caseName, cases.number AS caseNumber, "
+            "calibration.value AS value FROM calibration "
+            "JOIN runs ON runs.id = calibration.runId JOIN cases ON cases.id = runs.caseId "
+            "WHERE calibration.name = ? AND runs.module = ? ORDER BY cases.number, cases.filepath", (name, module))
@@ -0,0 +1,217 @@
+"""
+Collection of result rows for the batch CSV files.
+
+Rows are gathered in memory and written in bulk by flush(): the CSV file is read, the new rows
+are merged in and the complete file is written to a temporary file that replaces the original,
+so readers never see partially written lines. As each flush rewrites the whole file, batch
+processing flushes every few cases, not after each case. A lock file next to the CSV file
+serializes flushes of several processes (e.g. parallel batch workers) writing to the same output
+folder. If the columns of a result file change (e.g. other result options), the existing file is
+renamed and a new file is started, so that rows are never written under the wrong columns.
+
+The CSV format is the one of the original result files: semicolon separated, quoted header
+items and a trailing separator on each line. Result files can also be exported to a columnar
+format (Parquet if pyarrow is available, compressed numpy .npz otherwise) for fast loading.
+
+This module only depends on numpy (pyarrow is optional).
+"""
+
+import logging
+import os
+import threading
+import time
+
+import numpy as np
+
+
+class FileLock:
+    """
+    Lock that is held by creating a lock file exclusively. Lock files older than
+    staleTimeoutSec are assumed to be left behind by a crashed process and are removed.
+    """
+
+    def __init__(self, filename, timeoutSec=120., staleTimeoutSec=300.):
+        self.filename = filename
+        self.timeoutSec = timeoutSec
+        self.staleTimeoutSec = staleTimeoutSec
+
+    def __enter__(self):
+        startTime = time.time()
+        while True:
+            try:
+                fd = os.open(self.filename, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                os.close(fd)
+                return self
+            except FileExistsError:
+                pass
+            try:
+                if time.time() - os.path.getmtime(self.filename) > self.staleTimeoutSec:
+                    os.remove(self.filename)
+                    continue
+            except OSError:
+                continue
+            if time.time() - startTime > self.timeoutSec:
+                raise TimeoutError(f"Could not acquire lock '{self.filename}'.")
+            time.sleep(0.05)
+
+    def __exit__(self, *args):
+        try:
+            os.remove(self.filename)
+        except OSError:
+            pass
+
+
+def formatHeader(header):
+    return "".join(f'"{item}";' for item in header) + "\n"
+
+
+def formatRow(row):
+    return "".join(f"{item};" for item in row) + "\n"
+
+
+def parseLine(line):
+    items = line.rstrip("\n").split(";")
+    # lines end with a separator
+    if items and items[-1] == "":
+        items = items[:-1]
+    return items
+
+
+def appendRow(filename, header, row):
+    """
+    Append a row to a CSV file (the header is written if the file is new), lock protected,
+    so that several processes can add rows to the same file. Existing rows are not changed.
+    """
+    with FileLock(filename + ".lock"):
+        fileExists = os.path.isfile(filename)
+        with open(filename, "a") as f:
+            if not fileExists:
+                f.write(formatHeader(header))
+            f.write(formatRow(row))
+
+
+def renameOutdatedFile(filename):
+    """
+    Rename a result file by appending its modification time to the name and return the new filename.
+    """
+    basename, extension = os.path.splitext(filename)
+    renamedBasename = basename + time.strftime(".%Y%m%d-%H%M%S", time.localtime(os.path.getmtime(filename)))
+    renamedFilename = renamedBasename + extension
+    counter = 1
+    while os.path.exists(renamedFilename):
+        counter += 1
+        renamedFilename = f"{renamedBasename}-{counter}{extension}"
+    os.replace(filename, renamedFilename)
+    return renamedFilename
+
+
+def readCsv(filename):
+    """
+    Read a result CSV file. Returns (header, rows), items are strings.
+    """
+    with open(filename) as f:
+        lines = f.readlines()
+    if not lines:
+        return [], []
+    header = [item.strip('"') for item in parseLine(lines[0])]
+    return header, [parseLine(line) for line in lines[1:] if line.strip()]
+
+
+class ResultsSink:
+
+    def __init__(self, outputDir):
+        self.outputDir = outputDir
+        self.pendingRows = {}
+        self.headers = {}
+        self.lock = threading.Lock()
+
+    def addRow(self, csvFilename, header, row):
+        """
+        Add a row to a result file (filename relative to the output folder).
+        The row may be shorter than the header. All pending rows of a file must have the same header.
+        """
+        header = [str(item) for item in header]
+        with self.lock:
+            if self.pendingRows.get(csvFilename) and self.headers[csvFilename] != header:
+                raise ValueError(f"Columns of '{csvFilename}' changed while rows are pending.")
+            self.headers[csvFilename] = header
+            self.pendingRows.setdefault(csvFilename, []).append(list(row))
+
+    def discardRows(self, case):
+        """
+        Remove the pending rows of a case (first column, the input file path) from all result files,
+        e.g. of a case whose output files could not be written.
+        """
+        with self.lock:
+            for csvFilename, rows in self.pendingRows.items():
+                self.pendingRows[csvFilename] = [row for row in rows if str(row[0]) != str(case)]
+
+    def flush(self, replaceExisting=True):
+        """
+        Write pending rows to the CSV files. If replaceExisting is True, existing rows of the same
+        case (same first column, the input file path) are replaced, so rerunning a case does not
+        create duplicate rows. Rows are ordered by case number (second column) if it is numeric.
+        If writing fails, the rows that are not written stay pending.
+        """
+        with self.lock:
+            pendingRows = self.pendingRows
+            self.pendingRows = {}
+        try:
+            for csvFilename in list(pendingRows.keys()):
+                self._writeRows(csvFilename, pendingRows[csvFilename], replaceExisting)
+                del pendingRows[csvFilename]
+        finally:
+            if pendingRows:
+                with self.lock:
+                    for csvFilename, rows in self.pendingRows.items():
+                        pendingRows.setdefault(csvFilename, []).extend(rows)
+                    self.pendingRows = pendingRows
+
+    def _writeRows(self, csvFilename, newRows, replaceExisting):
+        if not newRows:
+            return
+        filename = os.path.join(self.outputDir, csvFilename)
+        with FileLock(filename + ".lock"):
+            header = self.headers[csvFilename]
+            rows = []
+            if os.path.isfile(filename):
+                existingHeader, rows = readCsv(filename)
+                if existingHeader and existingHeader != header:
+                    logging.warning(f"Columns of '{filename}' changed, the existing file is renamed to '{renameOutdatedFile(filename)}'.")
+                    rows = []
+            if replaceExisting:
+                newCases = {str(row[0]) for row in newRows}
+                rows = [row for row in rows if row[0] not in newCases]
+            rows += [[str(item) for item in row] for row in newRows]
+            try:
+                rows.sort(key=lambda row: int(row[1]))
+            except (IndexError, ValueError):
+                pass
+            with open(filename + ".tmp", "w") as f:
+                f.write(formatHeader(header) + "".join(formatRow(row) for row in rows))
+            os.replace(filename + ".tmp", filename)
+
+
+def exportColumnar(csvFilename):
+    """
+    Export a result CSV file to a columnar file next to it and return its filename:
+    .parquet if pyarrow is available, otherwise .npz with one array per column.
+    Columns that only contain numbers are stored as float64, missing values as NaN.
+    """
+    header, rows = readCsv(csvFilename)
+    columns = {}
+    for columnIndex, columnName in enumerate(header):
+        values = [row[columnIndex] if columnIndex < len(row) else "" for row in rows]
+        try:
+            columns[columnName] = np.array([float(value) if value != "" else np.nan for value in values], np.float64)
+        except ValueError:
+            columns[columnName] = np.array(values, str)
+    basename = os.path.splitext(csvFilename)[0]
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        np.savez_compressed(basename + ".npz", **columns)
+        return basename + ".npz"
+    pyarrow.parquet.write_table(pyarrow.table(columns), basename + ".parquet")
+    return basename + ".parquet"
@@ -0,0 +1,158 @@
+"""
+Timing and memory measurement of the stages of long running logic methods.
+
+A StageTimer measures consecutive named stages: startStage() ends the current stage and starts the
+next one, stop() ends the last stage. For each stage the wall time, the CPU time of the process
+(of all threads, so it exceeds the wall time when ITK or numpy use several cores) and the increase
+of the peak resident set size of the process are recorded. If Python memory allocations are traced
+(tracemalloc), the peak of the memory allocated during the stage is recorded as well; numpy arrays
+are included, VTK and ITK buffers are not.
+
+Timings of a stage that is started several times are accumulated.
+
+This module does not depend on Slicer.
+"""
+
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+# columns of the timings added to a results CSV file: timing name, column name suffix
+csvTimingColumns = [
+    ("wallTimeSec", "s"),
+    ("cpuTimeSec", "cpu s"),
+    ("peakRssIncreaseMB", "peak rss MB"),
+    ]
+
+
+def getPeakRssBytes():
+    """
+    Get the peak resident set size (Windows: peak working set) of the process, None if it is not available.
+    """
+    if sys.platform == "win32":
+        import ctypes
+        from ctypes import wintypes
+
+        class PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+            _fields_ = [("cb", wintypes.DWORD), ("PageFaultCount", wintypes.DWORD),
+                ("PeakWorkingSetSize", ctypes.c_size_t), ("WorkingSetSize", ctypes.c_size_t),
+                ("QuotaPeakPagedPoolUsage", ctypes.c_size_t), ("QuotaPagedPoolUsage", ctypes.c_size_t),
+                ("QuotaPeakNonPagedPoolUsage", ctypes.c_size_t), ("QuotaNonPagedPoolUsage", ctypes.c_size_t),
+                ("PagefileUsage", ctypes.c_size_t), ("PeakPagefileUsage", ctypes.c_size_t)]
+
+        counters = PROCESS_MEMORY_COUNTERS()
+        counters.cb = ctypes.sizeof(counters)
+        try:
+            psapi = ctypes.WinDLL("psapi")
+            psapi.GetProcessMemoryInfo.argtypes = [wintypes.HANDLE, ctypes.POINTER(PROCESS_MEMORY_COUNTERS), wintypes.DWORD]
+            if not psapi.GetProcessMemoryInfo(ctypes.windll.kernel32.GetCurrentProcess(), ctypes.byref(counters), counters.cb):
+                return None
+        except (OSError, AttributeError):
+            return None
+        return counters.PeakWorkingSetSize
+    try:
+        import resource
+    except ImportError:
+        return None
+    maxRss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes on Linux
+    return maxRss if sys.platform == "darwin" else maxRss * 1024
+
+
+class StageTimer:
+
+    def __init__(self, traceAllocations=False):
+        """
+        If traceAllocations is True, tracing of Python memory allocations is started for the measurement
+        (this slows down pure Python code considerably). Allocations are also measured if tracing was
+        started before, e.g. by setting the PYTHONTRACEMALLOC environment variable.
+        """
+        self.timings = {}
+        self.stageName = None
+        self._startedTracing = False
+        if traceAllocations and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._startedTracing = True
+        self._totalStart = None
+
+    def _now(self):
+        return time.perf_counter(), time.process_time(), getPeakRssBytes()
+
+    def startStage(self, name):
+        """
+        End the current stage (if any) and start measuring stage name.
+        """
+        self._endStage()
+        self.stageName = name
+        self._stageStart = self._now()
+        if self._totalStart is None:
+            self._totalStart = self._stageStart
+        self._allocatedStart = None
+        if tracemalloc.is_tracing():
+            tracemalloc.reset_peak()
+            self._allocatedStart = tracemalloc.get_traced_memory()[0]
+
+    def stop(self):
+        """
+        End the current stage and add the "total" of all stages. Returns the timings.
+        """
+        self._endStage()
+        if self._totalStart is not None:
+            self.timings["total"] = self._getTiming(self._totalStart, self._now())
+            self._totalStart = None
+        if self._startedTracing:
+            tracemalloc.stop()
+            self._startedTracing = False
+        return self.timings
+
+    def _getTiming(self, start, end):
+        return {
+            "wallTimeSec": end[0] - start[0],
+            "cpuTimeSec": end[1] - start[1],
+            "peakRssIncreaseMB": (end[2] - start[2]) / 2**20 if start[2] is not None and end[2] is not None else None,
+            }
+
+    def _endStage(self):
+        if self.stageName is None:
+            return
+        timing = self._getTiming(self._stageStart, self._now())
+        if self._allocatedStart is not None and tracemalloc.is_tracing():
+            timing["allocatedPeakMB"] = (tracemalloc.get_traced_memory()[1] - self._allocatedStart) / 2**20
+        previousTiming = self.timings.get(self.stageName)
+        if previousTiming:
+            for key, value in timing.items():
+                if value is None or previousTiming.get(key) is None:
+                    continue
+                # times add up, memory peaks do not
+                previousTiming[key] = previousTiming[key] + value if key.endswith("Sec") else max(previousTiming[key], value)
+        else:
+            self.timings[self.stageName] = timing
+        self.stageName = None
+
+
+def writeTimings(filename, timings, **info):
+    """
+    Write timings (and additional information, e.g. the input file) to a JSON file.
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+    with open(filename + ".tmp", "w") as f:
+        json.dump(dict(info, stages=timings), f, indent=2)
+    os.replace(filename + ".tmp", filename)
+
+
+def getCsvColumns(timings, stageNames):
+    """
+    Get header and values of the timings of stageNames (and the total) for a results CSV file.
+    The header only depends on stageNames, values of stages that did not run are empty.
+    """
+    header = []
+    row = []
+    for stageName in list(stageNames) + ["total"]:
+        timing = timings.get(stageName, {})
+        for timingName, columnSuffix in csvTimingColumns:
+            header.append(f"{stageName} {columnSuffix}")
+            value = timing.get(timingName)
+            row.append("" if value is None else f"{value:.3f}")
+    return header, row
@@ -0,0 +1 @@
+from .AnalysisCore import *
@@ -91,6 +91,9 @@ class LungCTSegmenterWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
       self.batchProcessingOutputDir = ""
       self.batchProcessingTestMode = False
       self.isNiiGzFormat = False
+      self.writeResultsDatabase = False
+      self.outputCompression = "fast"
+      self.minimalOutput = False
       self.batchProcessingIsCancelled = False
       self.calibrateData = False
       
@@ -227,6 +230,9 @@ class LungCTSegmenterWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
       self.ui.smoothLungsCheckBox.connect('toggled(bool)', self.updateParameterNodeFromGUI)
       self.ui.testModeCheckBox.connect('toggled(bool)', self.updateParameterNodeFromGUI)
       self.ui.niigzFormatCheckBox.connect('toggled(bool)', self.updateParameterNodeFromGUI)
+      self.ui.resultsDatabaseCheckBox.connect('toggled(bool)', self.updateParameterNodeFromGUI)
+      self.ui.outputCompressionComboBox.currentTextChanged.connect(self.updateParameterNodeFromGUI)
+      self.ui.minimalOutputCheckBox.connect('toggled(bool)', self.updateParameterNodeFromGUI)
       self.ui.calibrateDataCheckBox.connect('toggled(bool)', self.updateParameterNodeFromGUI)
 
       for key, uiid in self.outputCheckBoxesDict.items():
@@ -272,6 +278,18 @@ class LungCTSegmenterWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         self.isNiiGzFormat = eval(settings.value("LungCtSegmenter/niigzFormatCheckBoxChecked", ""))
         self.ui.niigzFormatCheckBox.checked = eval(settings.value("LungCtSegmenter/niigzFormatCheckBoxChecked", ""))
 
+      if settings.value("LungCtSegmenter/resultsDatabaseCheckBoxChecked", "") != "":
+        self.writeResultsDatabase = eval(settings.value("LungCtSegmenter/resultsDatabaseCheckBoxChecked", ""))
+        self.ui.resultsDatabaseCheckBox.checked = self.writeResultsDatabase
+
+      if settings.value("LungCtSegmenter/outputCompression", "") != "":
+        self.outputCompression = settings.value("LungCtSegmenter/outputCompression", "")
+        self.ui.outputCompressionComboBox.currentText = self.outputCompression
+
+      if settings.value("LungCtSegmenter/minimalOutputCheckBoxChecked", "") != "":
+        self.minimalOutput = eval(settings.value("LungCtSegmenter/minimalOutputCheckBoxChecked", ""))
+        self.ui.minimalOutputCheckBox.checked = self.minimalOutput
+
       if settings.value("LungCtSegmenter/fastCheckBoxChecked", "") != "":
           self.fastOption = eval(settings.value("LungCtSegmenter/fastCheckBoxChecked", ""))
           self.ui.fastCheckBox.checked = eval(settings.value("LungCtSegmenter/fastCheckBoxChecked", ""))
@@ -447,6 +465,24 @@ class LungCTSegmenterWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
       if os.path.exists(self.batchProcessingOutputDir + "/results.csv"):
           os.remove(self.batchProcessingOutputDir + "/results.csv")
 
+      # NIFTI outputs are snapshots of the output arrays that are written in the background while the next
+      # case is segmented. The writer is bounded by the size of the pending snapshots. It is part of the
+      # Lung CT Analyzer module, without it the outputs are written directly.
+      # progress of the segmentation of a case is only logged
+      try:
+          from LungCTAnalyzerLib import ProgressReporter
+          self.logic.progressReporter = ProgressReporter.ProgressReporter()
+      except ImportError:
+          pass
+
+      writer = None
+      if self.isNiiGzFormat:
+          try:
+              from LungCTAnalyzerLib import BatchIO
+              writer = BatchIO.BackgroundWriter(maxPendingTasks=256, maxPendingBytes=self.logic.outputWriterMaxPendingMB * 1024 * 1024)
+          except ImportError:
+              logging.warning("Lung CT Analyzer module is not available, output files are written before the next case is started.")
+
       if self.batchProcessingTestMode:
           filesToProcess = 3
       for filename in glob.iglob(self.batchProcessingInputDir + pattern, recursive=True):
@@ -464,6 +500,8 @@ class LungCTSegmenterWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
               print("Processing '" + filename + "' ...")
                             
               slicer.mrmlScene.Clear(0)
+              # timings of an earlier case are not written for a case that is not segmented
+              self.logic.stageTimings = {}
 
               import torch
               torch.cuda.empty_cache() 
@@ -497,9 +535,13 @@ class LungCTSegmenterWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
                   if not os.path.exists(targetdir):
                       os.makedirs(targetdir)
 
-                  if self.isNiiGzFormat:
+                  if self.isNiiGzFormat and writer:
+                      self.showStatusMessage("Queueing NIFTI output files for input " + str(counter) +  "/" + str(filesToProcess) + " to '" + targetdir + "' ...")
+                      for function, args, sizeBytes in self.logic.getNiftiOutputWriteTasks(targetdir, self.outputCompression, self.minimalOutput):
+                          writer.submit(function, *args, sizeBytes=sizeBytes, group=filename)
+                  elif self.isNiiGzFormat:
                       self.showStatusMessage("Writing NIFTI output files for input " + str(counter) +  "/" + str(filesToProcess) + " to '" + targetdir + "' ...")
-                      for volumeNode in slicer.util.getNodesByClass("vtkMRMLScalarVolumeNode"):
+                      for volumeNode in self.logic.getOutputVolumeNodes(self.minimalOutput):
                         volumeNode.AddDefaultStorageNode()
                         slicer.util.saveNode(volumeNode, targetdir + volumeNode.GetName().lower() + ".nii.gz")
                       numberOfSegments = self.logic.outputSegmentation.GetSegmentation().GetNumberOfSegments()
@@ -518,11 +560,32 @@ class LungCTSegmenterWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
                       sceneSaveFilename = targetdir + "ct_seg.mrb"
                       self.showStatusMessage("Writing mrb output file for input " + str(counter) +  "/" + str(filesToProcess) + " (last process: {0:.2f} s ".format(durationProcess) + ", time remaining {0:.2f} m ".format((durationProcess *(filesToProcess-counter))/60.) + ") to '" + sceneSaveFilename + "' ...")
                       print('Saving scene to ' + sceneSaveFilename)
+                      if self.minimalOutput:
+                        self.logic.removeIntermediateNodes(self.logic.getEssentialOutputNodes())
+                      # the scene archive itself is always compressed, the setting applies to the files in it
+                      for node in slicer.util.getNodesByClass("vtkMRMLScalarVolumeNode") + slicer.util.getNodesByClass("vtkMRMLSegmentationNode"):
+                        node.AddDefaultStorageNode()
+                        node.GetStorageNode().SetUseCompression(self.outputCompression != "none")
                       if slicer.util.saveScene(sceneSaveFilename):
                         logging.info("Scene saved to: {0}".format(sceneSaveFilename))
                       else:
                         logging.error("Scene saving failed") 
-                  self.logic.saveExtendedDataToFile(self.batchProcessingOutputDir + "/results.csv",str(counter),outpathtail,outpathtail)
+                  # Results of the case are written after its output files (by the writer, with the current values),
+                  # so a case whose output files could not be written has no results
+                  import functools
+                  header, data = self.logic.getExtendedDataRow(str(counter),outpathtail,outpathtail)
+                  caseResultTasks = [functools.partial(self.logic.saveRowToFile, self.batchProcessingOutputDir + "/results.csv", header, data)]
+                  if self.logic.stageTimings:
+                      from LungCTAnalyzerLib import StageTimer
+                      caseResultTasks.append(functools.partial(StageTimer.writeTimings, targetdir + "timings.json", self.logic.stageTimings, filepath=filename))
+                  if self.writeResultsDatabase:
+                      caseResultTasks.append(functools.partial(self.logic.saveResultsToDatabase, self.batchProcessingOutputDir + "/results.sqlite",
+                          filename, counter, outpathtail, *self.logic.getResultsDatabaseValues()))
+                  for caseResultTask in caseResultTasks:
+                      if writer:
+                          writer.submit(caseResultTask, group=filename)
+                      else:
+                          caseResultTask()
               stopProcessWatchTime = time.time()
               durationProcess = stopProcessWatchTime - startProcessWatchTime
               
@@ -535,13 +598,22 @@ class LungCTSegmenterWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
               break
           if self.batchProcessingTestMode and counter > 2:
               break
-      stopWatchTime = time.time()
-      if self.batchProcessingIsCancelled: 
-          print('Batch processing cancelled after {0:.2f} seconds'.format(stopWatchTime-startWatchTime))
-          self.showStatusMessage("Batch processing cancelled.")
-      else: 
-          print('Batch processing completed in {0:.2f} seconds'.format(stopWatchTime-startWatchTime))
-          self.showStatusMessage("Batch processing done.")
+      self.logic.progressReporter = None
+      try:
+          if writer:
+              self.showStatusMessage("Waiting for output files to be written ...")
+              writer.close()
+      finally:
+          if writer and writer.failedGroups:
+              logging.error(f"Writing the outputs of {len(writer.failedGroups)} cases failed, they have no results: "
+                  + ", ".join(writer.failedGroups.keys()))
+          stopWatchTime = time.time()
+          if self.batchProcessingIsCancelled: 
+              print('Batch processing cancelled after {0:.2f} seconds'.format(stopWatchTime-startWatchTime))
+              self.showStatusMessage("Batch processing cancelled.")
+          else: 
+              print('Batch processing completed in {0:.2f} seconds'.format(stopWatchTime-startWatchTime))
+              self.showStatusMessage("Batch processing done.")
 
 
   def onShiftSliderWidgetChanged(self):
@@ -714,6 +786,9 @@ class LungCTSegmenterWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
       
       self.ui.testModeCheckBox.checked = self.batchProcessingTestMode
       self.ui.niigzFormatCheckBox.checked = self.isNiiGzFormat
+      self.ui.resultsDatabaseCheckBox.checked = self.writeResultsDatabase
+      self.ui.outputCompressionComboBox.currentText = self.outputCompression
+      self.ui.minimalOutputCheckBox.checked = self.minimalOutput
       self.ui.shrinkMasksCheckBox.checked = self.shrinkMasks
       self.ui.detailedMasksCheckBox.checked = self.detailedMasks
       self.ui.saveFiducialsCheckBox.checked = self.saveFiducials
@@ -790,6 +865,15 @@ class LungCTSegmenterWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
       self.isNiiGzFormat = self.ui.niigzFormatCheckBox.checked 
       settings.setValue("LungCtSegmenter/niigzFormatCheckBoxChecked", str(self.isNiiGzFormat))
 
+      self.writeResultsDatabase = self.ui.resultsDatabaseCheckBox.checked
+      settings.setValue("LungCtSegmenter/resultsDatabaseCheckBoxChecked", str(self.writeResultsDatabase))
+
+      self.outputCompression = self.ui.outputCompressionComboBox.currentText
+      settings.setValue("LungCtSegmenter/outputCompression", self.outputCompression)
+
+      self.minimalOutput = self.ui.minimalOutputCheckBox.checked
+      settings.setValue("LungCtSegmenter/minimalOutputCheckBoxChecked", str(self.minimalOutput))
+
       self.smoothLungs = self.ui.smoothLungsCheckBox.checked 
       settings.setValue("LungCtSegmenter/smoothLungsCheckBoxChecked", str(self.smoothLungs))
         
@@ -1301,6 +1385,15 @@ class LungCTSegmenterLogic(ScriptedLoadableModuleLogic):
         self.medianLungs = 0.
         self.slope = 0.
         self.intercept = 0.
+        # Size limit of the output array snapshots waiting to be written in batch processing
+        self.outputWriterMaxPendingMB = 1024
+        # LungCTAnalyzerLib.ProgressReporter.ProgressReporter, created by getProgressReporter() if not set
+        self.progressReporter = None
+        # Timings of the steps of the last applySegmentation() run (see LungCTAnalyzerLib.StageTimer), by step name
+        self.stageTimer = None
+        self.stageTimings = {}
+        # trace Python memory allocations in the steps of applySegmentation() (slows down processing)
+        self.traceAllocations = False
         
     def __del__(self):
         self.removeTemporaryObjects()
@@ -1438,11 +1531,13 @@ class LungCTSegmenterLogic(ScriptedLoadableModuleLogic):
         return np.clip(rgbBrighter, 0.0, 1.0)
 
     def saveExtendedDataToFile(self,filename,user_str1,user_str2,user_str3):
-        import os.path
-        file_exists = os.path.isfile(filename)
-
-        import csv
+        header, data = self.getExtendedDataRow(user_str1,user_str2,user_str3)
+        self.saveRowToFile(filename, header, data)
 
+    def getExtendedDataRow(self,user_str1,user_str2,user_str3):
+        """
+        Get header and values of the calibration results of the current case.
+        """
         header = [
         'user1',
         'user2',
@@ -1462,6 +1557,13 @@ class LungCTSegmenterLogic(ScriptedLoadableModuleLogic):
         self.slope,
         self.intercept
         ]
+        return header, data
+
+    def saveRowToFile(self, filename, header, data):
+        """
+        Append a row to a CSV file, the header is written if the file does not exist.
+        """
+        file_exists = os.path.isfile(filename)
         try:
             with open(filename, 'a') as f:
                 if not file_exists:
@@ -1478,6 +1580,105 @@ class LungCTSegmenterLogic(ScriptedLoadableModuleLogic):
         except IOError:
             logging.error("I/O error")
 
+    def getEssentialOutputNodes(self):
+        """
+        Nodes that are written in the minimal output profile: the input CT, the calibrated CT (if any)
+        and the lung segmentation, which is all that Lung CT Analyzer reads from the output.
+        """
+        return self.getOutputVolumeNodes(True) + ([self.outputSegmentation] if self.outputSegmentation else [])
+
+    def getOutputVolumeNodes(self, minimalOutput=False):
+        """
+        Volumes to be written: all scalar volumes or, for minimal output, only the input and calibrated CT.
+        """
+        if not minimalOutput:
+            return slicer.util.getNodesByClass("vtkMRMLScalarVolumeNode")
+        calibratedVolume = slicer.util.getFirstNodeByClassByName("vtkMRMLScalarVolumeNode", "CT_calibrated")
+        return [node for node in [self.inputVolume, calibratedVolume] if node]
+
+    def removeIntermediateNodes(self, keepNodes):
+        """
+        Remove all data nodes except keepNodes (and transforms) from the scene, so that intermediate results such as
+        the masked and resampled volumes or the TotalSegmentator segmentations are not saved.
+        Display and storage nodes are removed with their data node.
+        """
+        keepNodeIDs = [node.GetID() for node in keepNodes]
+        for className in ["vtkMRMLVolumeNode", "vtkMRMLSegmentationNode", "vtkMRMLModelNode", "vtkMRMLTableNode", "vtkMRMLMarkupsNode"]:
+            for node in slicer.util.getNodesByClass(className):
+                if node.GetID() not in keepNodeIDs:
+                    slicer.mrmlScene.RemoveNode(node)
+
+    def getNiftiOutputWriteTasks(self, targetdir, compression="fast", minimalOutput=False):
+        """
+        Take snapshots of the volumes and output segments of the current case for writing them as NIFTI files to targetdir.
+        Returns (function, args, sizeBytes) write tasks, which do not access the scene, so they can run on a background
+        thread (see LungCTAnalyzerLib.BatchIO.BackgroundWriter). Requires the Lung CT Analyzer module.
+        If minimalOutput is True, only the input and calibrated CT volumes are written with the segments.
+        """
+        from LungCTAnalyzerLib import BatchIO
+        tasks = []
+
+        def addVolumeTask(volumeNode, filename):
+            ijkToRas = vtk.vtkMatrix4x4()
+            volumeNode.GetIJKToRASMatrix(ijkToRas)
+            volumeArray = slicer.util.arrayFromVolume(volumeNode).copy()
+            tasks.append((BatchIO.writeVolumeArray, (filename, volumeArray, slicer.util.arrayFromVTKMatrix(ijkToRas), compression), volumeArray.nbytes))
+
+        for volumeNode in self.getOutputVolumeNodes(minimalOutput):
+            addVolumeTask(volumeNode, targetdir + volumeNode.GetName().lower() + ".nii.gz")
+        if not os.path.exists(targetdir + "lung_segmentations/"):
+            os.makedirs(targetdir + "lung_segmentations/")
+        segmentation = self.outputSegmentation.GetSegmentation()
+        labelmapVolumeNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLLabelMapVolumeNode")
+        for i in range(segmentation.GetNumberOfSegments()):
+            segment = segmentation.GetNthSegment(i)
+            segmentIds = [str(segmentation.GetSegmentIdBySegment(segment))]
+            slicer.modules.segmentations.logic().ExportSegmentsToLabelmapNode(self.outputSegmentation, segmentIds, labelmapVolumeNode, self.inputVolume)
+            addVolumeTask(labelmapVolumeNode, targetdir + "lung_segmentations/" + segment.GetName().lower().replace(" ", "_") + ".nii.gz")
+        slicer.mrmlScene.RemoveNode(labelmapVolumeNode)
+        return tasks
+
+    def saveResultsToDatabase(self, filename, filepath, caseNumber, caseName, parameters=None, calibrationValues=None):
+        """
+        Add the calibration values of the current case (or the given parameters and calibration values,
+        see getResultsDatabaseValues) to a results database of Lung CT Analyzer
+        (see LungCTAnalyzerLib/ResultsDatabase.py). Requires the Lung CT Analyzer module.
+        """
+        try:
+            from LungCTAnalyzerLib import ResultsDatabase
+        except ImportError:
+            logging.warning("Results database not written: Lung CT Analyzer module is not available.")
+            return
+
+        if parameters is None:
+            parameters, calibrationValues = self.getResultsDatabaseValues()
+        with ResultsDatabase.ResultsDatabase(filename) as resultsDatabase:
+            resultsDatabase.addRun("LungCTSegmenter", filepath, caseName, caseNumber, parameters, calibrationValues=calibrationValues)
+
+    def getResultsDatabaseValues(self):
+        """
+        Get the segmentation parameters and calibration values of the current case for the results database.
+        """
+        parameters = {
+        "engineAI": self.engineAI,
+        "fastOption": self.fastOption,
+        "calibrateData": self.calibrateData,
+        "detailedAirways": self.detailedAirways,
+        "createVessels": self.createVessels,
+        "smoothLungs": self.smoothLungs,
+        "shrinkMasks": self.shrinkMasks,
+        "detailedMasks": self.detailedMasks,
+        }
+
+        calibrationValues = {
+        "meanAirHU": self.meanAir,
+        "meanMuscleHU": self.meanMuscle,
+        "medianLungsHU": self.medianLungs,
+        "slope": self.slope,
+        "intercept": self.intercept,
+        }
+        return parameters, calibrationValues
+
     def startSegmentation(self):
         if not self.inputVolume:
           # prevent start
@@ -1649,9 +1850,44 @@ class LungCTSegmenterLogic(ScriptedLoadableModuleLogic):
         self.segmentationStarted = False
 
     def showStatusMessage(self, msg, timeoutMsec=500):
-        slicer.util.showStatusMessage(msg, timeoutMsec)
+        progressReporter = self.getProgressReporter()
+        if progressReporter:
+            progressReporter.report(msg)
+        else:
+            slicer.util.showStatusMessage(msg, timeoutMsec)
+            slicer.app.processEvents()
+
+    def getProgressReporter(self):
+        """
+        Progress is shown in the status bar (at most every 100 ms), or only logged if there is no main window.
+        Requires the Lung CT Analyzer module, returns None if it is not available.
+        """
+        if self.progressReporter is None:
+            try:
+                from LungCTAnalyzerLib import ProgressReporter
+            except ImportError:
+                return None
+            self.progressReporter = ProgressReporter.ProgressReporter(self.updateProgress if slicer.util.mainWindow() else None)
+        return self.progressReporter
+
+    def updateProgress(self, message, fraction):
+        slicer.util.showStatusMessage(message, 500)
         slicer.app.processEvents()
 
+    def startTimingStage(self, name):
+        """
+        Start measuring the next step of applySegmentation() (see stageTimings).
+        """
+        if self.stageTimer:
+            self.stageTimer.startStage(name)
+
+    def saveStageTimings(self, filename, **info):
+        """
+        Write the step timings of the last applySegmentation() run to a JSON file.
+        """
+        from LungCTAnalyzerLib import StageTimer
+        StageTimer.writeTimings(filename, self.stageTimings, **info)
+
     def trimSegmentWithCube(self, id,r,a,s,offs_r,offs_a,offs_s) :
           
         self.segmentEditorNode.SetSelectedSegmentID(id)
@@ -2187,12 +2423,36 @@ class LungCTSegmenterLogic(ScriptedLoadableModuleLogic):
             # no region growing was done
             return
 
+        # Timings of the steps (see LungCTAnalyzerLib.StageTimer), requires the Lung CT Analyzer module.
+        # They are recorded also if the segmentation fails.
+        try:
+            from LungCTAnalyzerLib import StageTimer
+            self.stageTimer = StageTimer.StageTimer(self.traceAllocations)
+            self.stageTimings = self.stageTimer.timings
+        except ImportError:
+            self.stageTimer = None
+            self.stageTimings = {}
+        try:
+            self.applySegmentationSteps()
+        finally:
+            if self.stageTimer:
+                # also stops tracing of memory allocations
+                self.stageTimer.stop()
+                self.stageTimer = None
+        if self.stageTimings:
+            logging.info('Step timings: ' + ', '.join(f'{name} {timing["wallTimeSec"]:.2f} s' for name, timing in self.stageTimings.items()))
+
+    def applySegmentationSteps(self):
+        """
+        Run the steps of applySegmentation().
+        """
         import time
         startTime = time.time()
 
         # use it
         if not self.useAI: 
             self.showStatusMessage('Finalize region growing...')
+            self.startTimingStage("region growing")
             # Ensure closed surface representation is not present (would slow down computations)
             self.outputSegmentation.RemoveClosedSurfaceRepresentation()
 
@@ -2215,6 +2475,7 @@ class LungCTSegmenterLogic(ScriptedLoadableModuleLogic):
             # fill holes
             for i, segmentId in enumerate(segmentIds):
                 self.showStatusMessage(f'Filling holes ({i+1}/{len(segmentIds)})...')
+                self.startTimingStage("fill holes")
                 self.segmentEditorNode.SetSelectedSegmentID(segmentId)
                 self.segmentEditorWidget.setActiveEffectByName("Smoothing")
                 effect = self.segmentEditorWidget.activeEffect()
@@ -2222,6 +2483,7 @@ class LungCTSegmenterLogic(ScriptedLoadableModuleLogic):
                 effect.setParameter("KernelSizeMm","12")
                 effect.self().onApply()
 
+            self.startTimingStage("resample")
             # switch to full-resolution segmentation (this is quick, there is no need for progress message)
             self.outputSegmentation.SetReferenceImageGeometryParameterFromVolumeNode(self.inputVolume)
             referenceGeometryString = self.outputSegmentation.GetSegmentation().GetConversionParameter(slicer.vtkSegmentationConverter.GetReferenceImageGeometryParameterName())
@@ -2241,6 +2503,7 @@ class LungCTSegmenterLogic(ScriptedLoadableModuleLogic):
             self.outputSegmentation.Modified()
             self.outputSegmentation.EndModify(wasModified)
 
+            self.startTimingStage("smoothing")
             # smoothing
             for i, segmentId in enumerate(segmentIds):
                 self.showStatusMessage(f'Smoothing ({i+1}/{len(segmentIds)})...')
@@ -2252,6 +2515,7 @@ class LungCTSegmenterLogic(ScriptedLoadableModuleLogic):
                 effect.self().onApply()
             
             if self.shrinkMasks: 
+                self.startTimingStage("shrinking")
                 # Final shrinking masks by 1 mm
                 for i, segmentId in enumerate(segmentIds):
                     self.showStatusMessage(f'Final shrinking ({i+1}/{len(segmentIds)})...')
@@ -2262,13 +2526,16 @@ class LungCTSegmenterLogic(ScriptedLoadableModuleLogic):
                     effect.self().onApply()
             
             if self.detailedMasks: 
+                self.startTimingStage("detailed masks")
                 self.createDetailedMasks()
 
+            self.startTimingStage("postprocess")
             # Postprocess lungs and set tags
             self.postprocessSegment(self.outputSegmentation,0,"right lung")
             self.postprocessSegment(self.outputSegmentation,1,"left lung")
         _doAI = False
         if self.useAI:
+            self.startTimingStage("AI setup")
             # Install PyTorch
             if not hasattr(slicer.modules, 'pytorchutils'):
                 slicer.util.messageBox("AI segmentation requires the PyTorchUtils module in the PyTorch extension. Install Pytorch and restart Slicer.")
@@ -2346,6 +2613,7 @@ class LungCTSegmenterLogic(ScriptedLoadableModuleLogic):
                 inputVolumeSitk = sitkUtils.PullVolumeFromSlicer(self.inputVolume)
                 if self.engineAI == "lungmask R231":
                     self.showStatusMessage('Creating lungs with lungmask AI ...')
+                    self.startTimingStage("lungmask AI")
                     if infer_mode == "mask": 
                         model = mask.get_model('unet','R231')
                         segmentation_np = mask.apply(inputVolumeSitk, model)
@@ -2360,6 +2628,7 @@ class LungCTSegmenterLogic(ScriptedLoadableModuleLogic):
                     self.postprocessSegment(self.outputSegmentation,1,"left lung")
                 elif self.engineAI == "lungmask LTRCLobes":
                     self.showStatusMessage('Creating lungs and lobes with lungmask AI ...')
+                    self.startTimingStage("lungmask AI")
                     if infer_mode == "mask": 
                         model = mask.get_model('unet','LTRCLobes')
                         segmentation_np = mask.apply(inputVolumeSitk, model)
@@ -2380,6 +2649,7 @@ class LungCTSegmenterLogic(ScriptedLoadableModuleLogic):
                     self.postprocessSegment(self.outputSegmentation,4,"right lower lobe")
                 elif self.engineAI == "lungmask LTRCLobes_R231":
                     self.showStatusMessage('Creating lungs and lobes with lungmask AI ...')
+                    self.startTimingStage("lungmask AI")
                     if infer_mode == "mask": 
                         segmentation_np = mask.apply_fused(inputVolumeSitk)
                     else: 
@@ -2399,6 +2669,7 @@ class LungCTSegmenterLogic(ScriptedLoadableModuleLogic):
                     self.postprocessSegment(self.outputSegmentation,4,"right lower lobe")
                 elif self.engineAI == "lungmask R231CovidWeb":
                     self.showStatusMessage('Creating lungs with lungmask AI ...')
+                    self.startTimingStage("lungmask AI")
                     if infer_mode == "mask": 
                         model = mask.get_model('unet','R231CovidWeb')
                         segmentation_np = mask.apply(inputVolumeSitk, model)
@@ -2419,6 +2690,7 @@ class LungCTSegmenterLogic(ScriptedLoadableModuleLogic):
 
             elif self.engineAI.find("TotalSegmentator") == 0:
                 self.showStatusMessage(' Creating segmentations with TotalSegmentator ...')
+                self.startTimingStage("TotalSegmentator AI")
                 tslogic = slicer.util.getModuleLogic('TotalSegmentator')
                 if not tslogic: 
                     raise RuntimeError("TotalSegmentator program logic not found - please install the TotalSegmentator extension.")
@@ -2541,6 +2813,7 @@ class LungCTSegmenterLogic(ScriptedLoadableModuleLogic):
 
                     if self.calibrateData:
                         self.showStatusMessage('Calibrate data ...')
+                        self.startTimingStage("calibration")
                         self.calibratedInputVolumeNode = slicer.modules.volumes.logic().CloneVolume(self.inputVolume, "CT_calibrated")
                         voxels = slicer.util.arrayFromVolume(self.inputVolume)
                         # voxels_standardized = self.standardize_ct_scan(voxels, mean_air, mean_muscle)
@@ -2573,6 +2846,7 @@ class LungCTSegmenterLogic(ScriptedLoadableModuleLogic):
                 else: 
                     # try to connect to MONAILabel server
                     self.showStatusMessage(' Creating segmentations with MONAILabel ...')
+                    self.startTimingStage("MONAILabel AI")
                     logic = slicer.util.getModuleLogic('MONAILabel')
                     try:
                         #check if Monailabel is connected correctly
@@ -2615,6 +2889,7 @@ class LungCTSegmenterLogic(ScriptedLoadableModuleLogic):
                 logging.info("No AI engine defined.")  
         
         
+        self.startTimingStage("segment setup")
         if not self.outputSegmentation.GetSegmentation().GetSegmentIdBySegmentName("right lung"): 
             # AI created right lobes only, so create lungs and add lobes 
             rightLungID = self.addSegment(self.outputSegmentation, "right lung", self.rightLungColor, 0.3)
@@ -2670,6 +2945,7 @@ class LungCTSegmenterLogic(ScriptedLoadableModuleLogic):
                 slicer.util.errorDisplay("Please install 'SegmentEditorExtraEffects' extension using the extension manager.")
             else:
                 self.showStatusMessage('Airway segmentation ...')
+                self.startTimingStage("airways")
                 
                 # self.segmentEditorNode = self.segmentEditorWidget.mrmlSegmentEditorNode()
                 wasModified = self.outputSegmentation.StartModify()
@@ -2747,6 +3023,7 @@ class LungCTSegmenterLogic(ScriptedLoadableModuleLogic):
                 effect.self().apply(ijkPoints)
                 
                 self.showStatusMessage(f'Filling holes in airways ...')
+                self.startTimingStage("airway holes")
                 self.segmentEditorNode.SetSelectedSegmentID("airways")
                 self.segmentEditorWidget.setActiveEffectByName("Smoothing")
                 effect = self.segmentEditorWidget.activeEffect()
@@ -2769,6 +3046,7 @@ class LungCTSegmenterLogic(ScriptedLoadableModuleLogic):
               "~^^"
               "~^^")
             
+        self.startTimingStage("segment setup")
         # create segments for both lungs, vessel and tumor segmentation
         vesselMaskID = self.addSegment(self.outputSegmentation, "vesselmask", self.vesselmaskColor, 1.0)
         self.outputSegmentation.GetDisplayNode().SetSegmentVisibility(vesselMaskID,False)
@@ -2795,6 +3073,7 @@ class LungCTSegmenterLogic(ScriptedLoadableModuleLogic):
             else:
                 # Create thoracic cavity from lung segmentations
                 self.showStatusMessage('Creating thoracic cavity segment with wrap solidify effect ...')
+                self.startTimingStage("wrap solidify")
                 self.segmentEditorNode.SetSelectedSegmentID(thoracicCavityID)
                 
                 self.segmentEditorWidget.setActiveEffectByName("Wrap Solidify")
@@ -2830,6 +3109,7 @@ class LungCTSegmenterLogic(ScriptedLoadableModuleLogic):
                 self.segmentEditorNode.SetMaskMode(slicer.vtkMRMLSegmentationNode.EditAllowedInsideSingleSegment)
 
                 self.showStatusMessage('Creating vessel mask with threshold effect ...')
+                self.startTimingStage("vessel mask")
                 self.segmentEditorWidget.setActiveEffectByName("Threshold")
                 effect = self.segmentEditorWidget.activeEffect()
                 effect.setParameter("AutoThresholdMethod","OTSU")
@@ -2842,6 +3122,7 @@ class LungCTSegmenterLogic(ScriptedLoadableModuleLogic):
                 effect.self().onApply()
 
                 self.showStatusMessage(f'Filling holes in vessel mask ...')
+                self.startTimingStage("vessel mask holes")
                 self.segmentEditorNode.SetSelectedSegmentID("vesselmask")
                 self.segmentEditorWidget.setActiveEffectByName("Smoothing")
                 effect = self.segmentEditorWidget.activeEffect()
@@ -2865,6 +3146,7 @@ class LungCTSegmenterLogic(ScriptedLoadableModuleLogic):
 
 
                 self.showStatusMessage('Creating thoracic cavity volume with mask volume effect ...')
+                self.startTimingStage("mask volume")
                 self.segmentEditorWidget.setActiveEffectByName("Mask volume")
                 effect = self.segmentEditorWidget.activeEffect()
                 effect.setParameter("BinaryMaskFillValueInside","1")
@@ -2883,6 +3165,7 @@ class LungCTSegmenterLogic(ScriptedLoadableModuleLogic):
 
         if self.create3D: 
             self.showStatusMessage(' Creating 3D ...')
+            self.startTimingStage("3D")
             self.outputSegmentation.CreateClosedSurfaceRepresentation()
             # center 3D view
             layoutManager = slicer.app.layoutManager()
@@ -2916,6 +3199,7 @@ class LungCTSegmenterLogic(ScriptedLoadableModuleLogic):
         slicer.mrmlScene.RemoveNode(self.tracheaFiducials)
 
         self.showStatusMessage(' Cleaning up ...')
+        self.startTimingStage("cleanup")
         self.removeTemporaryObjects()
 
         self.segmentationStarted = False
@@ -1,124 +1,245 @@
-# Windows: Open slicer and enter the command to call this script (me) 
-# exec(open(r"C:\Users\Yourname\Documents\MySlicerExtensions\LungCTAnalyzer\PythonScripts\processAllCTInDir.py").read())
+# Run this script (me) from the command line, without the Slicer main window:
+# Slicer --no-splash --no-main-window --python-script processAllCTInDir.py --input D:/Patients5 --followups 0,1 --jobs 4
 
 
 """
       ProcessAllCtInDir
-      
-      Purpose: 
-      Run this script to search a directory for CT data sets according the 
-      data structure suggested by @PaoloZaffino,   
+
+      Purpose:
+      Run this script to search a directory for CT data sets according the
+      data structure suggested by @PaoloZaffino,
       automatically run LungCTAnalyzer on them and save the results.
-      
+
       Prerequisites:
       - Each CT data set needs to be placed in a subdirectory "Pat x" where x is an integer
-      - input volumes need to be present in each dir and named as follows: 
-              "CT.nrrd", "CT_followup.nrrd", "CT_followup2.nrrd", "CT_followup3.nrrd" 
-      - lung masks need to be prepared in each dir with LungCTSegmenter and named:                                                                            
+      - input volumes need to be present in each dir and named as follows:
+              "CT.nrrd", "CT_followup.nrrd", "CT_followup2.nrrd", "CT_followup3.nrrd"
+      - lung masks need to be prepared in each dir with LungCTSegmenter and named:
              "LungMasksCT.seg.nrrd","LungMasksCTFollowup.seg.nrrd","LungMasksCTFollowup2.seg.nrrd","LungMasksCTFollowup3.seg.nrrd"
       - Up to three follow up CT's are supported
-      - results will be saved as CSV to "results.csv" 
-      - all scenes will be saved automatically as a MRB file. 
-      
+      - results will be saved as CSV to "results.csv" (follow ups to "resultsFollowup.csv", ...) in the output folder
+      - the CTs of a patient are processed together, the change of the results of each CT compared
+        to the first requested CT (e.g. the initial CT) of the patient is saved to "longitudinalResults.csv";
+        the changes are left empty if this CT is missing or could not be processed
+      - all scenes will be saved automatically as a MRB file, in the case folder or, if an output
+        folder is given, in the same subfolder of the output folder.
+
+      Options (see --help):
+      --input DIR          folder that is searched for CT data sets
+      --output DIR         folder of the results (default: the input folder)
+      --followups 0,1      CTs to process: 0 initial CT, 1-3 follow ups (default: 0,1)
+      --jobs N             number of Slicer processes analyzing the cases in parallel (default: 1)
+      --show               show tables, segments and slice views (requires the main window)
+
       ProcessAllCtInDir.py was developed by Rudolf Bumm, Kantonsspital Graubünden, Switzerland in 8/2021
-      
+
 """
 
-import glob
-import sys
+import argparse
+import logging
 import os
+import subprocess
+import sys
 import time
 
-import LungCTAnalyzer
+import slicer
 
-from LungCTAnalyzer import LungCTAnalyzerTest
 from LungCTAnalyzer import LungCTAnalyzerLogic
 
 
-# root_dir needs a trailing slash (i.e. /root/dir/)
-root_dir = "D:/Patients5/"
-slicer.mrmlScene.Clear(0)
-
-slicer.util.selectModule('LungCTAnalyzer')
-
-# initial CT only
-#cnt= [0]
-# initial CT and followup
-cnt= [0,1]
-# initial CT and followup, followup2
-#cnt= [0,1,2]
-# initial CT and followup, followup2 and followup3
-#cnt= [0,1,2,3]
 ctName = ["CT.nrrd","CT_followup.nrrd","CT_followup2.nrrd","CT_followup3.nrrd"]
 maskName = ["LungMasksCT.seg.nrrd","LungMasksCTFollowup.seg.nrrd","LungMasksCTFollowup2.seg.nrrd","LungMasksCTFollowup3.seg.nrrd"]
-detailedSubsegments = False
-shrinkMasks = True
-countBullae = False
 saveDataFileName = ["results.csv","resultsFollowup.csv","resultsFollowup2.csv","resultsFollowup3.csv"]
 saveComment = ["Initial","Followup","Followup2","Followup3"]
 sceneFilename = ["saved_scene.mrb", "saved_scene_followup.mrb", "saved_scene_followup2.mrb", "saved_scene_followup3.mrb"]
-ctCount=0
-
-import time
-startTime = time.time()
-
-do_calc = True 
-list_only = False 
-
-for cn in cnt: 
-    for filename in glob.iglob(root_dir + '**/*.nrrd', recursive=True):
-        pathhead, pathtail = os.path.split(filename)
-        if pathtail == ctName[cn]:
-            if list_only: 
-                print('Found: ' + filename)
-            else: 
-                slicer.mrmlScene.Clear(0)
-                print('Processing: ' + pathhead)
-                slicer.mrmlScene.Clear(0)
-                loadedVolumeNode = slicer.util.loadVolume(filename)
-                loadedMaskNode = slicer.util.loadSegmentation(pathhead+"/"+maskName[cn])  
-                
-                loadedMaskNode.SetName("Lung segmentation")
-                ctCount += 1
-                
-                logic = LungCTAnalyzerLogic()
-
-                logic.inputVolume = loadedVolumeNode
-                logic.inputSegmentation = loadedMaskNode
-                logic.rightLungMaskSegmentID = loadedMaskNode.GetSegmentation().GetSegmentIdBySegmentName("right lung")
-                logic.leftLungMaskSegmentID = loadedMaskNode.GetSegmentation().GetSegmentIdBySegmentName("left lung")
-                logic.setDefaultThresholds(-1050,-990,-650,-400,0,3000)
-                
-                logic.detailedSubsegments = detailedSubsegments
-                logic.shrinkMasks = shrinkMasks
-                logic.countBullae = countBullae
-                if do_calc: 
-                    # show input segments to enable centroid calculation
-                    logic.inputSegmentation.GetDisplayNode().Visibility2DOn()
-                    logic.inputSegmentation.GetDisplayNode().Visibility3DOff()
-
-                    logic.process() # 3D
-
-                    logic.showTable(logic.resultsTable)
-
-                    # ensure user sees the new segments
-                    logic.outputSegmentation.GetDisplayNode().Visibility2DOn()
-
-
-                    # hide preview in slice view
-                    slicer.util.setSliceViewerLayers(background=logic.inputVolume, foreground=None)
-                    sys.stdout.flush()
-                    logic.saveExtendedDataToFile(root_dir + "/"+ saveDataFileName[cn],filename,str(ctCount),saveComment[cn])
-                    # Save scene
-                    sceneSaveFilename = pathhead+"/"+sceneFilename[cn]
-                    if slicer.util.saveScene(sceneSaveFilename):
-                      logging.info("Scene saved to: {0}".format(sceneSaveFilename))
-                    else:
-                      logging.error("Scene saving failed") 
-                    
+longitudinalDataFileName = "longitudinalResults.csv"
+# results of the longitudinal CSV file: logic attribute, column name
+longitudinalResults = [
+    ("totalLungVolume", "total ml"),
+    ("emphysemaTotalVolume", "emphysema ml"),
+    ("emphysemaTotalVolumePerc", "emphysema %"),
+    ("infiltratedTotalVolume", "infiltrated ml"),
+    ("infiltratedTotalVolumePerc", "infiltrated %"),
+    ("collapsedTotalVolume", "collapsed ml"),
+    ("collapsedTotalVolumePerc", "collapsed %"),
+    ]
+
+
+def parseArguments(argv):
+    parser = argparse.ArgumentParser(prog="processAllCTInDir.py", description="Run Lung CT Analyzer on all CT data sets in a folder.")
+    parser.add_argument("--input", required=True, help="folder that is searched (recursively) for CT data sets")
+    parser.add_argument("--output", help="folder of the results CSV files and scenes (default: the input folder, scenes are saved next to the CT)")
+    parser.add_argument("--followups", default="0,1", help="comma separated CTs to process: 0 initial CT, 1-3 follow ups (default: 0,1)")
+    parser.add_argument("--jobs", type=int, default=1, help="number of Slicer processes analyzing the cases in parallel (default: 1)")
+    parser.add_argument("--thresholds", default="-1050,-990,-650,-400,0,3000",
+        help="comma separated thresholds bulla lower, bulla/inflated, inflated/infiltrated, infiltrated/collapsed, collapsed/vessels, vessels upper")
+    parser.add_argument("--count-bullae", action="store_true", help="count bullae as emphysema")
+    parser.add_argument("--csv-only", action="store_true", help="write only the results CSV files, no scenes")
+    parser.add_argument("--list", action="store_true", help="only list the CT data sets that are found")
+    parser.add_argument("--show", action="store_true", help="show tables, segments and slice views (requires the main window)")
+    parser.add_argument("--worker-index", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    args.followups = [int(followup) for followup in args.followups.split(",")]
+    if any(followup not in range(len(ctName)) for followup in args.followups):
+        parser.error("follow ups must be in 0-" + str(len(ctName) - 1))
+    args.thresholds = [float(threshold) for threshold in args.thresholds.split(",")]
+    if len(args.thresholds) != 6:
+        parser.error("6 thresholds are required")
+    if not args.output:
+        args.output = args.input
+    return args
+
+
+def indexPatients(inputDir, followups):
+    """
+    Walk the input folder once and get a list of (patient folder, {follow up index: CT filename}),
+    ordered by folder. Only patients with at least one of the follow ups are listed.
+    """
+    followupByName = {ctName[cn]: cn for cn in followups}
+    patients = []
+    for dirpath, dirnames, filenames in os.walk(inputDir):
+        dirnames.sort()
+        timepoints = {followupByName[filename]: os.path.join(dirpath, filename) for filename in filenames if filename in followupByName}
+        if timepoints:
+            patients.append((dirpath, dict(sorted(timepoints.items()))))
+    return patients
+
+
+def getLongitudinalRows(patientDir, referenceCn, timepointResults):
+    """
+    Get the rows of the longitudinal CSV file of a patient from (follow up index, CT filename, results) of its CTs.
+    Changes are computed relative to the CT of follow up index referenceCn. If there are no results of this CT
+    (missing or failed), the changes are left empty, as changes relative to another CT would not be comparable.
+    """
+    referenceResults = {cn: results for cn, filename, results in timepointResults}.get(referenceCn)
+    if referenceResults is None:
+        logging.warning(f"No results of the {saveComment[referenceCn]} CT of '{patientDir}', changes are not computed.")
+    rows = []
+    for cn, filename, results in timepointResults:
+        row = [filename, patientDir, saveComment[cn], saveComment[referenceCn]]
+        row += [results[name] for name, columnName in longitudinalResults]
+        if referenceResults is None:
+            row += ["" for name, columnName in longitudinalResults]
+        else:
+            row += [results[name] - referenceResults[name] for name, columnName in longitudinalResults]
+        rows.append(row)
+    return rows
+
+
+def processCase(logic, args, cn, filename, caseNumber):
+    """
+    Analyze a CT and save its results. Returns the longitudinal results (see longitudinalResults).
+    """
+    pathhead, pathtail = os.path.split(filename)
+    print('Processing: ' + pathhead)
+    slicer.mrmlScene.Clear(0)
+    logic.setDefaultParameters(logic.getParameterNode())
+    loadedVolumeNode = slicer.util.loadVolume(filename)
+    loadedMaskNode = slicer.util.loadSegmentation(pathhead+"/"+maskName[cn])
+    loadedMaskNode.SetName("Lung segmentation")
+
+    logic.inputVolume = loadedVolumeNode
+    logic.inputSegmentation = loadedMaskNode
+    logic.rightLungMaskSegmentID = loadedMaskNode.GetSegmentation().GetSegmentIdBySegmentName("right lung")
+    logic.leftLungMaskSegmentID = loadedMaskNode.GetSegmentation().GetSegmentIdBySegmentName("left lung")
+    logic.setDefaultThresholds(*args.thresholds)
+    logic.countBullae = args.count_bullae
+
+    if args.show:
+        # show input segments
+        logic.inputSegmentation.GetDisplayNode().Visibility2DOn()
+        logic.inputSegmentation.GetDisplayNode().Visibility3DOff()
+
+    logic.process() # 3D
+
+    if args.show:
+        logic.showTable(logic.resultsTable)
+        # ensure user sees the new segments
+        logic.outputSegmentation.GetDisplayNode().Visibility2DOn()
+        # hide preview in slice view
+        slicer.util.setSliceViewerLayers(background=logic.inputVolume, foreground=None)
         # let slicer process events and update its display
         slicer.app.processEvents()
-        
-stopTime = time.time()
-logging.info('Serial processing completed in {0:.2f} seconds'.format(stopTime-startTime))
 
+    # results files are lock protected, so parallel jobs can add their rows
+    logic.saveExtendedDataToFile(args.output + "/" + saveDataFileName[cn], filename, str(caseNumber), saveComment[cn])
+    if not args.csv_only:
+        sceneDir = os.path.join(args.output, os.path.relpath(pathhead, args.input))
+        os.makedirs(sceneDir, exist_ok=True)
+        sceneSaveFilename = sceneDir + "/" + sceneFilename[cn]
+        if slicer.util.saveScene(sceneSaveFilename):
+            logging.info("Scene saved to: {0}".format(sceneSaveFilename))
+        else:
+            logging.error("Scene saving failed")
+    return {name: getattr(logic, name) for name, columnName in longitudinalResults}
+
+
+def runJobs(args, argv):
+    """
+    Start args.jobs headless Slicer processes running this script, each on every args.jobs-th patient.
+    Returns the number of failed processes.
+    """
+    workerProcesses = []
+    for workerIndex in range(args.jobs):
+        workerProcesses.append(subprocess.Popen([slicer.app.launcherExecutableFilePath,
+            "--no-splash", "--no-main-window", "--python-script", os.path.abspath(__file__)]
+            # workers have no main window to show anything
+            + [arg for arg in argv if arg != "--show"] + ["--worker-index", str(workerIndex)]))
+    return sum(workerProcess.wait() != 0 for workerProcess in workerProcesses)
+
+
+def main(argv):
+    args = parseArguments(argv)
+    startTime = time.time()
+    patients = indexPatients(args.input, args.followups)
+    if args.list:
+        for patientDir, timepoints in patients:
+            for cn, filename in timepoints.items():
+                print('Found: ' + filename)
+        return 0
+    if args.jobs > 1 and args.worker_index is None:
+        failedJobs = runJobs(args, argv)
+        logging.info('Parallel processing with {0} jobs completed in {1:.2f} seconds'.format(args.jobs, time.time()-startTime))
+        return 1 if failedJobs else 0
+
+    if args.show:
+        slicer.util.selectModule('LungCTAnalyzer')
+    logic = LungCTAnalyzerLogic()
+    logic.showProgressBar = args.show
+    from LungCTAnalyzerLib import ResultsSink
+    resultsSink = ResultsSink.ResultsSink(args.output)
+    longitudinalHeader = ['ct file', 'patient', 'timepoint', 'reference timepoint']
+    longitudinalHeader += [columnName for name, columnName in longitudinalResults]
+    longitudinalHeader += ['delta ' + columnName for name, columnName in longitudinalResults]
+    failedCases = 0
+    unflushedPatients = 0
+    # patients are numbered in the order of all patients, also when they are distributed on several jobs
+    for patientIndex, (patientDir, timepoints) in enumerate(patients):
+        if args.worker_index is not None and patientIndex % args.jobs != args.worker_index:
+            continue
+        timepointResults = []
+        for cn, filename in timepoints.items():
+            try:
+                timepointResults.append((cn, filename, processCase(logic, args, cn, filename, patientIndex + 1)))
+            except Exception as e:
+                logging.error(f"Processing of '{filename}' failed: {e}")
+                failedCases += 1
+            sys.stdout.flush()
+        if timepointResults:
+            for row in getLongitudinalRows(os.path.relpath(patientDir, args.input), min(args.followups), timepointResults):
+                resultsSink.addRow(longitudinalDataFileName, longitudinalHeader, row)
+            unflushedPatients += 1
+            # the results file is rewritten when flushed, rows of the CTs of an earlier run are replaced
+            if unflushedPatients >= logic.resultsFlushIntervalCases:
+                resultsSink.flush()
+                unflushedPatients = 0
+    resultsSink.flush()
+    logging.info('Serial processing completed in {0:.2f} seconds'.format(time.time()-startTime))
+    return 1 if failedCases else 0
+
+
+if __name__ == "__main__":
+    exitCode = main(sys.argv[1:])
+    # keep the application open to see the results
+    if "--show" not in sys.argv:
+        slicer.util.exit(exitCode)